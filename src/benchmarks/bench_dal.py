@@ -0,0 +1,77 @@
+"""
+Benchmark DAL write throughput.
+
+Compares the old behaviour - a rollback journal with synchronous=FULL and a
+commit after every statement - with WAL mode, synchronous=NORMAL and a single
+commit per transaction() block.
+
+Run from the src dir, with it on the module path:
+
+    PYTHONPATH=. python benchmarks/bench_dal.py [num_machines]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from hark.dal import DAL
+from hark.models.machine import Machine
+
+
+class LegacyDAL(DAL):
+    "A DAL configured like hark.dal was before WAL mode was introduced."
+
+    def _tune(self):
+        self._db.execute("PRAGMA journal_mode = DELETE;")
+        self._db.execute("PRAGMA synchronous = FULL;")
+
+
+def machines(n):
+    return [
+        Machine.new(
+            name='bench-%d' % i, driver='virtualbox',
+            guest='Debian-8', memory_mb=512)
+        for i in range(n)
+    ]
+
+
+def run(dal, models, batched):
+    start = time.time()
+    if batched:
+        with dal.transaction():
+            for m in models:
+                dal.create(m)
+            for m in models:
+                dal.delete(m)
+    else:
+        for m in models:
+            dal.create(m)
+        for m in models:
+            dal.delete(m)
+    return time.time() - start
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    models = machines(n)
+    ops = 2 * n
+
+    d = tempfile.mkdtemp()
+    try:
+        cases = (
+            ('journal=DELETE sync=FULL, commit per op', LegacyDAL, False),
+            ('journal=WAL sync=NORMAL, commit per op', DAL, False),
+            ('journal=WAL sync=NORMAL, one transaction', DAL, True),
+        )
+        for i, (label, cls, batched) in enumerate(cases):
+            dal = cls(os.path.join(d, 'bench-%d.db' % i))
+            elapsed = run(dal, models, batched)
+            print('%-42s %8.0f ops/s  (%d ops in %.3fs)' % (
+                label, ops / elapsed, ops, elapsed))
+    finally:
+        shutil.rmtree(d)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Benchmark downloading an image over HTTP.
+
+Serves a file of random data from a local http.server and downloads it with
+the previous 1 KiB iter_content loop and with responseToFile, in MiB per
+second. Both hash the data with SHA-256 as image pulls do.
+
+Run from the src dir, with it on the module path:
+
+    PYTHONPATH=. python benchmarks/bench_download.py [size_mib]
+"""
+import hashlib
+import http.server
+import os
+import shutil
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+
+import click
+import requests
+
+from hark.util.download import responseToFile
+
+
+def legacyResponseToFile(msg, response, f, hasher=None):
+    "responseToFile as it was, with a bar update for every 1 KiB chunk"
+    chunk_size = 1024
+    length = int(response.headers['Content-Length'])
+    with click.progressbar(length=length, label=msg) as bar:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            if chunk:
+                f.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+            bar.update(chunk_size)
+        f.flush()
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def translate_path(self, path):
+        # serve the server's directory, not the working directory
+        return os.path.join(self.server.directory, path.lstrip('/'))
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def serve(directory):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), QuietHandler)
+    server.directory = directory
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def throughput(fn, url, dest, size):
+    start = time.time()
+    resp = requests.get(url, stream=True)
+    with open(dest, 'wb') as f:
+        fn('Downloading:', resp, f, hasher=hashlib.sha256())
+    resp.close()
+    return size / (time.time() - start) / 2 ** 20
+
+
+def main():
+    size = int(sys.argv[1]) * 2 ** 20 if len(sys.argv) > 1 else 256 * 2 ** 20
+    d = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(d, 'image.vmdk'), 'wb') as f:
+            for _ in range(size // 2 ** 20):
+                f.write(os.urandom(2 ** 20))
+
+        server = serve(d)
+        url = 'http://127.0.0.1:%d/image.vmdk' % server.server_address[1]
+        dest = os.path.join(d, 'download')
+
+        cases = (
+            ('1 KiB chunks', legacyResponseToFile),
+            ('readinto', responseToFile),
+        )
+        results = [
+            (label, throughput(fn, url, dest, size)) for label, fn in cases]
+        server.shutdown()
+
+        for label, rate in results:
+            print('%-14s %8.1f MiB/s' % (label, rate))
+    finally:
+        shutil.rmtree(d)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Benchmark constructing models from SQL rows.
+
+Compares SQLModel.from_sql_row with the previous OrderedDict-based model,
+in rows per second and bytes allocated per row. The 'slots, trusted' case
+uses the row factory the DAL uses for reads, which skips validation.
+
+Run from the src dir, with it on the module path:
+
+    PYTHONPATH=. python benchmarks/bench_models.py [num_rows]
+"""
+import collections
+import sys
+import time
+import tracemalloc
+
+from hark.models.machine import Machine
+
+
+class LegacyMachine(collections.OrderedDict):
+    "A Machine as it was when models subclassed OrderedDict."
+
+    fields = Machine.fields
+    required = Machine.required
+
+    @classmethod
+    def from_sql_row(cls, row):
+        keyed = collections.OrderedDict()
+        for i, k in enumerate(cls.fields):
+            keyed[k] = row[i]
+
+        ins = cls(**keyed)
+        ins.validate()
+        return ins
+
+    def validate(self):
+        missing = [k for k in self.required if k not in self]
+        assert not missing
+        assert self['memory_mb'] >= 128
+
+
+def rows(n):
+    return [
+        ('%08x' % i, 'machine-%d' % i, 'virtualbox', 'Debian-8', 512)
+        for i in range(n)
+    ]
+
+
+class TrustedMachine(object):
+    "Construct Machines the way DAL reads do."
+
+    @classmethod
+    def from_sql_row(cls, row):
+        return Machine.from_sql_row(row, validate=False)
+
+
+def throughput(cls, data):
+    start = time.time()
+    for row in data:
+        cls.from_sql_row(row)
+    return len(data) / (time.time() - start)
+
+
+def memory(cls, data):
+    tracemalloc.start()
+    models = [cls.from_sql_row(row) for row in data]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del models
+    return size / len(data)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    data = rows(n)
+
+    cases = (
+        ('OrderedDict', LegacyMachine),
+        ('slots', Machine),
+        ('slots, trusted', TrustedMachine),
+    )
+    for label, cls in cases:
+        print('%-16s %10.0f rows/s %8.0f bytes/row' % (
+            label, throughput(cls, data), memory(cls, data)))
+
+
+if __name__ == '__main__':
+    main()
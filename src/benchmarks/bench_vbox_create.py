@@ -0,0 +1,91 @@
+"""
+Benchmark creating a VirtualBox machine.
+
+Puts a stub VBoxManage first on the PATH, which counts its invocations and
+sleeps to simulate the startup cost of connecting to VBoxSVC, and compares
+running one VBoxManage per command, as the driver used to, with the batched
+create. Reports invocations and seconds per machine.
+
+Run from the src dir, with it on the module path:
+
+    PYTHONPATH=. python benchmarks/bench_vbox_create.py [latency_ms] [n]
+
+n is the number of machines.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import hark.driver.virtualbox
+import hark.log
+from hark.models.machine import Machine
+
+
+_stub = """#!/bin/sh
+echo "$@" >> "%(log)s"
+sleep %(latency)s
+"""
+
+
+class LegacyDriver(hark.driver.virtualbox.Driver):
+    "The driver as it was, running each command separately."
+
+    def _runBatch(self, cmds):
+        for cmd in cmds:
+            self._run(cmd)
+
+
+def install_stub(d, latency):
+    log = os.path.join(d, 'calls.log')
+    path = os.path.join(d, 'VBoxManage')
+    with open(path, 'w') as f:
+        f.write(_stub % {'log': log, 'latency': latency})
+    os.chmod(path, 0o755)
+    os.environ['PATH'] = d + os.pathsep + os.environ['PATH']
+    return log
+
+
+def calls(log):
+    if not os.path.exists(log):
+        return 0
+    with open(log) as f:
+        return len(f.readlines())
+
+
+def bench(cls, log, n):
+    before = calls(log)
+    start = time.time()
+    for i in range(n):
+        machine = Machine.new(
+            name='bench-%d' % i, driver='virtualbox', guest='Debian-8',
+            memory_mb=512)
+        d = cls(machine)
+        d.host_only_interface = lambda dal: 'vboxnet0'
+        d.create('/images/base.vmdk', None)
+    return (calls(log) - before) / n, (time.time() - start) / n
+
+
+def main():
+    latency = float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.2
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    hark.log.setLevel('WARNING')
+    d = tempfile.mkdtemp()
+    try:
+        log = install_stub(d, latency)
+        cases = (
+            ('per command', LegacyDriver),
+            ('batched', hark.driver.virtualbox.Driver),
+        )
+        for label, cls in cases:
+            ncalls, seconds = bench(cls, log, n)
+            print('%-12s %5.1f calls/machine %7.3f s/machine' % (
+                label, ncalls, seconds))
+    finally:
+        shutil.rmtree(d)
+
+
+if __name__ == '__main__':
+    main()
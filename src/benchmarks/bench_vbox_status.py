@@ -0,0 +1,102 @@
+"""
+Benchmark finding the status of many VirtualBox machines.
+
+Puts a stub VBoxManage first on the PATH, which sleeps to simulate the
+startup cost of connecting to VBoxSVC and answers list --long vms and
+showvminfo for a number of machines, and compares a status() per machine
+with the bulk statuses(). Reports invocations and total seconds.
+
+Run from the src dir, with it on the module path:
+
+    PYTHONPATH=. python benchmarks/bench_vbox_status.py [latency_ms] [n]
+
+n is the number of machines.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import hark.driver.virtualbox
+import hark.log
+from hark.models.machine import Machine
+
+
+_stub = """#!/bin/sh
+echo "$@" >> "%(log)s"
+sleep %(latency)s
+case "$1 $2" in
+"list --long")
+    i=0
+    while [ $i -lt %(n)d ]; do
+        echo "Name:            bench-$i"
+        echo "State:           powered off (since 2016-01-01T00:00:00.0)"
+        echo
+        i=$((i + 1))
+    done
+    ;;
+showvminfo*)
+    echo 'VMState="poweroff"'
+    ;;
+esac
+"""
+
+
+def install_stub(d, latency, n):
+    log = os.path.join(d, 'calls.log')
+    path = os.path.join(d, 'VBoxManage')
+    with open(path, 'w') as f:
+        f.write(_stub % {'log': log, 'latency': latency, 'n': n})
+    os.chmod(path, 0o755)
+    os.environ['PATH'] = d + os.pathsep + os.environ['PATH']
+    return log
+
+
+def calls(log):
+    if not os.path.exists(log):
+        return 0
+    with open(log) as f:
+        return len(f.readlines())
+
+
+def per_machine(machines):
+    cls = hark.driver.virtualbox.Driver
+    return {m['name']: cls(m).status() for m in machines}
+
+
+def bulk(machines):
+    return hark.driver.virtualbox.Driver.statuses(machines)
+
+
+def bench(fn, log, machines):
+    before = calls(log)
+    start = time.time()
+    fn(machines)
+    return calls(log) - before, time.time() - start
+
+
+def main():
+    latency = float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.2
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+
+    hark.log.setLevel('WARNING')
+    machines = [
+        Machine.new(
+            name='bench-%d' % i, driver='virtualbox', guest='Debian-8',
+            memory_mb=512)
+        for i in range(n)
+    ]
+    d = tempfile.mkdtemp()
+    try:
+        log = install_stub(d, latency, n)
+        for label, fn in (('per machine', per_machine), ('bulk', bulk)):
+            ncalls, seconds = bench(fn, log, machines)
+            print('%-12s %4d calls %7.3f s for %d machines' % (
+                label, ncalls, seconds, n))
+    finally:
+        shutil.rmtree(d)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,8 @@
 import click
 
 from hark.cli.util import (
-    driverOption, guestOption, imageVersionPrompt,
+    driverOption, guestOption, imageVersionPrompt, imageQuotaOption,
+    SizeParamType,
     modelsWithHeaders, promptModelChoice,
     getMachine, getSSHMapping, getPrivateInterface,
     loadLocalContext,
@@ -15,7 +16,11 @@ from hark.imagestore import DEFAULT_IMAGESTORE_URL
 @click.pass_context
 @click.option('--hark-home', envvar='HARKHOME', type=str)
 @click.option('--log-level', envvar='LOGLEVEL', type=str, default='INFO')
-def hark_main(ctx, hark_home=None, log_level='INFO'):
+@click.option(
+    '--image-quota', type=SizeParamType(), envvar='HARK_IMAGE_QUOTA',
+    help='The most disk the image cache may use, e.g. 20G. Old images are '
+    'evicted to stay under it after each pull.')
+def hark_main(ctx, hark_home=None, log_level='INFO', image_quota=None):
     "Hark is a tool to help manage virtual machines"
     from hark.client import LocalClient
     import hark.exceptions
@@ -31,7 +36,7 @@ def hark_main(ctx, hark_home=None, log_level='INFO'):
 
     hark.log.setLevel(log_level)
 
-    harkctx = loadLocalContext(hark_home)
+    harkctx = loadLocalContext(hark_home, image_quota=image_quota)
 
     hark.log.setOutputFile(harkctx.log_file())
 
@@ -47,12 +52,27 @@ def vm(client):
 
 @vm.command(name='list')
 @click.pass_obj
-def machine_list(client):
+@click.option(
+    "--status", is_flag=True, default=False,
+    help="Show each machine's status, as its driver reports it")
+def machine_list(client, status):
     "List hark machines"
+    from hark.models.machine import Machine
+
     machines = client.machines()
 
     click.secho("vm list: found %d hark machines" % len(machines), fg='green')
-    click.echo(modelsWithHeaders(machines))
+    if not status:
+        click.echo(modelsWithHeaders(machines))
+        return
+
+    statuses = client.machineStatuses(machines)
+    rows = []
+    for m in machines:
+        row = dict(m)
+        row['status'] = str(statuses[m['name']])
+        rows.append(row)
+    click.echo(modelsWithHeaders(rows, fields=Machine.fields + ['status']))
 
 
 @vm.command()
@@ -65,7 +85,11 @@ def machine_list(client):
 @click.option(
     "--memory_mb", type=click.IntRange(MEMORY_MINIMUM),
     prompt="Memory (MB)", help="Memory allocated to the machine in MB")
-def new(ctx, **kwargs):
+@click.option(
+    "--linked-clone", is_flag=True, envvar='HARK_LINKED_CLONE',
+    help="Create the machine as a linked clone of a golden VM for its image, "
+    "which is much faster than building it from scratch")
+def new(ctx, linked_clone=False, **kwargs):
     "Create a new hark machine"
     from hark.models.machine import Machine
     import hark.procedure
@@ -78,7 +102,7 @@ def new(ctx, **kwargs):
     m = Machine.new(**{f: kwargs[f] for f in Machine.fields if f in kwargs})
     m.validate()
 
-    proc = hark.procedure.NewMachine(client, m)
+    proc = hark.procedure.NewMachine(client, m, linked_clone=linked_clone)
 
     try:
         proc.run()
@@ -152,13 +176,12 @@ def setup(client, name):
     help='Whether to start with a gui')
 def start(client, name, gui):
     "Start a machine"
-    import hark.driver
 
     m = getMachine(client, name)
 
     click.echo('Starting machine: ' + name)
 
-    d = hark.driver.get_driver(m['driver'], m)
+    d = client.driver(m)
 
     d.start(gui=gui)
     click.secho('Done.', fg='green')
@@ -174,13 +197,12 @@ def start(client, name, gui):
     prompt="Machine name", help="The name of the machine")
 def stop(client, name):
     "Stop a machine"
-    import hark.driver
 
     m = getMachine(client, name)
 
     click.echo('Stopping machine: ' + name)
 
-    d = hark.driver.get_driver(m['driver'], m)
+    d = client.driver(m)
 
     d.stop()
     click.secho('Done.', fg='green')
@@ -266,20 +288,49 @@ def image(client):
     pass
 
 
+def _evictImages(client, quota, dry_run=False, prune_golden=False):
+    evicted = client.gcImages(
+        quota=quota, dry_run=dry_run, prune_golden=prune_golden)
+    verb = 'Would evict' if dry_run else 'Evicted'
+    for image in evicted:
+        click.secho('%s image: %s' % (verb, image.json()), fg='yellow')
+    return evicted
+
+
 @image.command(name='pull')
 @click.pass_obj
 @click.option(
     '--imagestore-url', type=str,
     envvar='IMAGESTORE_URL', default=DEFAULT_IMAGESTORE_URL)
-def image_pull(client, imagestore_url=None):
+@imageQuotaOption
+@click.option(
+    '--segments', type=click.IntRange(min=1), envvar='HARK_DOWNLOAD_SEGMENTS',
+    default=4, help='How many parts of the image to download at once, if '
+    'the imagestore supports it')
+@click.option(
+    '--chunk-size', type=SizeParamType(), envvar='HARK_DOWNLOAD_CHUNK_SIZE',
+    default='4M', help='How much of the image to read at a time, e.g. 4M')
+@click.option(
+    '--compress/--no-compress', default=True,
+    help='Whether to download a compressed image, if the imagestore has '
+    'one. Compressed images are smaller, but their downloads are not '
+    'segmented and cannot be resumed.')
+def image_pull(
+        client, imagestore_url=None, quota=None, segments=4,
+        chunk_size=None, compress=True):
     "Pull down an image for the local cache"
     from hark.client import ImagestoreClient
+    import hark.exceptions
+    from hark.util.download import COMPRESSIONS
+    from hark.util.imageindex import ImageIndex
 
-    image_client = ImagestoreClient(imagestore_url)
+    image_client = ImagestoreClient(
+        imagestore_url, cache_dir=client.cacheDir())
 
-    image = promptModelChoice(image_client.images())
+    available = ImageIndex(image_client.images())
+    image = promptModelChoice(list(available))
 
-    if image in client.images():
+    if client.hasImage(image):
         click.secho(
             'Already have this image locally: %s' % image.json(), fg='red')
         click.secho(
@@ -287,14 +338,34 @@ def image_pull(client, imagestore_url=None):
             fg='red')
         return
 
-    url = image_client.image_url(image)
+    info = image_client.image_info(
+        image, compression=COMPRESSIONS if compress else None)
+    url = info['url']
+    sha256 = info.get('sha256')
 
     click.secho('Downloading image: ' + image.json(), fg='green')
     click.secho('From URL: %s' % url, fg='green')
+    if info['compression'] is not None:
+        click.secho(
+            'Decompressing %s as it downloads' % info['compression'],
+            fg='green')
+    elif client.hasPartialImage(image):
+        click.secho('Resuming an earlier download', fg='green')
+    if sha256 is None:
+        click.secho(
+            'The imagestore has no checksum for this image; '
+            'it will not be verified', fg='yellow')
 
-    client.saveImageFromUrl(image, url)
+    try:
+        client.saveImageFromUrl(
+            image, url, sha256=sha256, segments=segments,
+            chunk_size=chunk_size, compression=info['compression'])
+    except hark.exceptions.ChecksumMismatch as e:
+        click.secho(str(e), fg='red')
+        raise click.Abort
 
-    return
+    if quota is not None or client.imageQuota() is not None:
+        _evictImages(client, quota)
 
 
 @image.command(name='pull-local')
@@ -303,21 +374,77 @@ def image_pull(client, imagestore_url=None):
 @driverOption
 @guestOption
 @imageVersionPrompt
-def image_pull_local(client, local_file, driver, guest, version):
+@click.option(
+    '--mode', type=click.Choice(['copy', 'link', 'move']), default='copy',
+    help="How to import the file: copy it (cloning it where the filesystem "
+    "supports it), hardlink it, or move it into the cache")
+@imageQuotaOption
+def image_pull_local(
+        client, local_file, driver, guest, version, mode, quota=None):
     "Save an image from a local file"
     from hark.models.image import Image
     image = Image(
         driver=driver, guest=guest, version=version)
-    client.saveImageFromFile(image, local_file)
+    res = client.saveImageFromFile(image, local_file, mode=mode)
+    click.secho('Imported image with %s' % res, fg='green')
+
+    if quota is not None or client.imageQuota() is not None:
+        _evictImages(client, quota)
 
 
 @image.command(name='list')
 @click.pass_obj
 def image_list(client):
+    from hark.models.image import Image
+    from hark.util import formatSize
+
     images = client.images()
     click.secho(
         "image list: found %d cached hark images" % len(images), fg='green')
-    click.echo(modelsWithHeaders(images))
+
+    # show the apparent size of each image and the disk it actually uses,
+    # which is less for a sparse image
+    rows = []
+    for image in images:
+        entry = client.imageEntry(image)
+        row = Image(image)
+        row['size'] = formatSize(entry['size'])
+        row['allocated'] = formatSize(entry.get('allocated', entry['size']))
+        rows.append(row)
+    click.echo(modelsWithHeaders(
+        rows, fields=Image.fields + ['size', 'allocated']))
+
+
+@image.command(name='gc')
+@click.pass_obj
+@imageQuotaOption
+@click.option(
+    '--dry-run', is_flag=True, default=False,
+    help='Show which images would be evicted without removing them')
+@click.option(
+    '--prune-golden', is_flag=True, default=False,
+    help='First remove golden VMs which no machine is a linked clone of, '
+    'so that their images can be evicted')
+def image_gc(client, quota=None, dry_run=False, prune_golden=False):
+    """
+    Evict old images from the local cache.
+
+    The least recently used images go first. The latest version of each
+    image, and any image an existing machine may use, are always kept.
+    Without a quota, here or from --image-quota, every other image is
+    evicted. Images with golden VMs for linked clones are kept unless
+    --prune-golden removes the VMs.
+    """
+    before = client.imageCacheSize()
+    evicted = _evictImages(
+        client, quota, dry_run=dry_run, prune_golden=prune_golden)
+    if dry_run:
+        click.secho(
+            'image gc: would evict %d images' % len(evicted), fg='green')
+        return
+    click.secho(
+        'image gc: evicted %d images, freeing %d bytes' % (
+            len(evicted), before - client.imageCacheSize()), fg='green')
 
 
 @hark_main.command()
@@ -332,7 +459,7 @@ def ssh(client, name=None):
     import hark.ssh
 
     m = getMachine(client, name)
-    d = hark.driver.get_driver(m['driver'], m)
+    d = client.driver(m)
     mapping = getSSHMapping(client, m)
 
     status = d.status()
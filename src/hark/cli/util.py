@@ -26,6 +26,26 @@ imageVersionPrompt = click.option(
     type=int, help='The version to treat this image as')
 
 
+class SizeParamType(click.ParamType):
+    "A size in bytes, such as 500M or 20G"
+    name = 'size'
+
+    def convert(self, value, param, ctx):
+        import hark.util
+        if isinstance(value, int):
+            return value
+        try:
+            return hark.util.parseSize(value)
+        except ValueError as e:
+            self.fail(str(e), param, ctx)
+
+
+imageQuotaOption = click.option(
+    '--quota', type=SizeParamType(),
+    help='The most disk the image cache may use, e.g. 20G. Old images are '
+    'evicted to stay under it. Overrides --image-quota.')
+
+
 def promptModelChoice(models):
     click.echo(modelsWithHeaders(models, add_index=True))
     while True:
@@ -35,9 +55,12 @@ def promptModelChoice(models):
         click.secho('Invalid choice: %d' % i, fg='red')
 
 
-def modelsWithHeaders(models, add_index=False):
+def modelsWithHeaders(models, add_index=False, fields=None):
     """
     Generate a string to print a list of models with headers.
+
+    By default the columns are the models' fields; pass fields to choose
+    them, e.g. to include extra keys.
     """
     import io
 
@@ -45,11 +68,12 @@ def modelsWithHeaders(models, add_index=False):
     if len(models) == 0:
         return ""
 
-    fields = models[0].fields
+    if fields is None:
+        fields = models[0].fields
 
     if add_index:
-        # insert the num field
-        fields.insert(0, 'num')
+        # insert the num field, without mutating the model class's fields
+        fields = ['num'] + fields
         # copy the models so that we don't mutate
         models = [dict(m) for m in models]
         # add num to each of them
@@ -100,14 +124,14 @@ def getSSHMapping(client, machine):
     return mappings[0]
 
 
-def loadLocalContext(hark_home=None, context_class=None):
+def loadLocalContext(hark_home=None, context_class=None, image_quota=None):
     if context_class is None:
         from hark.context import Context
         context_class = Context
 
     if hark_home is not None:
-        return context_class(hark_home)
-    return context_class.home()
+        return context_class(hark_home, image_quota=image_quota)
+    return context_class.home(image_quota=image_quota)
 
 
 def getPrivateInterface(client, machine):
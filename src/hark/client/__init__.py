@@ -1,13 +1,63 @@
+import contextlib
+
+from hark.client.cache import ModelCache
+from hark.client.catalogcache import CatalogCache
 import hark.log as log
 
 
+# The imagestore client's defaults: seconds to wait to connect and for each
+# read, how many times to retry a request, and how many connections to keep.
+DEFAULT_TIMEOUT = (10, 60)
+DEFAULT_RETRIES = 3
+DEFAULT_POOL_SIZE = 8
+
+
+def _retry(retries):
+    "A urllib3 Retry policy for idempotent imagestore requests"
+    from requests.packages.urllib3.util.retry import Retry
+    kwargs = {
+        'total': retries,
+        'backoff_factor': 0.5,
+        'status_forcelist': (500, 502, 503, 504),
+    }
+    methods = frozenset(['GET', 'HEAD'])
+    try:
+        return Retry(allowed_methods=methods, **kwargs)
+    except TypeError:
+        # urllib3 before 1.26
+        return Retry(method_whitelist=methods, **kwargs)
+
+
 class LocalClient(object):
+    """
+    A client for the local hark context.
+
+    Reads of machines, port mappings and network interfaces are cached in
+    process. Writes made through the client keep the cache up to date; writes
+    made directly through the DAL are not seen.
+    """
+
     def __init__(self, context):
         self._context = context
+        self._cache = ModelCache()
 
     def dal(self):
         return self._context.dal
 
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        A context manager which commits every write made through this client
+        inside it in a single database transaction.
+        """
+        try:
+            with self.dal().transaction():
+                yield
+        except BaseException:
+            # the cache may hold models that were rolled back
+            self._cache.clear()
+            raise
+
     def network(self):
         return self._context.network()
 
@@ -18,40 +68,55 @@ class LocalClient(object):
     def machines(self):
         "Get all machines"
         from hark.models.machine import Machine
-        return self.dal().read(Machine)
+        return self._cache.read(
+            Machine, {}, lambda: self.dal().read(Machine))
 
     def createMachine(self, machine):
         log.debug('dal: saving machine: %s', machine.json())
         self.dal().create(machine)
+        self._cache.saved(machine)
 
     def getMachine(self, name):
         "Get a machine by name."
         import hark.exceptions
         from hark.models.machine import Machine
 
-        m = self.dal().read(Machine, constraints={"name": name})
-        if len(m) == 0:
+        constraints = {"name": name}
+        m = self._cache.read_one(
+            Machine, constraints,
+            lambda: self.dal().read_one(Machine, constraints=constraints))
+        if m is None:
             raise hark.exceptions.MachineNotFound
-        return m[0]
+        return m
 
     def deleteMachine(self, machine):
+        """
+        Delete a machine along with its network interfaces and port mappings,
+        in a single transaction.
+        """
+        from hark.models.machine import Machine
         from hark.models.network_interface import NetworkInterface
         from hark.models.port_mapping import PortMapping
         mid = machine['machine_id']
 
-        # delete the machine from the DB
-        log.debug('dal: deleting machine: %s', machine.json())
-        self.dal().delete(machine)
-
         constraints = {'machine_id': mid}
 
-        # delete its network interfaces
-        log.debug('dal: deleting network interfaces for machine: %s' % mid)
-        self.dal().deleteWhere(NetworkInterface, constraints)
+        with self.transaction():
+            # delete the machine from the DB
+            log.debug('dal: deleting machine: %s', machine.json())
+            self.dal().delete(machine)
+
+            # delete its network interfaces
+            log.debug('dal: deleting network interfaces for machine: %s' % mid)
+            self.dal().deleteWhere(NetworkInterface, constraints)
+
+            # delete its port mappings
+            log.debug('dal: deleting port mappings for machine: %s' % mid)
+            self.dal().deleteWhere(PortMapping, constraints)
 
-        # delete its port ma[[ings
-        log.debug('dal: deleting port mappings for machine: %s' % mid)
-        self.dal().deleteWhere(PortMapping, constraints)
+        self._cache.deleted(Machine, constraints)
+        self._cache.deleted(NetworkInterface, constraints)
+        self._cache.deleted(PortMapping, constraints)
 
     def portMappings(self, name=None, machine_id=None):
         "Get all port mappings"
@@ -62,11 +127,14 @@ class LocalClient(object):
         if machine_id is not None:
             constraints['machine_id'] = machine_id
 
-        return self.dal().read(PortMapping, constraints=constraints)
+        return self._cache.read(
+            PortMapping, constraints,
+            lambda: self.dal().read(PortMapping, constraints=constraints))
 
     def createPortMapping(self, mapping):
         log.debug('dal: saving port mapping: %s', mapping)
         self.dal().create(mapping)
+        self._cache.saved(mapping)
 
     def networkInterfaces(self, machine=None, kind=None):
         "Get all network interfaces"
@@ -78,7 +146,9 @@ class LocalClient(object):
         if machine is not None:
             constraints['machine_id'] = machine['machine_id']
 
-        return self.dal().read(NetworkInterface, constraints=constraints)
+        return self._cache.read(
+            NetworkInterface, constraints,
+            lambda: self.dal().read(NetworkInterface, constraints=constraints))
 
     def freePrivateIP(self):
         "Get an free private IP address for a machine"
@@ -90,56 +160,252 @@ class LocalClient(object):
     def createNetworkInterface(self, iface):
         log.debug('dal: saving network interface: %s', iface)
         self.dal().create(iface)
+        self._cache.saved(iface)
+
+    def driver(self, machine):
+        "Return the driver instance for a machine"
+        import hark.driver
+        return hark.driver.get_driver(
+            machine['driver'], machine,
+            state_dir=self._context.machines_dir())
+
+    def machineStatuses(self, machines):
+        "Return a dict of machine name to driver status for machines"
+        import hark.driver
+        return hark.driver.statuses(
+            machines, state_dir=self._context.machines_dir())
 
     def images(self):
         "Return the list of locally cached images"
         return self._context.image_cache().images()
 
+    def imageIndex(self):
+        "Return an ImageIndex of the locally cached images"
+        return self._context.image_cache().index()
+
+    def hasImage(self, image):
+        "Whether an image is in the local cache"
+        return self._context.image_cache().has(image)
+
+    def imageEntry(self, image):
+        """
+        Return the cache's record of an image: its size, allocated size,
+        checksum and usage.
+        """
+        return self._context.image_cache().entry(image)
+
+    def hasPartialImage(self, image):
+        "Whether there is an interrupted download of an image to resume"
+        return self._context.image_cache().has_partial(image)
+
+    def useImage(self, image, machine=None):
+        "Record that an image was used, optionally to create a machine"
+        machine_id = None if machine is None else machine['machine_id']
+        self._context.image_cache().touch(image, machine_id=machine_id)
+
+    def gcImages(self, quota=None, dry_run=False, prune_golden=False):
+        """
+        Evict old images from the local cache, least recently used first,
+        until the disk it uses fits within quota bytes; without one, the
+        cache's own quota is used. The latest version of each image, any
+        image an existing machine may use and any image a driver keeps a
+        golden VM for are kept. Returns the list of evicted images.
+
+        With prune_golden, golden VMs with no linked clones are removed
+        first, so that their images can be evicted too. A dry run doesn't
+        remove them.
+        """
+        import hark.driver
+        if prune_golden and not dry_run:
+            for path in hark.driver.prune_golden_vms(self.dal()):
+                log.info('Removed the golden VM for image %s', path)
+        return self._context.image_cache().gc(
+            self.machines(), quota=quota, dry_run=dry_run,
+            pinned=hark.driver.pinned_images(self.dal()))
+
+    def imageQuota(self):
+        "The image cache's own quota in bytes, or None if it has none"
+        return self._context.image_cache().quota
+
+    def imageCacheSize(self):
+        "The total bytes of disk the local image cache uses"
+        return self._context.image_cache().allocated()
+
+    def cacheDir(self):
+        "The directory for hark's caches of remote data"
+        return self._context.cache_dir()
+
     def imagePath(self, image):
         "Get the full file path to an image"
         return self._context.image_cache().full_image_path(image)
 
-    def saveImageFromFile(self, image, source):
-        self._context.image_cache().saveFromFile(image, source)
-
-    def saveImageFromUrl(self, image, url):
+    def saveImageFromFile(self, image, source, mode='copy'):
+        """
+        Import an image from a local file, with the 'copy', 'link' or 'move'
+        mode. Returns a CopyResult.
+        """
+        return self._context.image_cache().saveFromFile(
+            image, source, mode=mode)
+
+    def saveImageFromUrl(
+            self, image, url, sha256=None, segments=None, chunk_size=None,
+            compression=None):
+        """
+        Download an image into the local cache.
+
+        The image is written to a partial file, and an interrupted download
+        is resumed where it left off the next time this is called. If the
+        server supports it, the image is downloaded in this many segments at
+        once; see hark.util.download.segmentedDownload.
+
+        If compression is given, e.g. 'xz', the URL is for a compressed image,
+        which is decompressed into the cache as it downloads. Such downloads
+        are neither segmented nor resumable.
+
+        If sha256 is given and the digest of the (decompressed) image doesn't
+        match it, the download is discarded and ChecksumMismatch is raised;
+        the image only appears in the cache once it has been verified.
+        """
+        import hark.exceptions
         import hark.util.download
-        import requests
-        resp = requests.get(url, stream=True)
-        f = open(self.imagePath(image), 'wb')
 
-        try:
-            hark.util.download.responseToFile(
-                'Downloading:', resp, f)
-        finally:
-            resp.close()
-            f.close()
+        if segments is None:
+            segments = hark.util.download.DEFAULT_SEGMENTS
+        if chunk_size is None:
+            chunk_size = hark.util.download.BUFFER_SIZE
+
+        cache = self._context.image_cache()
+        if compression is None:
+            digest = hark.util.download.segmentedDownload(
+                'Downloading:', url, cache.partial_path(image),
+                sha256=sha256, state_path=cache.partial_state_path(image),
+                segments=segments, chunk_size=chunk_size)
+        else:
+            try:
+                digest = hark.util.download.decompressingDownload(
+                    'Downloading:', url, cache.partial_path(image),
+                    compression, state_path=cache.partial_state_path(image),
+                    buffer_size=chunk_size)
+            except BaseException:
+                # there's nothing to resume from
+                cache.discard_partial(image)
+                raise
+
+        if sha256 is not None and digest != sha256.lower():
+            cache.discard_partial(image)
+            raise hark.exceptions.ChecksumMismatch(url, sha256, digest)
+
+        cache.commit_partial(image, sha256=digest)
 
 
 class ImagestoreClient(object):
-    def __init__(self, url):
+    """
+    A client for the imagestore's JSON API.
+
+    Requests go through a pooled session which retries connection errors and
+    server errors with backoff, and time out. If a cache_dir is given, JSON
+    responses are cached there according to their Cache-Control and ETag
+    headers, and the last good response is used if the imagestore can't be
+    reached.
+    """
+
+    def __init__(self, url, cache_dir=None, timeout=DEFAULT_TIMEOUT,
+                 retries=DEFAULT_RETRIES, pool_size=DEFAULT_POOL_SIZE):
         import requests
+        import requests.adapters
         import hark.imagestore
 
         self.session = requests.session()
         self.base_url = url
         self.session.headers['Accept'] = 'application/json'
         self.urls = hark.imagestore.URLS
+        self.timeout = timeout
+
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size,
+            max_retries=_retry(retries))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.catalog_cache = None
+        if cache_dir is not None:
+            self.catalog_cache = CatalogCache(cache_dir)
 
     def _full_url(self, url):
         return "%s/%s" % (self.base_url, url)
 
     def _get(self, url):
-        response = self.session.get(self._full_url(url))
+        import requests
+
+        full_url = self._full_url(url)
+        if self.catalog_cache is None:
+            response = self.session.get(full_url, timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()
+
+        entry = self.catalog_cache.get(full_url)
+        if self.catalog_cache.fresh(entry):
+            log.debug('imagestore: using cached %s', full_url)
+            return entry['body']
+
+        headers = {}
+        if entry is not None and entry['etag'] is not None:
+            headers['If-None-Match'] = entry['etag']
+
+        try:
+            response = self.session.get(
+                full_url, headers=headers, timeout=self.timeout)
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.RetryError) as e:
+            # RetryError is raised when the server kept answering with a
+            # 5xx status until the retries ran out
+            if entry is None:
+                raise
+            log.info(
+                'imagestore: %s is unreachable, using the cached response '
+                '(%s)', full_url, e)
+            return entry['body']
+
+        if response.status_code == 304 and entry is not None:
+            log.debug('imagestore: %s not modified', full_url)
+            body = entry['body']
+            self.catalog_cache.put(
+                full_url, body, response.headers, etag=entry['etag'])
+            return body
+
         response.raise_for_status()
-        return response.json()
+        body = response.json()
+        self.catalog_cache.put(full_url, body, response.headers)
+        return body
 
     def images(self):
         from hark.models.image import Image
         js = self._get(self.urls['images'])
         return [Image(**o) for o in js]
 
-    def image_url(self, image):
+    def image_info(self, image, compression=None):
+        """
+        Return the imagestore's record for an image: a dictionary with its
+        download 'url', the 'sha256' of the image if the imagestore publishes
+        one, and the 'compression' the URL is for, or None.
+
+        compression is a list of the compressed formats the client accepts,
+        most preferred first; the imagestore may then give the URL of a
+        compressed variant. It says which in 'compression', or failing that
+        by the URL's file suffix.
+        """
+        import hark.util.download
+
         url = self.urls['image'].format(**image)
-        js = self._get(url)
-        return js['url']
+        if compression:
+            url += '?compression=' + ','.join(compression)
+        info = dict(self._get(url))
+        if not compression:
+            info['compression'] = None
+        elif info.get('compression') is None:
+            info['compression'] = hark.util.download.compressionFromUrl(
+                info['url'])
+        return info
+
+    def image_url(self, image):
+        return self.image_info(image)['url']
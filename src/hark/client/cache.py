@@ -0,0 +1,92 @@
+class ModelCache(object):
+    """
+    An in-process identity map and read cache for SQL models.
+
+    Each model is held once, keyed by its class and primary key. The results
+    of reads are cached as lists of primary keys, keyed by the model class and
+    the query constraints. Writing a model of a class drops every cached read
+    for that class.
+    """
+
+    def __init__(self):
+        # (cls, primary key) -> model
+        self._models = {}
+        # (cls, constraints) -> [primary key]
+        self._reads = {}
+
+    def _primary_key(self, model):
+        key = model.key
+        if isinstance(key, str):
+            return model[key]
+        return tuple(model[k] for k in key)
+
+    def _read_key(self, cls, constraints):
+        return (cls, tuple(sorted(constraints.items())))
+
+    def _add(self, model):
+        """
+        Add a model to the identity map, and return the instance held for its
+        key.
+        """
+        k = (model.__class__, self._primary_key(model))
+        return self._models.setdefault(k, model)
+
+    def read(self, cls, constraints, loader):
+        """
+        Return the list of models of cls matching constraints. On a miss,
+        loader is called to read them.
+        """
+        rk = self._read_key(cls, constraints)
+        keys = self._reads.get(rk)
+        if keys is not None:
+            return [self._models[(cls, k)] for k in keys]
+
+        models = [self._add(m) for m in loader()]
+        self._reads[rk] = [self._primary_key(m) for m in models]
+        return models
+
+    def read_one(self, cls, constraints, loader):
+        """
+        Return the model of cls matching constraints, or None. On a miss,
+        loader is called to read it. Only hits are cached.
+        """
+        rk = self._read_key(cls, constraints)
+        keys = self._reads.get(rk)
+        if keys is not None:
+            return self._models[(cls, keys[0])]
+
+        model = loader()
+        if model is None:
+            return None
+
+        model = self._add(model)
+        self._reads[rk] = [self._primary_key(model)]
+        return model
+
+    def invalidate(self, cls):
+        "Drop every cached read for a model class."
+        for rk in [rk for rk in self._reads if rk[0] is cls]:
+            del self._reads[rk]
+
+    def saved(self, model):
+        "Record that a model was written."
+        cls = model.__class__
+        self.invalidate(cls)
+        self._models[(cls, self._primary_key(model))] = model
+
+    def deleted(self, cls, constraints=None):
+        """
+        Record that models of a class were deleted. Without constraints, all
+        of them are dropped from the identity map.
+        """
+        self.invalidate(cls)
+        for k, model in list(self._models.items()):
+            if k[0] is not cls:
+                continue
+            if constraints is None or all(
+                    model.get(f) == v for f, v in constraints.items()):
+                del self._models[k]
+
+    def clear(self):
+        self._models.clear()
+        self._reads.clear()
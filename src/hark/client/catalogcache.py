@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+import time
+
+
+def _max_age(headers):
+    """
+    Return how many seconds a response may be used for without revalidating
+    it, from its Cache-Control header, or None if it mustn't be stored.
+    """
+    directives = {}
+    for d in headers.get('Cache-Control', '').split(','):
+        k, _, v = d.strip().partition('=')
+        directives[k.lower()] = v.strip('"')
+
+    if 'no-store' in directives:
+        return None
+    if 'no-cache' in directives:
+        return 0
+    try:
+        return max(0, int(directives.get('max-age', 0)))
+    except ValueError:
+        return 0
+
+
+class CatalogCache(object):
+    """
+    An on-disk cache of JSON responses from the imagestore.
+
+    Each response is kept in its own file, with its ETag and the time until
+    which its Cache-Control max-age says it is fresh. Fresh responses can be
+    used without a request; stale ones are revalidated with If-None-Match.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _entry_path(self, url):
+        h = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, h + '.json')
+
+    def get(self, url):
+        """
+        Return the cached entry for a URL: a dictionary with its 'body',
+        'etag' and 'expires', or None.
+        """
+        try:
+            with open(self._entry_path(url), 'r') as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if entry.get('url') != url:
+            return None
+        return entry
+
+    def fresh(self, entry):
+        "Whether an entry can be used without revalidating it"
+        return entry is not None and time.time() < entry['expires']
+
+    def put(self, url, body, headers, etag=None):
+        """
+        Cache a response body with its headers, unless they forbid it.
+        Returns the entry, or None if it wasn't stored.
+        """
+        max_age = _max_age(headers)
+        if max_age is None:
+            return None
+
+        entry = {
+            'url': url,
+            'body': body,
+            'etag': headers.get('ETag', etag),
+            'expires': time.time() + max_age,
+        }
+
+        os.makedirs(self.path, exist_ok=True)
+        p = self._entry_path(url)
+        tmp = p + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp, p)
+        return entry
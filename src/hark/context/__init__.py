@@ -7,7 +7,7 @@ import hark.networking
 
 
 class Context(object):
-    def __init__(self, path):
+    def __init__(self, path, image_quota=None):
         from hark.context.imagecache import ImageCache
 
         self.path = path
@@ -18,7 +18,7 @@ class Context(object):
         self.dal = hark.dal.DAL(dbpath)
 
         imagedir = os.path.join(path, 'images')
-        self._image_cache = ImageCache(imagedir)
+        self._image_cache = ImageCache(imagedir, quota=image_quota)
 
         self._network = hark.networking.Network()
 
@@ -26,10 +26,18 @@ class Context(object):
         return os.path.join(self.path, 'hark.log')
 
     @classmethod
-    def home(cls):
+    def home(cls, image_quota=None):
         home = os.path.expanduser("~")
         path = os.path.join(home, ".hark")
-        return cls(path)
+        return cls(path, image_quota=image_quota)
+
+    def machines_dir(self):
+        "The directory for drivers' per-machine files"
+        return os.path.join(self.path, 'machines')
+
+    def cache_dir(self):
+        "The directory for caches of remote data, e.g. the image catalog"
+        return os.path.join(self.path, 'cache')
 
     def image_cache(self):
         return self._image_cache
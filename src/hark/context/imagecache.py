@@ -1,38 +1,394 @@
+import json
 import os
-import shutil
+import time
 
+import hark.exceptions
+import hark.lib.fastcopy
 import hark.log as log
 from hark.models.image import Image
+from hark.util.imageindex import ImageIndex
+
+
+# How close to the time of a scan a directory mtime has to be for us not to
+# trust it. A file added in the same filesystem timestamp tick as a scan
+# wouldn't change the directory mtime we recorded, so we rescan next time.
+_RACY_MTIME_NS = 2 * 10 ** 9
+
+_MANIFEST_VERSION = 1
+
+# The suffix of an image file which is still being written, and of the file
+# recording the state of its download.
+PARTIAL_SUFFIX = '.partial'
+PARTIAL_STATE_SUFFIX = PARTIAL_SUFFIX + '.json'
+
+
+def _allocated(st):
+    "The bytes of disk a file uses, which for a sparse file is under its size"
+    blocks = getattr(st, 'st_blocks', None)
+    if blocks is None:
+        return st.st_size
+    return blocks * 512
+
+
+def _entry_allocated(entry):
+    # manifests written before allocated was recorded only have the size
+    return entry.get('allocated', entry['size'])
+
+
+def _image_key(image):
+    return (image['driver'], image['guest'], image['version'])
 
 
 class ImageCache(object):
-    "A local cache of image files."
+    """
+    A local cache of image files.
+
+    The cache keeps an index of its images - their identity, size, mtime and
+    checksum - in a JSON manifest next to the image directory. The index is
+    only rebuilt from the directory listing when the directory's mtime
+    changes, so looking up an image is a dictionary hit.
 
-    def __init__(self, path):
+    The manifest also records when each image was last used to create a
+    machine, how many times, and by which machines, so that gc() can evict
+    old versions nobody needs to keep the cache under a byte quota.
+    """
+
+    def __init__(self, path, manifest_path=None, quota=None):
         self.path = path
+        if manifest_path is None:
+            manifest_path = path.rstrip(os.sep) + '.json'
+        self.manifest_path = manifest_path
+        self.quota = quota
+
         if not os.path.exists(path):
             log.info("Creating hark image dir: %s", path)
             self._initialize()
 
+        # file name -> entry dict
+        self._entries = None
+        # (driver, guest, version) -> file name
+        self._files = {}
+        self._index = ImageIndex()
+        # the mtime of the image dir when the entries were last checked
+        self._dir_mtime_ns = None
+
     def _initialize(self):
         os.mkdir(self.path)
 
-    def images(self):
-        "The list of cached images, sorted by ascending version"
-        os.listdir(self.path)
-        im = []
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if manifest.get('version') != _MANIFEST_VERSION:
+            return
+        self._set_entries(manifest['images'])
+        self._dir_mtime_ns = manifest['dir_mtime_ns']
+
+    def _save_manifest(self):
+        manifest = {
+            'version': _MANIFEST_VERSION,
+            'dir_mtime_ns': self._dir_mtime_ns,
+            'images': self._entries,
+        }
+        tmp = self.manifest_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.manifest_path)
+
+    def _set_entries(self, entries):
+        self._entries = entries
+        self._files = {}
+        self._index = ImageIndex()
+        for f, e in entries.items():
+            self._files[(e['driver'], e['guest'], e['version'])] = f
+            self._index.add(Image(
+                driver=e['driver'], guest=e['guest'], version=e['version']))
+
+    def _checked_dir_mtime(self):
+        """
+        Return the mtime of the image dir, or None if it is too recent to be
+        trusted.
+        """
+        mtime_ns = os.stat(self.path).st_mtime_ns
+        if time.time() * 10 ** 9 - mtime_ns < _RACY_MTIME_NS:
+            return None
+        return mtime_ns
+
+    def _refresh(self):
+        "Make sure the index matches the image dir, rescanning it if needed."
+        if self._entries is None:
+            self._load_manifest()
+
+        mtime_ns = os.stat(self.path).st_mtime_ns
+        if self._entries is not None and mtime_ns == self._dir_mtime_ns:
+            return
+
+        self._scan()
+
+    def _scan(self):
+        log.debug("Scanning image dir: %s", self.path)
+        old = self._entries or {}
+        entries = {}
+
         for f in os.listdir(self.path):
-            im.append(Image.from_file_path(f))
-        return list(sorted(
-            im,
-            key=lambda i: i['version']))
+            if f.endswith((PARTIAL_SUFFIX, PARTIAL_STATE_SUFFIX)):
+                continue
+            try:
+                image = Image.from_file_path(f)
+            except hark.exceptions.InvalidImagePath:
+                log.debug("Ignoring unrecognised file in image dir: %s", f)
+                continue
+
+            st = os.stat(os.path.join(self.path, f))
+            entry = old.get(f)
+            if entry is None or entry['size'] != st.st_size or \
+                    entry['mtime_ns'] != st.st_mtime_ns:
+                entry = self._new_entry(image, st, previous=entry)
+            entries[f] = entry
+
+        self._set_entries(entries)
+        self._dir_mtime_ns = self._checked_dir_mtime()
+        self._save_manifest()
+
+    def _new_entry(self, image, st, sha256=None, previous=None):
+        """
+        Make an index entry for an image file. Usage is carried over from
+        the previous entry for the same file, if there was one.
+        """
+        if previous is None:
+            previous = {}
+        return {
+            'driver': image['driver'],
+            'guest': image['guest'],
+            'version': image['version'],
+            'size': st.st_size,
+            'allocated': _allocated(st),
+            'mtime_ns': st.st_mtime_ns,
+            'sha256': sha256,
+            'last_used': previous.get('last_used'),
+            'use_count': previous.get('use_count', 0),
+            'machines': previous.get('machines', []),
+        }
+
+    def images(self):
+        "The list of cached images, sorted by driver, guest and version"
+        return list(self.index())
+
+    def index(self):
+        "An ImageIndex of the cached images"
+        self._refresh()
+        return self._index
+
+    def has(self, image):
+        "Whether an image is in the cache"
+        self._refresh()
+        return _image_key(image) in self._files
+
+    def entry(self, image):
+        """
+        Return the index entry for an image: a dictionary with its size, the
+        bytes of disk it uses as allocated, mtime_ns and sha256, which is
+        None if it has not been computed.
+
+        Raises ImageNotFound if it is not in the cache.
+        """
+        self._refresh()
+        f = self._files.get(_image_key(image))
+        if f is None:
+            raise hark.exceptions.ImageNotFound(image.file_path())
+        return self._entries[f]
+
+    def checksum(self, image):
+        "Return the SHA-256 hex digest of an image, computing it if needed."
+        import hashlib
+        entry = self.entry(image)
+        if entry['sha256'] is None:
+            h = hashlib.sha256()
+            with open(self.full_image_path(image), 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    h.update(chunk)
+            entry['sha256'] = h.hexdigest()
+            self._save_manifest()
+        return entry['sha256']
+
+    def register(self, image, sha256=None):
+        """
+        Record an image which has just been written to its path in the cache.
+        """
+        self._refresh()
+        f = image.file_path()
+        st = os.stat(os.path.join(self.path, f))
+        self._entries[f] = self._new_entry(
+            image, st, sha256=sha256, previous=self._entries.get(f))
+        self._files[_image_key(image)] = f
+        self._index.add(image)
+        self._dir_mtime_ns = self._checked_dir_mtime()
+        self._save_manifest()
+
+    def touch(self, image, machine_id=None):
+        """
+        Record that an image was used, optionally to create the machine with
+        this ID.
+        """
+        entry = self.entry(image)
+        entry['last_used'] = time.time()
+        entry['use_count'] = entry.get('use_count', 0) + 1
+        machines = entry.setdefault('machines', [])
+        if machine_id is not None and machine_id not in machines:
+            machines.append(machine_id)
+        self._save_manifest()
+
+    def size(self):
+        "The total size in bytes of the cached images"
+        self._refresh()
+        return sum(e['size'] for e in self._entries.values())
+
+    def allocated(self):
+        """
+        The total bytes of disk the cached images use, which is less than
+        their size when they are sparse.
+        """
+        self._refresh()
+        return sum(_entry_allocated(e) for e in self._entries.values())
+
+    def remove(self, image):
+        "Remove an image from the cache"
+        entry = self.entry(image)
+        f = image.file_path()
+        log.info("Removing cached image: %s", f)
+        os.remove(os.path.join(self.path, f))
+        del self._entries[f]
+        del self._files[_image_key(image)]
+        self._index.remove(image)
+        self._dir_mtime_ns = self._checked_dir_mtime()
+        self._save_manifest()
+        return entry
+
+    def evictable(self, machines, pinned=()):
+        """
+        Return the images which can be evicted, least recently used first:
+        those which aren't the latest version for their driver and guest,
+        weren't used to create any of these machines, and whose paths aren't
+        pinned.
+
+        A machine with no usage recorded against any image - one created
+        before usage was recorded, or after the manifest was lost - may be
+        using any version of its driver and guest, so all of them are kept.
+        """
+        self._refresh()
+        recorded = set()
+        for e in self._entries.values():
+            recorded.update(e.get('machines', []))
+
+        machine_ids = set()
+        unrecorded = set()
+        for m in machines:
+            machine_ids.add(m['machine_id'])
+            if m['machine_id'] not in recorded:
+                unrecorded.add((m['driver'], m['guest']))
+
+        pinned = set(pinned)
+        candidates = []
+
+        for f, e in self._entries.items():
+            if os.path.join(self.path, f) in pinned:
+                continue
+            if (e['driver'], e['guest']) in unrecorded:
+                continue
+            image = Image(driver=e['driver'], guest=e['guest'],
+                          version=e['version'])
+            latest = self._index.latest(e['driver'], e['guest'])
+            if latest['version'] == e['version']:
+                continue
+            if machine_ids.intersection(e.get('machines', [])):
+                continue
+            candidates.append(
+                ((e.get('last_used') or 0, e.get('use_count', 0)), image))
+
+        return [image for _, image in sorted(
+            candidates, key=lambda c: c[0])]
+
+    def gc(self, machines, quota=None, dry_run=False, pinned=()):
+        """
+        Evict images until the disk the cache uses fits within quota bytes,
+        least recently used first. Only images returned by evictable() for
+        these machines are removed. If no quota is given, the cache's own
+        quota is used; if it has none, every evictable image is removed.
+
+        Returns the list of evicted images.
+        """
+        if quota is None:
+            quota = self.quota
+
+        used = self.allocated()
+        evicted = []
+
+        for image in self.evictable(machines, pinned=pinned):
+            if quota is not None and used <= quota:
+                break
+            entry = self.entry(image)
+            if not dry_run:
+                self.remove(image)
+            used -= _entry_allocated(entry)
+            evicted.append(image)
+
+        if quota is not None and used > quota:
+            log.info(
+                "Image cache uses %d bytes, over its quota of %d bytes, but "
+                "no more images can be evicted", used, quota)
+
+        return evicted
 
     def full_image_path(self, image):
         return os.path.join(self.path, image.file_path())
 
-    def saveFromFile(self, image, source):
+    def partial_path(self, image):
+        """
+        The path an image is written to before it is complete. Files at this
+        path are never reported as cached images.
+        """
+        return self.full_image_path(image) + PARTIAL_SUFFIX
+
+    def partial_state_path(self, image):
+        "The path of the file recording the state of a partial download"
+        return self.full_image_path(image) + PARTIAL_STATE_SUFFIX
+
+    def has_partial(self, image):
+        "Whether there is a partial download of an image to resume"
+        return os.path.exists(self.partial_path(image))
+
+    def commit_partial(self, image, sha256=None):
+        """
+        Atomically move a completed image from its partial path into the
+        cache, and record it with its checksum.
+        """
+        os.replace(self.partial_path(image), self.full_image_path(image))
+        self._remove_if_exists(self.partial_state_path(image))
+        self.register(image, sha256=sha256)
+
+    def discard_partial(self, image):
+        "Remove a partial download of an image"
+        self._remove_if_exists(self.partial_path(image))
+        self._remove_if_exists(self.partial_state_path(image))
+
+    def _remove_if_exists(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def saveFromFile(self, image, source, mode=hark.lib.fastcopy.COPY):
+        """
+        Import an image from a local file. mode is one of 'copy', 'link' or
+        'move'; see hark.lib.fastcopy.copyFile. Returns a CopyResult.
+        """
         dest = self.full_image_path(image)
         log.info(
-            "Copying local file %s to destination image %s",
-            source, dest)
-        shutil.copy(source, dest)
+            "Importing local file %s to destination image %s (%s)",
+            source, dest, mode)
+        res = hark.lib.fastcopy.copyFile(source, dest, mode=mode)
+        log.info("Imported image %s with %s", dest, res)
+        self.register(image)
+        return res
@@ -1,13 +1,30 @@
+import contextlib
+import functools
 import os
+import re
 import sqlite3
 
 from hark.exceptions import (
+    InvalidDALOption,
     InvalidQueryConstraint,
-    DuplicateModelException
+    DuplicateModelException,
+    UnsupportedSchemaVersion,
 )
 import hark.log
 
 
+# Valid values for PRAGMA synchronous. NORMAL is safe in WAL mode: a commit
+# can only be lost on power failure, and the database is never corrupted.
+SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+DEFAULT_SYNCHRONOUS = 'NORMAL'
+
+# How many distinct SQL statements to keep. Generated SQL text depends only on
+# the model class and the constrained fields, so this bounds both our cache of
+# query text and sqlite3's cache of prepared statements.
+QUERY_CACHE_SIZE = 128
+
+
 def hark_schema():
     schemaFile = 'schema.sql'
     dir = os.path.dirname(__file__)
@@ -16,74 +33,251 @@ def hark_schema():
         return f.read()
 
 
+_migrationFileMatch = r'^(\d+)_(\w+)\.sql$'
+
+
+def hark_migrations():
+    """
+    Return the list of schema migrations as (version, name, sql) tuples,
+    sorted by version.
+
+    Version 1 is the original schema in schema.sql. Later versions are read
+    from the migrations directory, where each file is named
+    <version>_<name>.sql. The schema version of a database is tracked with
+    PRAGMA user_version.
+    """
+    migrations = [(1, 'schema', hark_schema())]
+
+    dir = os.path.join(os.path.dirname(__file__), 'migrations')
+    for f in os.listdir(dir):
+        matches = re.findall(_migrationFileMatch, f)
+        if len(matches) != 1:
+            continue
+        version, name = matches[0]
+        with open(os.path.join(dir, f), 'r') as fh:
+            migrations.append((int(version), name, fh.read()))
+
+    return list(sorted(migrations))
+
+
+def _where_clause(keys):
+    "Format the WHERE clause for a tuple of (field, is_null) pairs"
+    if not keys:
+        return ''
+    formatted = [
+        "%s IS NULL" % k if is_null else "%s = ?" % k
+        for k, is_null in keys
+    ]
+    return ' WHERE ' + " AND ".join(formatted)
+
+
+def _order_by_clause(order):
+    "Format the ORDER BY clause for a tuple of (field, descending) pairs"
+    if not order:
+        return ''
+    formatted = [
+        "%s DESC" % k if desc else "%s ASC" % k
+        for k, desc in order
+    ]
+    return ' ORDER BY ' + ", ".join(formatted)
+
+
+@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _select_sql(cls, keys, order=(), limit=False):
+    return "SELECT %s FROM %s%s%s%s;" % (
+        ", ".join(cls.fields), cls.table,
+        _where_clause(keys),
+        _order_by_clause(order),
+        ' LIMIT ?' if limit else '')
+
+
+@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _insert_sql(cls):
+    return "INSERT INTO %s (%s) VALUES (%s);" % (
+        cls.table,
+        ", ".join(cls.fields),
+        ", ".join("?" for _ in cls.fields))
+
+
+@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _delete_sql(cls, keys):
+    return "DELETE FROM %s%s;" % (cls.table, _where_clause(keys))
+
+
+def _group_by(items, keyfunc):
+    """
+    Group consecutive items which share the same key. Returns a list of
+    (key, items) tuples.
+    """
+    groups = []
+    for item in items:
+        k = keyfunc(item)
+        if groups and groups[-1][0] == k:
+            groups[-1][1].append(item)
+        else:
+            groups.append((k, [item]))
+    return groups
+
+
 class DAL(object):
     """
     An sqlite3 database connection which is capable of mapping rows to
     model instances and vice versa.
     """
 
-    def __init__(self, path):
+    def __init__(self, path, synchronous=DEFAULT_SYNCHRONOUS):
+        synchronous = synchronous.upper()
+        if synchronous not in SYNCHRONOUS_LEVELS:
+            raise InvalidDALOption(
+                "synchronous must be one of %s, not '%s'" % (
+                    ", ".join(SYNCHRONOUS_LEVELS), synchronous))
+
         self.path = path
+        self.synchronous = synchronous
+
+        # The depth of nested transaction() blocks. Commits are deferred
+        # until the outermost block exits.
+        self._transaction_depth = 0
+
         self._connect()
 
     def _connect(self):
-        if os.path.exists(self.path):
-            initialized = True
-        else:
-            initialized = False
+        # Transactions are begun and ended by transaction(), not by sqlite3:
+        # before Python 3.6 it commits on its own ahead of statements such as
+        # SAVEPOINT, ending the transaction they are part of.
+        self._db = sqlite3.connect(
+            self.path, cached_statements=QUERY_CACHE_SIZE,
+            isolation_level=None)
+        self._tune()
+        self._setup()
+
+    def _tune(self):
+        """
+        Put the connection in WAL mode and set the synchronous level.
 
-        self._db = sqlite3.connect(self.path)
+        In WAL mode a commit appends to the write-ahead log rather than
+        rewriting the database file, so with synchronous=NORMAL most commits
+        don't need an fsync at all.
+        """
+        self._db.execute("PRAGMA journal_mode = WAL;")
+        self._db.execute("PRAGMA synchronous = %s;" % self.synchronous)
 
-        if not initialized:
-            self._setup()
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        A context manager which groups every write made inside it into a
+        single transaction. A write outside any block is committed by itself.
+
+        The transaction is committed when the outermost block exits normally
+        and rolled back if it raises, or if the commit fails. Blocks can be
+        nested; inner blocks just join the outer transaction.
+        """
+        if self._transaction_depth == 0:
+            self._db.execute("BEGIN;")
+        self._transaction_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                self._rollback()
+            raise
+        else:
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                try:
+                    self._db.execute("COMMIT;")
+                except BaseException:
+                    self._rollback()
+                    raise
+
+    def _rollback(self):
+        # sqlite may already have rolled back after some errors
+        if self._db.in_transaction:
+            self._db.execute("ROLLBACK;")
+
+    @contextlib.contextmanager
+    def savepoint(self):
+        """
+        A context manager for a block of writes which is undone if it raises,
+        without rolling back the rest of the enclosing transaction() block.
+        """
+        with self.transaction():
+            self._db.execute("SAVEPOINT hark_savepoint;")
+            try:
+                yield self
+            except BaseException:
+                self._db.execute("ROLLBACK TO hark_savepoint;")
+                self._db.execute("RELEASE hark_savepoint;")
+                raise
+            else:
+                self._db.execute("RELEASE hark_savepoint;")
 
     def _format_constraints(self, constraints):
-        formatted = []
+        """
+        Split a constraints dictionary into a hashable description of the
+        WHERE clause and the list of values to bind to its placeholders.
+
+        The description is a tuple of (field, is_null) pairs: it depends only
+        on which fields are constrained, not on their values, so it can be
+        used to cache the generated SQL.
+        """
+        keys = []
+        bindings = []
 
         for k, v in constraints.items():
-            if isinstance(v, int):
-                s = "%s = %d" % (k, v)
-                formatted.append(s)
-            elif isinstance(v, str):
-                s = "%s = '%s'" % (k, v)
-                formatted.append(s)
-            elif v is None:
-                s = "%s is null" % k
-                formatted.append(s)
+            if v is None:
+                keys.append((k, True))
+            elif isinstance(v, (int, str)):
+                keys.append((k, False))
+                bindings.append(v)
             else:
                 raise InvalidQueryConstraint("Unsupported value: %s" % v)
 
-        return formatted
+        return tuple(keys), bindings
 
-    def _read_query(self, cls, constraints=None):
-        tmpl = "SELECT %s FROM %s%s;"
-        fields = ", ".join(cls.fields)
-        if constraints is not None and len(constraints) > 0:
-            formatted = self._format_constraints(constraints)
-            cons_str = ' WHERE ' + " AND ".join(formatted)
+    def _format_order_by(self, cls, order_by):
+        """
+        Given a field name or list of field names, return a tuple of
+        (field, descending) pairs. A field name prefixed with '-' is sorted in
+        descending order.
+        """
+        if isinstance(order_by, str):
+            order_by = [order_by]
+
+        order = []
+        for k in order_by:
+            desc = k.startswith('-')
+            if desc:
+                k = k[1:]
+            if k not in cls.fields:
+                raise InvalidQueryConstraint(
+                    "Cannot order %s by unknown field: %s" % (
+                        cls.__name__, k))
+            order.append((k, desc))
+
+        return tuple(order)
+
+    def _read_query(self, cls, constraints=None, order_by=None, limit=None):
+        if constraints:
+            keys, bindings = self._format_constraints(constraints)
         else:
-            cons_str = ''
+            keys, bindings = (), []
 
-        return tmpl % (fields, cls.table, cons_str)
-
-    def _insert_query(self, model):
-        tmpl = "INSERT INTO {} ({}) VALUES ({});"
+        if order_by:
+            order = self._format_order_by(cls, order_by)
+        else:
+            order = ()
 
-        fields = []
-        bindings = []
-        placeholders = []
+        if limit is not None:
+            bindings.append(limit)
 
-        for k in model.fields:
-            fields.append(k)
-            bindings.append(model[k])
-            placeholders.append("?")
+        qr = _select_sql(cls, keys, order, limit is not None)
+        return qr, bindings
 
-        query = tmpl.format(
-            model.table,
-            ", ".join(fields),
-            ", ".join(placeholders),
-        )
-        return (query, bindings)
+    def _insert_query(self, model):
+        bindings = [model[k] for k in model.fields]
+        return _insert_sql(model.__class__), bindings
 
     def _delete_query(self, ins):
         constraints = self._key_constraints(ins)
@@ -91,12 +285,12 @@ class DAL(object):
         return self._delete_where_query(ins.__class__, constraints)
 
     def _delete_where_query(self, cls, constraints):
-        tmpl = "DELETE FROM %s WHERE %s;"
-
-        formatted = self._format_constraints(constraints)
-        cons_str = " AND ".join(formatted)
+        if not constraints:
+            raise InvalidQueryConstraint(
+                "Refusing to delete from %s without constraints" % cls.table)
+        keys, bindings = self._format_constraints(constraints)
 
-        return tmpl % (cls.table, cons_str)
+        return _delete_sql(cls, keys), bindings
 
     def _key_constraints(self, ins):
         """
@@ -110,48 +304,167 @@ class DAL(object):
 
         return {k: ins[k] for k in keys}
 
+    def schema_version(self):
+        "Return the schema version of the database."
+        version = self._db.execute("PRAGMA user_version;").fetchone()[0]
+        if version == 0:
+            # Databases created before migrations were introduced have the
+            # original schema but no version recorded.
+            qr = "SELECT name FROM sqlite_master " \
+                "WHERE type = 'table' AND name = 'machine';"
+            if self._db.execute(qr).fetchone() is not None:
+                return 1
+        return version
+
     def _setup(self):
-        "Set up the schema"
-        hark.log.info("Setting up DB schema: %s", self.path)
-        self._db.executescript(hark_schema())
-        self._db.commit()
+        "Set up the schema, or migrate it to the latest version"
+        migrations = hark_migrations()
+        latest = migrations[-1][0]
+        current = self.schema_version()
+
+        if current > latest:
+            raise UnsupportedSchemaVersion(self.path, current, latest)
+
+        if current == 0:
+            hark.log.info("Setting up DB schema: %s", self.path)
+
+        for version, name, sql in migrations:
+            if version <= current:
+                continue
+            if current > 0:
+                hark.log.info(
+                    "Migrating DB schema to version %d (%s): %s",
+                    version, name, self.path)
+            self._migrate(version, sql)
+
+    def _migrate(self, version, sql):
+        "Apply a single migration and record its version atomically"
+        script = "BEGIN;\n%s\nPRAGMA user_version = %d;\nCOMMIT;" % (
+            sql, version)
+        try:
+            self._db.executescript(script)
+        except sqlite3.Error:
+            self._rollback()
+            raise
 
     def create(self, ins):
-        "Insert a model instance"
+        "Validate and insert a model instance"
+        ins.validate()
         query, bindings = self._insert_query(ins)
         try:
             self._db.execute(query, bindings)
-            self._db.commit()
-        except sqlite3.IntegrityError as e:
+        except sqlite3.IntegrityError:
             raise DuplicateModelException(ins)
 
-    def read(self, cls, constraints=None):
+    def create_many(self, models):
         """
-        Given a class and a set of constraints that should uniquely
-        identify a row in the database, create an instance of this
-        class.
+        Validate and insert a sequence of model instances in a single
+        transaction.
+
+        Consecutive instances of the same class are inserted with one
+        executemany() call. If any insert fails, none are saved.
         """
-        qr = self._read_query(cls, constraints=constraints)
-        cur = self._db.execute(qr)
+        # models may be a generator, and is iterated more than once
+        models = list(models)
+        for m in models:
+            m.validate()
+
+        with self.transaction():
+            for cls, group in _group_by(models, lambda m: m.__class__):
+                query = _insert_sql(cls)
+                inserting = [None]
+
+                def bindings(cls=cls, group=group):
+                    # executemany() runs each insert as it takes its row,
+                    # so the model being inserted is the one which fails.
+                    for m in group:
+                        inserting[0] = m
+                        yield [m[k] for k in cls.fields]
+
+                try:
+                    self._db.executemany(query, bindings())
+                except sqlite3.IntegrityError as e:
+                    raise DuplicateModelException(inserting[0], e)
+
+    def iter(
+            self, cls, constraints=None, order_by=None, limit=None,
+            validate=False):
+        """
+        Given a class and a set of constraints, lazily yield an instance of
+        this class for each matching row as the cursor advances.
 
-        return [cls.from_sql_row(row) for row in cur]
+        order_by is a field name or list of field names; prefix a name with
+        '-' to sort descending. limit caps the number of rows read.
+
+        Models are validated when they are written, so rows read back are
+        trusted and not validated again unless validate is True.
+        """
+        qr, bindings = self._read_query(
+            cls, constraints=constraints, order_by=order_by, limit=limit)
+        cur = self._db.cursor()
+        cur.row_factory = cls.row_factory()
+        cur.execute(qr, bindings)
+
+        if not validate:
+            yield from cur
+            return
+
+        for ins in cur:
+            ins.validate()
+            yield ins
+
+    def read(
+            self, cls, constraints=None, order_by=None, limit=None,
+            validate=False):
+        """
+        Given a class and a set of constraints, return a list of instances of
+        this class for every matching row.
+        """
+        return list(self.iter(
+            cls, constraints=constraints, order_by=order_by, limit=limit,
+            validate=validate))
+
+    def read_one(self, cls, constraints=None, order_by=None, validate=False):
+        """
+        Given a class and a set of constraints, return an instance of this
+        class for the first matching row, or None if there is none.
+        """
+        for ins in self.iter(
+                cls, constraints=constraints, order_by=order_by, limit=1,
+                validate=validate):
+            return ins
+        return None
 
     def delete(self, ins):
         """
         Delete an instance of a model from the DB.
         """
-        qr = self._delete_query(ins)
-        self._db.execute(qr)
-        self._db.commit()
+        qr, bindings = self._delete_query(ins)
+        self._db.execute(qr, bindings)
+
+    def delete_many(self, models):
+        """
+        Delete a sequence of model instances, identified by their keys, in a
+        single transaction.
+        """
+        deletes = []
+        for m in models:
+            keys, bindings = self._format_constraints(
+                self._key_constraints(m))
+            deletes.append(((m.__class__, keys), bindings))
+
+        with self.transaction():
+            for (cls, keys), group in _group_by(deletes, lambda d: d[0]):
+                bindings = [b for _, b in group]
+                self._db.executemany(_delete_sql(cls, keys), bindings)
 
     def deleteWhere(self, cls, constraints):
         """
         Given a class and a set of constraints, delete rows from the table
         associated with this class.
         """
-        qr = self._delete_where_query(cls, constraints)
-        self._db.execute(qr)
-        self._db.commit()
+        qr, bindings = self._delete_where_query(cls, constraints)
+        self._db.execute(qr, bindings)
 
 
 class InMemoryDAL(DAL):
@@ -0,0 +1,184 @@
+import asyncio
+import concurrent.futures
+import queue
+import threading
+
+from hark.dal import DAL
+import hark.log
+
+
+_READS = ('read', 'read_one')
+
+# Put on the request queue to stop the worker thread.
+_STOP = object()
+
+
+def _freeze(v):
+    "Make a hashable version of a read's arguments, for coalescing reads."
+    if isinstance(v, dict):
+        return tuple(sorted((k, _freeze(x)) for k, x in v.items()))
+    if isinstance(v, (list, tuple)):
+        return tuple(_freeze(x) for x in v)
+    return v
+
+
+class _Request(object):
+    def __init__(self, method, args, kwargs):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.future = concurrent.futures.Future()
+
+    def is_read(self):
+        return self.method in _READS
+
+    def coalesce_key(self):
+        try:
+            k = (self.method, _freeze(self.args), _freeze(self.kwargs))
+            hash(k)
+            return k
+        except TypeError:
+            return None
+
+
+class AsyncDAL(object):
+    """
+    An asyncio facade over DAL, for use from an event loop.
+
+    All database work happens on one dedicated thread, which owns the sqlite3
+    connection. Requests go onto a queue; whenever the thread wakes it takes
+    every queued request and runs them in order inside one transaction, so
+    concurrent writes share a single commit. Identical reads in the same batch
+    with no write between them are only run once.
+
+    Each write runs in its own savepoint, so a failed write (for example a
+    DuplicateModelException) only fails its own future.
+
+    The methods take the same arguments as their DAL counterparts and return
+    asyncio futures.
+    """
+
+    def __init__(self, path, loop=None, dal_class=DAL, **kwargs):
+        self.path = path
+        self._loop = loop
+        self._queue = queue.Queue()
+
+        ready = concurrent.futures.Future()
+        self._thread = threading.Thread(
+            target=self._run, args=(ready, dal_class, kwargs),
+            name='hark-dal', daemon=True)
+        self._thread.start()
+        # raise any error from connecting
+        ready.result()
+
+    def create(self, ins):
+        return self._submit('create', (ins,), {})
+
+    def create_many(self, models):
+        return self._submit('create_many', (models,), {})
+
+    def read(self, cls, *args, **kwargs):
+        return self._submit('read', (cls,) + args, kwargs)
+
+    def read_one(self, cls, *args, **kwargs):
+        return self._submit('read_one', (cls,) + args, kwargs)
+
+    def delete(self, ins):
+        return self._submit('delete', (ins,), {})
+
+    def delete_many(self, models):
+        return self._submit('delete_many', (models,), {})
+
+    def deleteWhere(self, cls, constraints):
+        return self._submit('deleteWhere', (cls, constraints), {})
+
+    def _submit(self, method, args, kwargs):
+        if not self._thread.is_alive():
+            raise RuntimeError('AsyncDAL is closed')
+        req = _Request(method, args, kwargs)
+        self._queue.put(req)
+        return asyncio.wrap_future(req.future, loop=self._loop)
+
+    def close(self):
+        "Finish every queued request, then close the database connection."
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def _run(self, ready, dal_class, kwargs):
+        try:
+            dal = dal_class(self.path, **kwargs)
+        except Exception as e:
+            ready.set_exception(e)
+            return
+        ready.set_result(None)
+
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if _STOP in batch:
+                stopping = True
+                batch = [r for r in batch if r is not _STOP]
+
+            if batch:
+                self._run_batch(dal, batch)
+
+        dal._db.close()
+
+    def _run_batch(self, dal, batch):
+        hark.log.debug('AsyncDAL: running batch of %d requests', len(batch))
+
+        # results are only delivered once the batch has committed
+        results = []
+        reads = {}
+
+        try:
+            with dal.transaction():
+                for req in batch:
+                    if req.is_read():
+                        results.append((req, self._read(dal, req, reads)))
+                    else:
+                        reads.clear()
+                        results.append((req, self._write(dal, req)))
+        except Exception as e:
+            # the commit failed: none of the writes happened
+            results = [
+                (req, res if req.is_read() else (None, e))
+                for req, res in results
+            ]
+
+        for req, (value, exc) in results:
+            if exc is not None:
+                req.future.set_exception(exc)
+            else:
+                req.future.set_result(value)
+
+    def _read(self, dal, req, reads):
+        key = req.coalesce_key()
+        if key is not None and key in reads:
+            value, exc = reads[key]
+        else:
+            try:
+                value, exc = getattr(dal, req.method)(
+                    *req.args, **req.kwargs), None
+            except Exception as e:
+                value, exc = None, e
+            if key is not None:
+                reads[key] = (value, exc)
+
+        if isinstance(value, list):
+            value = list(value)
+        return value, exc
+
+    def _write(self, dal, req):
+        try:
+            with dal.savepoint():
+                return getattr(dal, req.method)(*req.args, **req.kwargs), None
+        except Exception as e:
+            return None, e
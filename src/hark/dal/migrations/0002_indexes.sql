@@ -0,0 +1,7 @@
+-- LocalClient.portMappings() filters on machine_id, and freePrivateIP()
+-- filters network interfaces on kind.
+CREATE INDEX IF NOT EXISTS port_mapping_machine_id
+	ON port_mapping (machine_id);
+
+CREATE INDEX IF NOT EXISTS network_interface_kind
+	ON network_interface (kind);
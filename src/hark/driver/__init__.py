@@ -7,11 +7,43 @@ def drivers():
     return _drivers
 
 
-def get_driver(name, machine):
+def pinned_images(dal):
+    """
+    Return the paths of base images which drivers keep state for, such as
+    golden VMs for linked clones, and so must stay in the image cache.
+    """
+    from .virtualbox.golden import golden_images
+    return golden_images(dal)
+
+
+def prune_golden_vms(dal):
+    """
+    Remove the golden VMs which no machine is a linked clone of, so that
+    their images can be evicted. Returns the paths of those images.
+    """
+    from .virtualbox import Driver
+    from .virtualbox.golden import GoldenPool
+    return GoldenPool(Driver, dal).prune()
+
+
+def get_driver(name, machine, state_dir=None):
+    """
+    Return a driver instance for a machine. state_dir is where drivers which
+    keep per-machine files, like qemu, keep them.
+    """
+    cls = driver_class(name)
+    if name == 'qemu':
+        return cls(machine, state_dir=state_dir)
+    return cls(machine)
+
+
+def driver_class(name):
+    "Return the driver class for a driver name"
     import hark.lib.platform
     from hark.exceptions import (
         UnknownDriverException, UnsupportedDriverException
     )
+    from . import qemu
     from . import virtualbox
 
     if name not in _drivers:
@@ -21,4 +53,21 @@ def get_driver(name, machine):
         raise UnsupportedDriverException(hark.lib.platform.platform(), name)
 
     if name == 'virtualbox':
-        return virtualbox.Driver(machine)
+        return virtualbox.Driver
+    elif name == 'qemu':
+        return qemu.Driver
+
+
+def statuses(machines, state_dir=None):
+    """
+    Return a dict of machine name to status for a list of machines, with
+    one bulk query per driver.
+    """
+    byDriver = {}
+    for m in machines:
+        byDriver.setdefault(m['driver'], []).append(m)
+
+    res = {}
+    for name, ms in byDriver.items():
+        res.update(driver_class(name).statuses(ms, state_dir=state_dir))
+    return res
@@ -1,10 +1,23 @@
+import random
 import time
 
+import hark.exceptions
 import hark.guest
 import hark.log
 from hark.lib.command import which, Command
 
 
+# The first and longest sleeps between polls in waitStatus, which backs off
+# exponentially from one to the other. The longest is the one second that
+# waitStatus used to sleep every time, so a change is never noticed later.
+WAIT_INTERVAL_MS = 100
+WAIT_MAX_INTERVAL_MS = 1000
+
+# The longest a driver's event source blocks before the status is polled
+# again, in seconds.
+WAIT_EVENT_SECONDS = 10
+
+
 class BaseDriver(object):
 
     def __init__(self, machine):
@@ -26,6 +39,15 @@ class BaseDriver(object):
         res = cmd.assertRun()
         return res.stdout.strip()
 
+    @classmethod
+    def statuses(cls, machines, state_dir=None):
+        """
+        Return a dict of machine name to status for a list of machines which
+        use this driver. Drivers override this when they can find every
+        machine's status at once, rather than with a status() each.
+        """
+        return {m['name']: cls(m).status() for m in machines}
+
     def assertStatus(self, msg, *valid_statuses):
         """
         Given a machine driver instance, throw hark.exceptions.InvalidStatus
@@ -41,10 +63,60 @@ class BaseDriver(object):
                 "cannot remove a machine unless it's stopped: "
                 "status is '%s' and needs to be one of (%s)" % (s, fmt))
 
-    def waitStatus(self, status, interval_ms=1000):
+    def waitStatus(
+            self, status, timeout=None,
+            interval_ms=WAIT_INTERVAL_MS,
+            max_interval_ms=WAIT_MAX_INTERVAL_MS):
+        """
+        Wait until the machine has the given status.
+
+        Between polls of status(), the driver's event source is used if it
+        has one (see waitChange), and otherwise it sleeps, starting at
+        interval_ms and doubling up to max_interval_ms, with jitter.
+
+        Raises hark.exceptions.WaitTimeout if timeout, in seconds, passes
+        first; with no timeout it waits forever.
+        """
         hark.log.info('Waiting for machine %s status to be %s' % (
             self.machine['name'], status))
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        interval = interval_ms / 1000
         while True:
-            if self.status() == status:
+            current = self.status()
+            if current == status:
                 return
-            time.sleep(interval_ms / 1000)
+
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise hark.exceptions.WaitTimeout(
+                        "machine '%s' status was still '%s' after %ds, "
+                        "waiting for '%s'" % (
+                            self.machine['name'], current, timeout, status))
+
+            wait = WAIT_EVENT_SECONDS
+            if remaining is not None:
+                wait = min(wait, remaining)
+            try:
+                if self.waitChange(current, wait):
+                    continue
+            except (hark.exceptions.CommandFailed, OSError) as e:
+                hark.log.debug('waitStatus: event source failed: %s', e)
+
+            sleep = interval * random.uniform(0.5, 1.0)
+            if remaining is not None:
+                sleep = min(sleep, remaining)
+            time.sleep(sleep)
+            interval = min(interval * 2, max_interval_ms / 1000)
+
+    def waitChange(self, current, timeout):
+        """
+        Block until the machine's status may have changed from current, or
+        for at most timeout seconds, and return True; or return False if the
+        driver has no way to wait for it, so waitStatus should poll.
+        """
+        return False
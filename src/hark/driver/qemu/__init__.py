@@ -0,0 +1,284 @@
+import json
+import os
+import shutil
+
+import hark.exceptions
+from hark.lib.command import Command
+import hark.log as log
+
+from .. import base
+from .. import status
+from .qmp import QMPClient
+
+
+# The formats of base images, by file suffix, for the overlay's backing file.
+_backingFormats = {
+    '.qcow2': 'qcow2',
+    '.vmdk': 'vmdk',
+    '.img': 'raw',
+    '.raw': 'raw',
+}
+
+# QMP run states, from query-status, and the hark status for each.
+_runStates = {
+    'running': status.RUNNING,
+    'paused': status.PAUSED,
+    'suspended': status.PAUSED,
+    'shutdown': status.STOPPED,
+    'guest-panicked': status.ABORTED,
+    'internal-error': status.ABORTED,
+    'io-error': status.ABORTED,
+}
+
+# QMP events which mean the machine's run state has changed.
+_stateEvents = ['SHUTDOWN', 'STOP', 'RESUME', 'SUSPEND', 'WAKEUP', 'RESET']
+
+KVM_DEVICE = '/dev/kvm'
+
+
+def kvmAvailable():
+    "Whether this host can run machines with KVM acceleration"
+    return os.access(KVM_DEVICE, os.R_OK | os.W_OK)
+
+
+def _processExists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # it exists, but isn't ours
+        return True
+    return True
+
+
+def _default_state_dir():
+    return os.path.join(os.path.expanduser('~'), '.hark', 'machines')
+
+
+class Driver(base.BaseDriver):
+    """
+    A driver which runs machines with qemu.
+
+    Each machine has a directory under state_dir holding its disk, a thin
+    qcow2 overlay backed by the cached base image, and its settings. Running
+    machines are controlled over a QMP socket in the same directory. The
+    machine's network is qemu user-mode networking, with its port mappings
+    as host forwards.
+    """
+
+    cmd = 'qemu-system-x86_64'
+    imgCmd = 'qemu-img'
+    versionArg = '--version'
+
+    # seconds to wait for each reply on the QMP socket
+    qmpTimeout = 5.0
+
+    def __init__(self, machine, state_dir=None):
+        base.BaseDriver.__init__(self, machine)
+        if state_dir is None:
+            state_dir = _default_state_dir()
+        self.state_dir = state_dir
+
+    def _run(self, cmd):
+        return Command(list(cmd)).assertRun()
+
+    def _name(self):
+        return self.machine['name']
+
+    def machine_dir(self):
+        return os.path.join(self.state_dir, self._name())
+
+    def _path(self, name):
+        return os.path.join(self.machine_dir(), name)
+
+    def disk_path(self):
+        return self._path('disk.qcow2')
+
+    def qmp_path(self):
+        return self._path('qmp.sock')
+
+    def pid_path(self):
+        return self._path('qemu.pid')
+
+    def _pid(self):
+        "The pid qemu recorded when it started, or None"
+        try:
+            with open(self.pid_path(), 'r') as f:
+                return int(f.read().strip())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _settings_path(self):
+        return self._path('machine.json')
+
+    def _loadSettings(self):
+        with open(self._settings_path(), 'r') as f:
+            return json.load(f)
+
+    def _saveSettings(self, settings):
+        tmp = self._settings_path() + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(settings, f, indent=2, sort_keys=True)
+        os.replace(tmp, self._settings_path())
+
+    def qmp(self):
+        "Return a QMPClient for this machine; use it as a context manager."
+        return QMPClient(self.qmp_path(), timeout=self.qmpTimeout)
+
+    def create(self, baseImagePath, dal, linked_clone=False):
+        """
+        Create the machine's directory and its disk, a qcow2 overlay on the
+        base image, so nothing is copied. Every qemu machine is in effect a
+        linked clone, so linked_clone makes no difference.
+        """
+        log.debug("qemu: Creating machine '%s'", self._name())
+        log.debug("qemu: base image will be '%s'", baseImagePath)
+
+        ext = os.path.splitext(baseImagePath)[1].lower()
+        fmt = _backingFormats.get(ext, 'raw')
+
+        os.makedirs(self.machine_dir())
+        try:
+            self._run([
+                self.imgCmd, 'create', '-f', 'qcow2',
+                '-b', os.path.abspath(baseImagePath), '-F', fmt,
+                self.disk_path(),
+            ])
+            self._saveSettings({
+                'memory_mb': self.machine['memory_mb'],
+                'port_mappings': [],
+            })
+        except BaseException:
+            shutil.rmtree(self.machine_dir())
+            raise
+
+    def _startCommand(self, gui=False):
+        settings = self._loadSettings()
+
+        hostfwd = ''.join(
+            ',hostfwd=tcp:127.0.0.1:%d-:%d' % (pm[0], pm[1])
+            for pm in settings['port_mappings'])
+
+        cmd = [
+            self.cmd,
+            '-name', self._name(),
+            '-m', str(settings['memory_mb']),
+            '-drive', 'file=%s,if=virtio,format=qcow2' % self.disk_path(),
+            '-netdev', 'user,id=net0' + hostfwd,
+            '-device', 'virtio-net-pci,netdev=net0',
+            '-qmp', 'unix:%s,server,nowait' % self.qmp_path(),
+            '-pidfile', self.pid_path(),
+            '-daemonize',
+        ]
+        if kvmAvailable():
+            cmd.extend(['-accel', 'kvm', '-cpu', 'host'])
+        else:
+            log.info("qemu: KVM is not available; machines will be slow")
+            cmd.extend(['-accel', 'tcg'])
+        if gui:
+            cmd.extend(['-display', 'gtk'])
+        else:
+            cmd.extend(['-display', 'none'])
+        return cmd
+
+    def start(self, gui=False):
+        log.debug("qemu: Starting machine '%s'", self._name())
+        self._run(self._startCommand(gui=gui))
+
+    def stop(self):
+        "Ask the guest to power off, like pressing the power button."
+        log.debug("qemu: Stopping machine '%s'", self._name())
+        with self.qmp() as q:
+            q.execute('system_powerdown')
+
+    @classmethod
+    def statuses(cls, machines, state_dir=None):
+        """
+        Return the status of each machine. Each is a query over its QMP
+        socket, without starting a process, or MISSING if the machine has
+        no directory.
+        """
+        return {
+            m['name']: cls(m, state_dir=state_dir).status() for m in machines
+        }
+
+    def status(self):
+        """
+        Return the machine's status, or MISSING if it has no directory.
+
+        If nothing is listening on the QMP socket, or qemu closes it, the
+        machine is stopped - unless the pid qemu recorded is still running,
+        in which case the error is raised, as it is for any other failure to
+        talk to qemu, such as a timeout. A machine which can't be asked must
+        not be taken to be stopped.
+        """
+        if not os.path.isdir(self.machine_dir()):
+            return status.MISSING
+        try:
+            with self.qmp() as q:
+                state = q.execute('query-status')['status']
+        except (FileNotFoundError, ConnectionRefusedError,
+                hark.exceptions.QMPError):
+            pid = self._pid()
+            if pid is not None and _processExists(pid):
+                raise
+            return status.STOPPED
+
+        s = _runStates.get(state)
+        if s is None:
+            raise hark.exceptions.UnrecognisedMachineState(state)
+        return s
+
+    def waitChange(self, current, timeout):
+        """
+        Block on the QMP event stream until the run state changes or qemu
+        exits and closes the socket. A stopped machine has no socket, so
+        waitStatus polls.
+        """
+        if current in (status.STOPPED, status.MISSING):
+            return False
+        try:
+            with self.qmp() as q:
+                # the state may have changed before we connected
+                state = q.execute('query-status')['status']
+                if _runStates.get(state) != current:
+                    return True
+                q.waitEvent(_stateEvents, timeout=timeout)
+        except hark.exceptions.QMPError:
+            # qemu closed the connection as it exited
+            pass
+        return True
+
+    def remove(self):
+        """
+        Remove the machine: its overlay disk and settings. A machine whose
+        directory is already gone is removed already.
+        """
+        self.assertStatus(
+            "cannot remove a machine unless it's stopped",
+            status.STOPPED, status.ABORTED, status.MISSING)
+        try:
+            shutil.rmtree(self.machine_dir())
+        except FileNotFoundError:
+            pass
+
+    def setPortMappings(self, mappings):
+        """
+        Record port mappings, which become host forwards when the machine
+        starts. If it is running they are added straight away too.
+        """
+        settings = self._loadSettings()
+        for pm in mappings:
+            settings['port_mappings'].append(
+                [pm['host_port'], pm['guest_port']])
+        self._saveSettings(settings)
+
+        if self.status() != status.RUNNING:
+            return
+        with self.qmp() as q:
+            for pm in mappings:
+                q.execute(
+                    'human-monitor-command',
+                    **{'command-line': 'hostfwd_add tcp:127.0.0.1:%d-:%d' % (
+                        pm['host_port'], pm['guest_port'])})
@@ -0,0 +1,112 @@
+import json
+import socket
+
+import hark.exceptions
+import hark.log as log
+
+
+class QMPClient(object):
+    """
+    A minimal client for the QEMU Machine Protocol, over a unix socket.
+
+    Commands are sent with execute(). Asynchronous events which arrive while
+    waiting for a command's reply are kept, and can be read or waited for
+    with events() and waitEvent().
+    """
+
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+        self._events = []
+
+    def connect(self):
+        """
+        Connect and negotiate capabilities. Raises OSError if nothing is
+        listening on the socket.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        self._sock = sock
+        self._file = sock.makefile('rb')
+
+        greeting = self._read()
+        if 'QMP' not in greeting:
+            self.close()
+            raise hark.exceptions.QMPError(
+                'unexpected QMP greeting: %s' % greeting)
+        self.execute('qmp_capabilities')
+        return self
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def __enter__(self):
+        return self.connect()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _read(self):
+        line = self._file.readline()
+        if not line:
+            raise hark.exceptions.QMPError(
+                'QMP connection closed: %s' % self.path)
+        return json.loads(line.decode('utf-8'))
+
+    def execute(self, command, **arguments):
+        "Run a QMP command and return its result."
+        msg = {'execute': command}
+        if arguments:
+            msg['arguments'] = arguments
+        log.debug('qmp: %s', msg)
+        self._sock.sendall(json.dumps(msg).encode('utf-8') + b'\n')
+
+        while True:
+            resp = self._read()
+            if 'event' in resp:
+                self._events.append(resp)
+                continue
+            if 'error' in resp:
+                raise hark.exceptions.QMPError(
+                    '%s failed: %s' % (command, resp['error'].get('desc')))
+            return resp.get('return')
+
+    def events(self):
+        "Return and clear the events received so far."
+        events, self._events = self._events, []
+        return events
+
+    def waitEvent(self, names, timeout=None):
+        """
+        Wait for an event with one of these names, and return it. Returns
+        None if the timeout, in seconds, passes first.
+        """
+        for i, e in enumerate(self._events):
+            if e['event'] in names:
+                del self._events[i]
+                return e
+
+        self._sock.settimeout(timeout)
+        try:
+            while True:
+                e = self._read()
+                if e.get('event') in names:
+                    return e
+                if 'event' in e:
+                    self._events.append(e)
+        except socket.timeout:
+            return None
+        finally:
+            self._sock.settimeout(self.timeout)
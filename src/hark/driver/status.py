@@ -11,3 +11,6 @@ STOPPED = status('stopped')
 RUNNING = status('running')
 ABORTED = status('aborted')
 PAUSED = status('paused')
+
+# The machine is in the hark DB, but its driver has no such machine.
+MISSING = status('missing')
@@ -1,69 +1,249 @@
 import re
 
 import hark.exceptions
-from hark.lib.command import Command
+from hark.lib.command import batchCommands, Command
 import hark.log as log
 import hark.models.config
 import hark.networking
 
 from .. import base
 from .. import status
+from .golden import BASE_SNAPSHOT, GoldenPool
 
 
 HOST_ONLY_INTERFACE_CFG_KEY = 'virtualbox_host_only_interface'
 
+# Set by the Guest Additions when they start in the guest.
+GUEST_ADDITIONS_PROPERTY = '/VirtualBox/GuestAdd/Version'
+
+# The statuses for machine states, as named by `VBoxManage showvminfo
+# --machinereadable` and by `VBoxManage list --long vms`.
+_machineStates = {
+    'running': status.RUNNING,
+    'poweroff': status.STOPPED,
+    'aborted': status.ABORTED,
+    'paused': status.PAUSED,
+}
+_longStates = {
+    'running': status.RUNNING,
+    'powered off': status.STOPPED,
+    'aborted': status.ABORTED,
+    'paused': status.PAUSED,
+}
+
+# A line of `VBoxManage list --long vms` giving a machine's state, e.g.
+# "State:      powered off (since 2016-01-01T00:00:00.000000000)"
+_longStateRe = re.compile(r'^State:\s+(.*?)(?: \(since .*\))?$')
+
 
 class Driver(base.BaseDriver):
     cmd = 'VBoxManage'
     versionArg = '-v'
 
-    def _run(self, cmd):
+    # whether the machine has Guest Additions, once waitChange has asked
+    _guestAdditions = None
+
+    @classmethod
+    def _run(cls, cmd):
         # copy the list before mutating it
         cmd = list(cmd)
         # insert the binary name
-        cmd.insert(0, self.cmd)
+        cmd.insert(0, cls.cmd)
         # run it
         return Command(cmd).assertRun()
 
+    def _runBatch(self, cmds):
+        """
+        Run a list of commands, merging consecutive modifyvm commands for the
+        same machine into one invocation; each VBoxManage run has to connect
+        to VBoxSVC, which is slow.
+        """
+        for cmd in batchCommands(cmds, self._batchable):
+            self._run(cmd)
+
+    @staticmethod
+    def _batchable(cmd):
+        # modifyvm takes any number of property flags
+        if cmd[0] == 'modifyvm':
+            return 2
+        return None
+
     def status(self):
         state = self._vmInfo()['VMState']
-        if state == 'running':
-            return status.RUNNING
-        elif state == 'poweroff':
-            return status.STOPPED
-        elif state == 'aborted':
-            return status.ABORTED
-        elif state == 'paused':
-            return status.PAUSED
-        else:
+        try:
+            return _machineStates[state]
+        except KeyError:
             raise hark.exceptions.UnrecognisedMachineState(state)
 
+    def waitChange(self, current, timeout):
+        """
+        While the machine is up and has Guest Additions, block in
+        guestproperty wait, which returns as soon as the guest changes a
+        property. It can't see a change of state which touches no property,
+        such as a power-off from the host, so the wait is capped at
+        WAIT_MAX_INTERVAL_MS: such a change is still noticed within a second,
+        as it was when waitStatus polled every second.
+
+        A stopped machine, or one without the Additions, has nothing to wait
+        on, so waitStatus polls.
+        """
+        if current not in (status.RUNNING, status.PAUSED):
+            return False
+        if not self._hasGuestAdditions():
+            return False
+        timeout = min(timeout, base.WAIT_MAX_INTERVAL_MS / 1000)
+        self._run([
+            'guestproperty', 'wait', self._name(), '*',
+            '--timeout', str(int(timeout * 1000)),
+        ])
+        return True
+
+    def _hasGuestAdditions(self):
+        "Whether the Guest Additions in the machine have reported in"
+        if self._guestAdditions is None:
+            res = self._run([
+                'guestproperty', 'get', self._name(),
+                GUEST_ADDITIONS_PROPERTY,
+            ])
+            self._guestAdditions = res.stdout.startswith('Value:')
+        return self._guestAdditions
+
+    @classmethod
+    def statuses(cls, machines, state_dir=None):
+        """
+        Return the status of every machine from one `list --long vms`,
+        instead of a showvminfo per machine.
+        """
+        states = cls._listStates()
+
+        statuses = {}
+        for m in machines:
+            name = m['name']
+            state = states.get(name)
+            if state is None:
+                statuses[name] = status.MISSING
+            elif state in _longStates:
+                statuses[name] = _longStates[state]
+            else:
+                raise hark.exceptions.UnrecognisedMachineState(state)
+        return statuses
+
+    @classmethod
+    def _listStates(cls):
+        "Return a dict of the name of every machine to its state"
+        res = cls._run(['list', '--long', 'vms'])
+        states = {}
+        name = None
+        for line in res.stdout.splitlines():
+            # Other sections, such as shared folders, have Name: lines too,
+            # but they come after the machine's State: line.
+            if line.startswith('Name:'):
+                name = line[len('Name:'):].strip()
+                continue
+            match = _longStateRe.match(line)
+            if match is not None and name is not None:
+                states[name] = match.group(1)
+                name = None
+        return states
+
     def _vmInfo(self):
-        res = self._run(['showvminfo', self._name(), '--machinereadable'])
+        return self._machineInfo(self._name())
+
+    @classmethod
+    def _machineInfo(cls, name):
+        "Return the showvminfo of a VM, as a dict"
+        res = cls._run(['showvminfo', name, '--machinereadable'])
         vmInfo = {}
         for line in res.stdout.splitlines():
             k, v = line.split("=", 1)
-            vmInfo[k] = v.strip('"')
+            # keys naming storage slots are quoted, e.g. "sata1-0-0"
+            vmInfo[k.strip('"')] = v.strip('"')
         return vmInfo
 
-    def create(self, baseImagePath, dal):
+    def create(self, baseImagePath, dal, linked_clone=False):
         """
         Create a new image.
 
         A DAL instance is needed in case the driver needs to persist some
         global configuration.
+
+        With linked_clone, the machine is cloned from a snapshot of a golden
+        VM for the base image, which is created the first time; see
+        GoldenPool.
         """
         hostonly_interface_name = self.host_only_interface(dal)
 
         log.debug("virtualbox: Creating machine '%s'", self._name())
         log.debug("virtualbox: base image will be '%s'", baseImagePath)
+
+        if linked_clone:
+            golden = self.golden_pool(dal).get(baseImagePath)
+            log.debug(
+                "virtualbox: linked clone of golden VM '%s'", golden)
+            cmds = [self._cloneCommand(golden)]
+            cmds.extend(self._machineCommands(hostonly_interface_name))
+            self._runBatch(cmds)
+            return
+
         cmds = self._createCommands(hostonly_interface_name)
-        for cmd in cmds:
-            self._run(cmd)
-        self._attachStorage(baseImagePath)
+        self._runBatch(cmds)
+        self._attachStorage(self._name(), baseImagePath)
 
-    def _attachStorage(self, baseImagePath):
-        name = self._name()
+    def golden_pool(self, dal):
+        "The pool of golden VMs which linked clones are made from"
+        return GoldenPool(self, dal)
+
+    def _createGolden(self, name, baseImagePath):
+        """
+        Create a golden VM for a base image, with its base snapshot. If any
+        step fails, the partly created VM is removed again.
+        """
+        try:
+            cmds = [['createvm', '--name', name, '--register']]
+            cmds.extend(self._baseCommands(name))
+            self._runBatch(cmds)
+            self._attachStorage(name, baseImagePath)
+            self._run(['snapshot', name, 'take', BASE_SNAPSHOT])
+        except BaseException:
+            self._discardGolden(name)
+            raise
+
+    @classmethod
+    def _goldenInfo(cls, name):
+        "Return the showvminfo of a golden VM, or None if there is no such VM"
+        try:
+            return cls._machineInfo(name)
+        except hark.exceptions.CommandFailed:
+            return None
+
+    @classmethod
+    def _discardGolden(cls, name):
+        """
+        Remove whatever there is of a golden VM, ignoring failures. The base
+        image is detached first so that deleting the VM doesn't delete it.
+        """
+        log.info("virtualbox: removing incomplete golden VM '%s'", name)
+        for cmd in (cls._detachStorageCommand(name),
+                    ['unregistervm', name, '--delete']):
+            try:
+                cls._run(cmd)
+            except hark.exceptions.CommandFailed as e:
+                log.debug("virtualbox: %s", e)
+
+    def _cloneCommand(self, golden):
+        return [
+            'clonevm', golden, '--snapshot', BASE_SNAPSHOT,
+            '--options', 'link', '--name', self._name(), '--register',
+        ]
+
+    @staticmethod
+    def _detachStorageCommand(name):
+        return [
+            'storageattach', name, '--storagectl', 'sata1',
+            '--port', '0', '--device', '0', '--medium', 'none',
+        ]
+
+    def _attachStorage(self, name, baseImagePath):
         self._run([
             'storagectl', name, '--name', 'sata1', '--add', 'sata'
         ])
@@ -125,37 +305,50 @@ class Driver(base.BaseDriver):
         self._run(cmd)
 
     def setPortMappings(self, mappings):
-        for pm in mappings:
-            fpm = pm.format_virtualbox()
-            cmd = self._modifyvm('--natpf1', fpm)
-            self._run(cmd)
+        self._runBatch([
+            self._modifyvm('--natpf1', pm.format_virtualbox())
+            for pm in mappings
+        ])
 
     def _createCommands(self, host_only_interface):
         name = self._name()
+        cmds = [['createvm', '--name', name, '--register']]
+        cmds.extend(self._baseCommands(name))
+        cmds.extend(self._machineCommands(host_only_interface))
+        return cmds
+
+    def _baseCommands(self, name):
+        """
+        The settings which a machine shares with the golden VM it is cloned
+        from.
+        """
         mod = self._modifyvm
-        cmds = (
-            ['createvm', '--name', name, '--register'],
+        return [
+            mod('--ostype', self.guest_config.virtualbox_os_type(), vm=name),
+
+            mod('--acpi', 'on', vm=name),
+            mod('--ioapic', 'on', vm=name),
 
-            mod('--ostype', self.guest_config.virtualbox_os_type()),
+            mod('--nictype1', 'virtio', vm=name),
+            mod('--nictype2', 'virtio', vm=name),
+        ]
 
-            mod('--acpi', 'on'),
-            mod('--ioapic', 'on'),
+    def _machineCommands(self, host_only_interface):
+        "The settings particular to this machine"
+        mod = self._modifyvm
+        return [
             mod('--memory', str(self.machine['memory_mb'])),
 
             mod('--nic1', 'nat'),
             mod(
                 '--nic2', 'hostonly',
                 '--hostonlyadapter2', host_only_interface),
+        ]
 
-            mod('--nictype1', 'virtio'),
-            mod('--nictype2', 'virtio'),
-
-        )
-
-        return cmds
-
-    def _modifyvm(self, prop, *val):
-        c = ['modifyvm', self.machine['name'], prop]
+    def _modifyvm(self, prop, *val, vm=None):
+        if vm is None:
+            vm = self.machine['name']
+        c = ['modifyvm', vm, prop]
         c.extend(val)
         return c
 
@@ -169,10 +362,10 @@ class Driver(base.BaseDriver):
         Return the name of the hark-dedicated host only interface. Create one
         if necessary.
         """
-        interfaceCfg = dal.read(hark.models.config.Config, constraints={
+        interfaceCfg = dal.read_one(hark.models.config.Config, constraints={
             'name': HOST_ONLY_INTERFACE_CFG_KEY
         })
-        if not len(interfaceCfg):
+        if interfaceCfg is None:
             # no host-only interface name is recorded by the config - create
             # one and save it.
             hostonly_interface_name = self._create_host_only_interface()
@@ -182,7 +375,7 @@ class Driver(base.BaseDriver):
             dal.create(model)
             return hostonly_interface_name
         else:
-            return interfaceCfg[0]['value']
+            return interfaceCfg['value']
 
     def _create_host_only_interface(self):
         "Create a host-only interface and return its name"
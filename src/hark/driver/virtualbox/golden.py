@@ -0,0 +1,139 @@
+import hashlib
+import os
+
+import hark.exceptions
+import hark.log as log
+import hark.models.config
+
+
+# Config rows recording the golden VMs are named with this prefix and the
+# path of the base image; their value is the name of the VM.
+GOLDEN_VM_CFG_PREFIX = 'virtualbox_golden_vm:'
+
+# The snapshot of each golden VM which machines are cloned from.
+BASE_SNAPSHOT = 'hark-base'
+
+# The showvminfo key of the slot a golden VM's base image is attached to.
+GOLDEN_DISK = 'sata1-0-0'
+
+
+def _golden_name(baseImagePath):
+    base = os.path.splitext(os.path.basename(baseImagePath))[0]
+    h = hashlib.sha1(baseImagePath.encode('utf-8')).hexdigest()[:8]
+    return 'hark-golden-%s-%s' % (base, h)
+
+
+def golden_images(dal):
+    "Return the paths of the base images which have golden VMs"
+    return [
+        cfg['name'][len(GOLDEN_VM_CFG_PREFIX):]
+        for cfg in dal.read(hark.models.config.Config)
+        if cfg['name'].startswith(GOLDEN_VM_CFG_PREFIX)
+    ]
+
+
+class GoldenPool(object):
+    """
+    The pool of golden VMs which machines are created from as linked clones.
+
+    There is one golden VM per base image. It has the image attached as its
+    disk and a base snapshot, so a new machine is a clonevm of that snapshot
+    with a differencing disk, rather than a VM built from scratch. The pool
+    is recorded in the DAL's config table.
+
+    driver is a virtualbox Driver; the Driver class itself is enough to
+    remove golden VMs, which doesn't need a machine.
+    """
+
+    def __init__(self, driver, dal):
+        self.driver = driver
+        self.dal = dal
+
+    def _key(self, baseImagePath):
+        return GOLDEN_VM_CFG_PREFIX + baseImagePath
+
+    def _read(self, baseImagePath):
+        return self.dal.read_one(hark.models.config.Config, constraints={
+            'name': self._key(baseImagePath)})
+
+    def get(self, baseImagePath):
+        """
+        Return the name of the golden VM for a base image, creating it if
+        there isn't a complete one.
+        """
+        cfg = self._read(baseImagePath)
+        if cfg is not None:
+            name = cfg['value']
+        else:
+            name = _golden_name(baseImagePath)
+
+        info = self.driver._goldenInfo(name)
+        if info is not None and info.get('SnapshotName') == BASE_SNAPSHOT:
+            if cfg is not None:
+                return name
+            # a complete golden VM whose config row was lost, e.g. when the
+            # transaction creating the first machine from it rolled back
+            log.info(
+                "virtualbox: adopting existing golden VM '%s' for base "
+                "image '%s'", name, baseImagePath)
+        else:
+            # a VM left without its snapshot, by a failed create or remove
+            if info is not None:
+                self.driver._discardGolden(name)
+            log.info(
+                "virtualbox: creating golden VM '%s' for base image '%s'",
+                name, baseImagePath)
+            self.driver._createGolden(name, baseImagePath)
+
+        if cfg is None:
+            self.dal.create(hark.models.config.Config(
+                name=self._key(baseImagePath), value=name))
+        return name
+
+    def images(self):
+        "Return the paths of the base images which have golden VMs"
+        return golden_images(self.dal)
+
+    def remove(self, baseImagePath):
+        """
+        Unregister and delete the golden VM for a base image, leaving the
+        image itself in place. VirtualBox refuses to while linked clones of
+        it exist.
+
+        The config row, which keeps the image from being evicted, is only
+        deleted once the VM is gone, so a remove which fails part way can
+        be run again.
+        """
+        cfg = self._read(baseImagePath)
+        if cfg is None:
+            return
+        name = cfg['value']
+        run = self.driver._run
+        info = self.driver._goldenInfo(name)
+        if info is not None:
+            if info.get('SnapshotName') == BASE_SNAPSHOT:
+                run(['snapshot', name, 'delete', BASE_SNAPSHOT])
+            # detach the base image so that deleting the VM doesn't delete it
+            if info.get(GOLDEN_DISK, 'none') != 'none':
+                run(self.driver._detachStorageCommand(name))
+            run(['unregistervm', name, '--delete'])
+        self.dal.delete(cfg)
+
+    def prune(self):
+        """
+        Remove the golden VMs which have no linked clones, so that their
+        images are no longer pinned in the image cache. Golden VMs which
+        VirtualBox won't delete the base snapshot of, because clones of it
+        exist, are kept. Returns the paths of the base images whose golden
+        VMs were removed.
+        """
+        removed = []
+        for path in self.images():
+            try:
+                self.remove(path)
+            except hark.exceptions.CommandFailed as e:
+                log.debug(
+                    "virtualbox: keeping golden VM for '%s': %s", path, e)
+                continue
+            removed.append(path)
+        return removed
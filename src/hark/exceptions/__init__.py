@@ -22,6 +22,17 @@ class InvalidQueryConstraint(Exception):
     pass
 
 
+class InvalidDALOption(Exception):
+    pass
+
+
+class UnsupportedSchemaVersion(Exception):
+    def __init__(self, path, version, latest):
+        msg = "Database %s has schema version %d, but this version of hark " \
+            "only supports up to version %d" % (path, version, latest)
+        Exception.__init__(self, msg)
+
+
 class DuplicateModelException(Exception):
     def __init__(self, instance, e=None):
         self.model = instance
@@ -65,6 +76,10 @@ class CommandFailed(Exception):
         Exception.__init__(self, msg)
 
 
+class QMPError(Exception):
+    pass
+
+
 class MachineNotFound(Exception):
     pass
 
@@ -73,6 +88,16 @@ class ImageNotFound(Exception):
     pass
 
 
+class ChecksumMismatch(Exception):
+    def __init__(self, path, expected, actual):
+        self.path = path
+        self.expected = expected
+        self.actual = actual
+        msg = "Checksum mismatch for %s: expected sha256 %s, got %s" % (
+            path, expected, actual)
+        Exception.__init__(self, msg)
+
+
 class UnrecognisedMachineState(Exception):
     pass
 
@@ -86,6 +111,11 @@ class InvalidStatus(Exception):
     pass
 
 
+class WaitTimeout(Exception):
+    "Exception used when a machine doesn't reach a status in time."
+    pass
+
+
 class BadHarkEnvironment(Exception):
     def __init__(self, *complaints):
         msg = "hark found %d issues with your environment; they were:\n%s" % (
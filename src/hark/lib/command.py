@@ -20,6 +20,32 @@ def which(cmd):
     return res.stdout.strip()
 
 
+def batchCommands(cmds, batchable):
+    """
+    Plan how to run a list of commands in as few invocations as possible, by
+    merging runs of consecutive commands which can be run as one.
+
+    batchable(cmd) returns how many leading arguments of a command say what
+    it acts on, e.g. 2 for ['modifyvm', 'vm1', '--memory', '512'], or None if
+    it can't be merged with others. Consecutive commands with the same
+    leading arguments are merged by concatenating the rest of their
+    arguments. The order of the commands is kept.
+
+    Returns the list of commands to run.
+    """
+    plan = []
+    prefix = None
+    for cmd in cmds:
+        n = batchable(cmd)
+        if n is not None and prefix is not None and \
+                list(cmd[:n]) == prefix:
+            plan[-1].extend(cmd[n:])
+            continue
+        plan.append(list(cmd))
+        prefix = list(cmd[:n]) if n is not None else None
+    return plan
+
+
 class Result(object):
     """
     The result of a command.
@@ -0,0 +1,251 @@
+import errno
+import os
+import shutil
+import time
+
+import hark.log
+
+from . import platform
+from .sparse import SparseWriter
+
+
+# Import modes: how an image file gets into the cache.
+COPY = 'copy'
+LINK = 'link'
+MOVE = 'move'
+MODES = (COPY, LINK, MOVE)
+
+# The FICLONE ioctl from linux/fs.h: _IOW(0x94, 9, int). It makes the
+# destination share the source's extents on copy-on-write filesystems such
+# as btrfs and xfs.
+FICLONE = 0x40049409
+
+# errnos which mean a strategy can't be used for this pair of files, so the
+# next one should be tried.
+_UNSUPPORTED = set(getattr(errno, e) for e in (
+    'EBADF', 'EINVAL', 'ENOSYS', 'ENOTSUP', 'EOPNOTSUPP', 'ENOTTY', 'EXDEV',
+    'EPERM', 'ETXTBSY',
+) if hasattr(errno, e))
+
+_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+class _Unsupported(Exception):
+    pass
+
+
+class CopyResult(object):
+    "How a file was copied: the strategy used, its size and how long it took"
+
+    def __init__(self, strategy, size, seconds):
+        self.strategy = strategy
+        self.size = size
+        self.seconds = seconds
+
+    def throughput(self):
+        "Bytes per second, or None if the copy took no measurable time"
+        if self.seconds <= 0:
+            return None
+        return self.size / self.seconds
+
+    def __str__(self):
+        t = self.throughput()
+        rate = 'instant' if t is None else '%.1f MiB/s' % (t / 2 ** 20)
+        return '%s: %d bytes in %.3fs (%s)' % (
+            self.strategy, self.size, self.seconds, rate)
+
+
+def _reflink(src, dst, size):
+    if not platform.platform().startswith('linux'):
+        raise _Unsupported
+    import fcntl
+    try:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except (IOError, OSError) as e:
+        if e.errno in _UNSUPPORTED:
+            raise _Unsupported
+        raise
+
+
+def _kernel_copy(fn):
+    """
+    Copy with fn(src_fd, dst_fd, offset, count) -> bytes copied, which is
+    os.copy_file_range or os.sendfile. Falls back only if the first call
+    fails; an error after some data has been copied is raised.
+    """
+    def copy(src, dst, size):
+        offset = 0
+        while offset < size:
+            try:
+                n = fn(src.fileno(), dst.fileno(), offset, size - offset)
+            except OSError as e:
+                if offset == 0 and e.errno in _UNSUPPORTED:
+                    raise _Unsupported
+                raise
+            if n == 0:
+                break
+            offset += n
+        if offset == 0 and size > 0:
+            raise _Unsupported
+    return copy
+
+
+def _copy_file_range(src_fd, dst_fd, offset, count):
+    return os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+
+
+def _sendfile(src_fd, dst_fd, offset, count):
+    # sendfile writes at the destination's file position
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    return os.sendfile(dst_fd, src_fd, offset, count)
+
+
+def _isSparse(f, size):
+    st = os.fstat(f.fileno())
+    return hasattr(st, 'st_blocks') and st.st_blocks * 512 < size
+
+
+def _extents(fd, size):
+    "Yield the (start, end) offsets of the data in a file, between holes."
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # there's only a hole from offset to the end
+                return
+            raise
+        end = os.lseek(fd, start, os.SEEK_HOLE)
+        yield start, end
+        offset = end
+
+
+def _copyRange(src_fd, dst_fd, start, end):
+    "Copy bytes start to end from src_fd to the same offsets in dst_fd."
+    offset = start
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < end:
+                n = os.copy_file_range(
+                    src_fd, dst_fd, end - offset, offset, offset)
+                if n == 0:
+                    break
+                offset += n
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+    while offset < end:
+        data = os.pread(src_fd, min(_BUFFER_SIZE, end - offset), offset)
+        if not data:
+            break
+        os.pwrite(dst_fd, data, offset)
+        offset += len(data)
+
+
+def _sparse(src, dst, size):
+    """
+    Copy only the data extents of a sparse source, found with SEEK_DATA and
+    SEEK_HOLE, so the holes stay holes in the destination.
+    """
+    if not hasattr(os, 'SEEK_DATA') or not _isSparse(src, size):
+        raise _Unsupported
+    src_fd, dst_fd = src.fileno(), dst.fileno()
+    try:
+        extents = list(_extents(src_fd, size))
+    except OSError as e:
+        if e.errno in _UNSUPPORTED:
+            raise _Unsupported
+        raise
+    for start, end in extents:
+        _copyRange(src_fd, dst_fd, start, end)
+    os.ftruncate(dst_fd, size)
+
+
+def _userspace(src, dst, size):
+    # skip over blocks of zeroes, so they become holes in the destination
+    w = SparseWriter(dst)
+    buf = bytearray(_BUFFER_SIZE)
+    while True:
+        n = src.readinto(buf)
+        if not n:
+            break
+        w.write(buf if n == len(buf) else buf[:n])
+    w.finish()
+
+
+def _strategies():
+    "The copy strategies available on this platform, fastest first"
+    s = [('reflink', _reflink)]
+    if hasattr(os, 'SEEK_DATA'):
+        s.append(('sparse', _sparse))
+    if hasattr(os, 'copy_file_range'):
+        s.append(('copy_file_range', _kernel_copy(_copy_file_range)))
+    if hasattr(os, 'sendfile') and platform.platform().startswith('linux'):
+        # only linux supports sendfile to a regular file
+        s.append(('sendfile', _kernel_copy(_sendfile)))
+    s.append(('userspace', _userspace))
+    return s
+
+
+def _copy(source, dest, size):
+    with open(source, 'rb') as src:
+        with open(dest, 'wb') as dst:
+            for strategy, fn in _strategies():
+                try:
+                    fn(src, dst, size)
+                except _Unsupported:
+                    hark.log.debug(
+                        'fastcopy: %s not supported for %s', strategy, dest)
+                    dst.seek(0)
+                    dst.truncate()
+                    continue
+                break
+    shutil.copymode(source, dest)
+    return strategy
+
+
+def copyFile(source, dest, mode=COPY):
+    """
+    Copy source to dest, avoiding pushing the data through userspace where
+    possible. Returns a CopyResult.
+
+    A copy tries a reflink clone first, then, if the source is sparse, a
+    copy of just its data extents, then os.copy_file_range, then
+    os.sendfile, and only then an ordinary read/write copy which leaves holes
+    for blocks of zeroes. The 'link' mode
+    hardlinks dest to source, and the 'move' mode renames source to dest;
+    both fall back to a copy if the files are on different filesystems, and
+    a move then removes the source.
+    """
+    if mode not in MODES:
+        raise ValueError("mode must be one of %s, not '%s'" % (
+            ", ".join(MODES), mode))
+
+    start = time.time()
+    size = os.stat(source).st_size
+    strategy = None
+
+    if mode == LINK:
+        try:
+            if os.path.exists(dest):
+                os.remove(dest)
+            os.link(source, dest)
+            strategy = 'hardlink'
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+    elif mode == MOVE:
+        try:
+            os.replace(source, dest)
+            strategy = 'rename'
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+
+    if strategy is None:
+        strategy = _copy(source, dest, size)
+        if mode == MOVE:
+            os.remove(source)
+
+    return CopyResult(strategy, size, time.time() - start)
@@ -0,0 +1,68 @@
+BLOCK_SIZE = 4096
+
+
+class SparseWriter(object):
+    """
+    Writes to a file, leaving holes where the data is all zeroes.
+
+    Data is checked in BLOCK_SIZE blocks; a block of zeroes is skipped by
+    seeking past it rather than written, so on filesystems which support
+    sparse files it takes no space. finish() must be called once all the data
+    is written, to extend the file over any hole at the end.
+    """
+
+    def __init__(self, f, block_size=BLOCK_SIZE):
+        self.f = f
+        self.block_size = block_size
+        # the offset the next write goes to
+        self.pos = f.tell()
+        # the number of bytes skipped rather than written
+        self.skipped = 0
+        self._seek = False
+        self._zeroes = bytes(block_size)
+
+    def _write(self, data):
+        if self._seek:
+            self.f.seek(self.pos)
+            self._seek = False
+        self.f.write(data)
+        self.pos += len(data)
+
+    def _skip(self, n):
+        self.pos += n
+        self.skipped += n
+        self._seek = True
+
+    def write(self, data):
+        # Work on a view, so that a reused buffer like a readinto() buffer
+        # isn't copied; a block is zeroes if a block of zeroes starts with
+        # it, which compares the memory without a copy.
+        view = memoryview(data)
+        if view.format != 'B':
+            view = view.cast('B')
+        n = len(view)
+        bs = self.block_size
+        zeroes = self._zeroes
+
+        # start of the run of data blocks not yet written
+        start = 0
+        for i in range(0, n, bs):
+            end = min(i + bs, n)
+            if not zeroes.startswith(view[i:end]):
+                continue
+            if start < i:
+                self._write(view[start:i])
+            self._skip(end - i)
+            start = end
+        if start < n:
+            self._write(view[start:n])
+        return n
+
+    def flush(self):
+        self.f.flush()
+
+    def finish(self):
+        "Set the length of the file, and return it."
+        self.f.truncate(self.pos)
+        self.f.flush()
+        return self.pos
@@ -1,16 +1,146 @@
+import abc
 import collections
+import collections.abc
 import json
 from hark.exceptions import (
     ModelInvalidException,
 )
 
 
-class BaseModel(collections.OrderedDict):
+def _slot_name(field):
+    # Slots are prefixed so that field names can't collide with methods or
+    # class attributes, e.g. a field called 'key' or 'items'.
+    return '_f_' + field
+
+
+_rowFactoryTmpl = """def row_factory(cursor, row):
+    ins = new(cls)
+%s
+    return ins
+"""
+
+
+def _compile_row_factory(cls):
+    """
+    Compile a function which constructs an instance of cls from a row whose
+    values are in the order of cls.fields, by assigning each slot directly.
+
+    It has the (cursor, row) signature of an sqlite3 row_factory.
+    """
+    lines = [
+        '    ins.%s = row[%d]' % (slot, i)
+        for i, slot in enumerate(cls._slots.values())
+    ]
+    namespace = {'new': cls.__new__, 'cls': cls}
+    exec(_rowFactoryTmpl % ('\n'.join(lines) or '    pass'), namespace)
+    return namespace['row_factory']
+
+
+class _ModelMeta(abc.ABCMeta):
+    """
+    The metaclass for models.
+
+    It gives each model class a __slots__ entry for every declared field that
+    doesn't already have one in a base class, so model instances don't carry
+    a per-instance dict.
+    """
+
+    def __new__(mcs, name, bases, namespace):
+        if '__slots__' not in namespace:
+            namespace['__slots__'] = tuple(
+                _slot_name(f) for f in namespace.get('fields', ())
+                if not any(hasattr(b, _slot_name(f)) for b in bases))
+
+        cls = abc.ABCMeta.__new__(mcs, name, bases, namespace)
+
+        # field name -> slot name, in field order
+        cls._slots = collections.OrderedDict(
+            (f, _slot_name(f)) for f in getattr(cls, 'fields', ()))
+        cls._row_factory = _compile_row_factory(cls)
+
+        return cls
+
+
+class BaseModel(collections.abc.MutableMapping, metaclass=_ModelMeta):
+    """
+    The base class for models.
+
+    A model behaves like an ordered dictionary. Values for the fields declared
+    in the class's fields list are stored in slots; any other keys are kept
+    in a dictionary which is only allocated when first needed.
+    """
+
+    __slots__ = ('_extra',)
 
     required = []
 
+    def __init__(self, *args, **kwargs):
+        if args or kwargs:
+            self.update(*args, **kwargs)
+
+    def __getitem__(self, k):
+        slot = self._slots.get(k)
+        if slot is not None:
+            try:
+                return getattr(self, slot)
+            except AttributeError:
+                raise KeyError(k)
+        try:
+            return self._extra[k]
+        except AttributeError:
+            raise KeyError(k)
+
+    def __setitem__(self, k, v):
+        slot = self._slots.get(k)
+        if slot is not None:
+            setattr(self, slot, v)
+            return
+        try:
+            self._extra[k] = v
+        except AttributeError:
+            self._extra = collections.OrderedDict([(k, v)])
+
+    def __delitem__(self, k):
+        slot = self._slots.get(k)
+        if slot is not None:
+            try:
+                delattr(self, slot)
+                return
+            except AttributeError:
+                raise KeyError(k)
+        try:
+            del self._extra[k]
+        except AttributeError:
+            raise KeyError(k)
+
+    def __contains__(self, k):
+        slot = self._slots.get(k)
+        if slot is not None:
+            return hasattr(self, slot)
+        return hasattr(self, '_extra') and k in self._extra
+
+    def __iter__(self):
+        for k, slot in self._slots.items():
+            if hasattr(self, slot):
+                yield k
+        if hasattr(self, '_extra'):
+            for k in self._extra:
+                yield k
+
+    def __len__(self):
+        n = sum(1 for s in self._slots.values() if hasattr(self, s))
+        if hasattr(self, '_extra'):
+            n += len(self._extra)
+        return n
+
+    def __repr__(self):
+        return '%s(%s)' % (
+            self.__class__.__name__,
+            ', '.join('%s=%r' % (k, v) for k, v in self.items()))
+
     def json(self, indent=None):
-        return json.dumps(self, indent=indent)
+        return json.dumps(
+            collections.OrderedDict(self.items()), indent=indent)
 
     def validate(self):
         if not hasattr(self, 'fields'):
@@ -31,22 +161,32 @@ class SQLModel(BaseModel):
     A model that can be persisted to and read from the database.
     """
 
+    __slots__ = ()
+
     @classmethod
-    def from_sql_row(cls, row):
+    def from_sql_row(cls, row, validate=True):
         """
         Construct an instance of this model from an SQL row.
 
         Assumes that the select query used the ordering of fields in the model
         definition.
         """
-        keyed = collections.OrderedDict()
-        for i, k in enumerate(cls.fields):
-            keyed[k] = row[i]
-
-        ins = cls(**keyed)
-        ins.validate()
+        ins = cls._row_factory(None, row)
+        if validate:
+            ins.validate()
         return ins
 
+    @classmethod
+    def row_factory(cls):
+        """
+        Return an sqlite3 row_factory which constructs an instance of this
+        model from each row, without validating it.
+
+        Assumes that the select query used the ordering of fields in the model
+        definition.
+        """
+        return cls._row_factory
+
     def validate(self):
         BaseModel.validate(self)
         for attr in ['table', 'key']:
@@ -6,6 +6,7 @@ import hark.models
 
 _file_suffixes = {
     'virtualbox': 'vmdk',
+    'qemu': 'qcow2',
 }
 
 
@@ -44,17 +44,21 @@ class MachineProcedure(Procedure):
 
     def driver(self):
         """Get the driver instance for this machine"""
-        return hark.driver.get_driver(self.machine['driver'], self.machine)
+        return self.client.driver(self.machine)
 
 
 class NewMachine(MachineProcedure):
     """
     A procedure for creating a new machine.
+
+    With linked_clone, the machine is created as a linked clone of a golden
+    VM for its image, where the driver supports it.
     """
 
-    def __init__(self, client, machine):
+    def __init__(self, client, machine, linked_clone=False):
         MachineProcedure.__init__(self, client, machine)
 
+        self.linked_clone = linked_clone
         self.ssh_port_mapping = None
         self.private_interface = None
 
@@ -66,37 +70,65 @@ class NewMachine(MachineProcedure):
             self.error("Run 'hark image pull' to download it first.")
             raise Abort
 
-        # Get a driver for this machine
+        # This will identify duplicates before we attempt to create the
+        # machine.
         try:
-            # Save it in the DAL.
-            # This will identify duplicates before we attempt to create the
-            # machine.
-            self.saveMachineToDal()
-        except hark.exceptions.DuplicateModelException:
-            self.error(
-                'Machine already exists with these options:\n\t%s' %
-                self.machine)
-            raise Abort
-
-        self.driver().create(baseImagePath, self.client.dal())
+            self.client.getMachine(self.machine['name'])
+        except hark.exceptions.MachineNotFound:
+            pass
+        else:
+            self.duplicate()
 
-        self.createPortMapping()
+        # Get a driver for this machine
+        d = self.driver()
+        d.create(
+            baseImagePath, self.client.dal(), linked_clone=self.linked_clone)
 
-        self.configureNetwork()
+        try:
+            self.createPortMapping()
+
+            self.configureNetwork()
+
+            # Everything we save for this machine is committed at once, after
+            # the driver is done, so the database isn't locked while it runs.
+            with self.client.transaction():
+                self.saveToDal()
+        except BaseException:
+            # Nothing was saved, so hark couldn't remove the machine later.
+            self.removeFromDriver(d)
+            raise
+
+    def duplicate(self):
+        self.error(
+            'Machine already exists with these options:\n\t%s' %
+            self.machine)
+        raise Abort
+
+    def removeFromDriver(self, d):
+        try:
+            d.remove()
+        except Exception as e:
+            self.error('Failed to remove the partly created machine: %s' % e)
 
     def image(self):
         """
-        Check for the image specified by this machine. Return a tuple of
-        (image, baseImagePath).
+        Check for the image specified by this machine, and record that it is
+        being used. Return a tuple of (image, baseImagePath).
         """
-        image = hark.util.findImage(
-            self.client.images(),
+        image = self.client.imageIndex().latest(
             self.machine['driver'], self.machine['guest'])
+        self.client.useImage(image, self.machine)
         baseImagePath = self.client.imagePath(image)
         return image, baseImagePath
 
-    def saveMachineToDal(self):
-        self.client.createMachine(self.machine)
+    def saveToDal(self):
+        "Save the machine, its port mapping and its network interface."
+        try:
+            self.client.createMachine(self.machine)
+        except hark.exceptions.DuplicateModelException:
+            self.duplicate()
+        self.client.createPortMapping(self.ssh_port_mapping)
+        self.client.createNetworkInterface(self.private_interface)
 
     def createPortMapping(self):
         """Set up an SSH port mapping for this machine."""
@@ -117,9 +149,6 @@ class NewMachine(MachineProcedure):
         # Create the mapping in the driver
         self.driver().setPortMappings([mapping])
 
-        # Save the mapping in the DAL
-        self.client.createPortMapping(mapping)
-
     def configureNetwork(self):
         # We need to assign a static IP address for the host-only interface.
         free_addr = self.client.freePrivateIP()
@@ -128,12 +157,13 @@ class NewMachine(MachineProcedure):
             kind='private',
             addr=free_addr)
 
-        self.client.createNetworkInterface(iface)
-
         self.private_interface = iface
 
 
 class RemoveMachine(MachineProcedure):
+    # How long to wait for a machine to power off, in seconds.
+    stop_timeout = 120
+
     def run(self):
         from hark.driver.status import PAUSED, RUNNING, STOPPED
         d = self.driver()
@@ -142,7 +172,11 @@ class RemoveMachine(MachineProcedure):
         if s in (PAUSED, RUNNING):
             self.info("Machine status is '%s' - stopping it first." % s)
             d.stop()
-            d.waitStatus(STOPPED)
+            try:
+                d.waitStatus(STOPPED, timeout=self.stop_timeout)
+            except hark.exceptions.WaitTimeout as e:
+                self.error(str(e))
+                raise Abort
 
         # remove the VM in the driver
         d.remove()
@@ -1,4 +1,4 @@
-from hark.exceptions import BadHarkEnvironment, ImageNotFound
+from hark.exceptions import BadHarkEnvironment
 
 
 def getFreePort(exclude=[]):
@@ -14,18 +14,50 @@ def getFreePort(exclude=[]):
             return port
 
 
-def findImage(images, driver, guest):
+def findImage(images, driver, guest, version=None):
     """
-    Given a list of images, find the highest-version image for this driver and
-    guest.
+    Given a list of images, in any order, find the image for this driver and
+    guest with this version, or the highest-version image if version is None.
 
     Raises ImageNotFound if none is found.
     """
-    im = [i for i in images if i['driver'] == driver and i['guest'] == guest]
-    if len(im) == 0:
-        raise ImageNotFound(
-            "no local image for driver '%s' and guest: '%s'" % (driver, guest))
-    return im[-1]
+    from hark.util.imageindex import ImageIndex
+    return ImageIndex(images).find(driver, guest, version=version)
+
+
+_SIZE_UNITS = {
+    '': 1,
+    'K': 1024,
+    'M': 1024 ** 2,
+    'G': 1024 ** 3,
+    'T': 1024 ** 4,
+}
+
+
+def parseSize(s):
+    """
+    Parse a size in bytes such as '500M' or '20G', with binary units.
+
+    Raises ValueError if it can't be parsed.
+    """
+    import re
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*$', s, re.I)
+    if m is None:
+        raise ValueError("invalid size: '%s'" % s)
+    return int(float(m.group(1)) * _SIZE_UNITS[m.group(2).upper()])
+
+
+def formatSize(n):
+    "Format a size in bytes with a binary unit, e.g. '1.5G'"
+    for unit in ('', 'K', 'M', 'G'):
+        if n < 1024:
+            break
+        n /= 1024.0
+    else:
+        unit = 'T'
+    if unit == '':
+        return '%dB' % n
+    return '%.1f%s' % (n, unit)
 
 
 def checkHarkEnv():
@@ -1,17 +1,681 @@
+import hashlib
+import json
+import os
+import sys
+import time
+
 import click
 
+from hark.lib.sparse import SparseWriter
+import hark.log as log
+from hark.util import formatSize
+
+
+# How much is read from the response at a time.
+BUFFER_SIZE = 4 * 1024 * 1024
+
+# The least time between updates of the progress bar, in seconds.
+PROGRESS_INTERVAL = 0.25
+
+# Seconds to wait to connect, and for each read of a download. A stalled
+# connection fails, and the download can be resumed, rather than hanging.
+DEFAULT_TIMEOUT = (10, 60)
+
+# How many ranges of a file are downloaded at once by segmentedDownload.
+DEFAULT_SEGMENTS = 4
+
+# The least time between saves of a segmented download's state, in seconds.
+STATE_INTERVAL = 1.0
+
+# The compressed formats images can be downloaded in, most preferred first,
+# and the file suffixes which identify them.
+COMPRESSIONS = ('xz', 'gz')
+_compressionSuffixes = {
+    '.xz': 'xz',
+    '.gz': 'gz',
+}
+
+# The most decompressed data produced from one chunk at a time. Disk images
+# compress very well, so one chunk of input can expand enormously.
+_DECOMPRESS_LIMIT = 16 * 1024 * 1024
 
-def responseToFile(msg, response, f):
+# LZMADecompressor can only bound its output from Python 3.5; before then,
+# each chunk is decompressed whole.
+_LZMA_MAX_LENGTH = sys.version_info >= (3, 5)
+
+
+def _encoded(response):
+    "Whether requests has to decode the body of a response"
+    return response.headers.get('Content-Encoding', 'identity') != 'identity'
+
+
+class _ByteCounter(object):
     """
-    Download a response object to a value. Print a progress bar with click.
+    Stands in for a click progress bar when the length of a download isn't
+    known, showing how much has been written so far instead.
+    """
+
+    def __init__(self, label):
+        self.label = label
+        self.n = 0
+        self.tty = sys.stdout.isatty()
+
+    def __enter__(self):
+        if not self.tty:
+            click.echo(self.label)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.tty:
+            click.echo()
+
+    def update(self, n):
+        self.n += n
+        if self.tty:
+            click.echo('\r%s  %s' % (self.label, formatSize(self.n)), nl=False)
+
+
+def _progress(msg, response):
+    """
+    A progress bar for a download. The Content-Length of a response with a
+    Content-Encoding is of the encoded body, not of what is written, so it
+    is only used for one without.
+    """
+    length = response.headers.get('Content-Length')
+    if length is None or _encoded(response):
+        return _ByteCounter(msg)
+    return click.progressbar(length=int(length), label=msg)
+
+
+def _chunks(response, buffer_size):
+    """
+    Yield the body of a response in chunks of up to buffer_size bytes.
+
+    The chunks are views of one preallocated buffer, which the raw response
+    reads into directly, so each is only valid until the next is yielded.
+    A response with a Content-Encoding has to be decoded by requests, so it
+    is read through iter_content instead.
+    """
+    if _encoded(response):
+        for chunk in response.iter_content(chunk_size=buffer_size):
+            yield chunk
+        return
+
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    raw = response.raw
+    while True:
+        n = raw.readinto(buf)
+        if not n:
+            break
+        yield view[:n]
+
+
+def responseToFile(
+        msg, response, f, hasher=None,
+        buffer_size=BUFFER_SIZE, progress_interval=PROGRESS_INTERVAL):
+    """
+    Download a response object to a value. Print a progress bar with click,
+    or a count of the bytes written if the length isn't known.
+
+    If hasher is given, e.g. a hashlib.sha256 object, it is updated with each
+    chunk as it is written, so the digest is ready when the download is done.
+
+    The body is read in buffer_size chunks into a reused buffer, and the
+    progress bar is updated at most every progress_interval seconds. Returns
+    the number of bytes written.
 
     Assumes that stream=True was passed to requests.
     """
-    chunk_size = 1024
-    length = int(response.headers['Content-Length'])
-    with click.progressbar(length=length, label=msg) as bar:
-        for chunk in response.iter_content(chunk_size=chunk_size):
-            if chunk:
-                f.write(chunk)
-            bar.update(chunk_size)
+    total = 0
+
+    with _progress(msg, response) as bar:
+        pending = 0
+        last = time.monotonic()
+        for chunk in _chunks(response, buffer_size):
+            f.write(chunk)
+            if hasher is not None:
+                hasher.update(chunk)
+            n = len(chunk)
+            total += n
+            pending += n
+
+            now = time.monotonic()
+            if now - last >= progress_interval:
+                bar.update(pending)
+                pending = 0
+                last = now
+        bar.update(pending)
         f.flush()
+
+    return total
+
+
+def _hashFile(path, hasher):
+    "Update hasher with the contents of a file. Returns its size."
+    n = 0
+    buf = bytearray(BUFFER_SIZE)
+    view = memoryview(buf)
+    with open(path, 'rb') as f:
+        while True:
+            r = f.readinto(buf)
+            if not r:
+                break
+            hasher.update(view[:r])
+            n += r
+    return n
+
+
+def _loadState(state_path):
+    try:
+        with open(state_path, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _saveState(state_path, state):
+    tmp = state_path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp, state_path)
+
+
+def _resumeFrom(url, path, state, sha256, hasher):
+    """
+    Work out whether a partial download at path can be resumed. Returns the
+    offset to resume from, having fed the data already downloaded through
+    hasher, and the validator to send in If-Range; or (0, None) to start
+    again.
+    """
+    if state is None or not os.path.exists(path):
+        return 0, None
+    if state.get('url') != url or state.get('sha256') != sha256:
+        return 0, None
+    if 'segments' in state:
+        # a segmented download's file is full of holes
+        return 0, None
+    validator = state.get('etag') or state.get('last_modified')
+    if validator is None:
+        # without a validator we can't tell if the file has changed
+        return 0, None
+    return _hashFile(path, hasher), validator
+
+
+def resumableDownload(
+        msg, url, path, sha256=None, state_path=None,
+        buffer_size=BUFFER_SIZE, timeout=DEFAULT_TIMEOUT):
+    """
+    Download url to path, resuming an earlier partial download if there is
+    one. Returns the SHA-256 hex digest of the complete file.
+
+    A sidecar JSON file at state_path (path + '.json' by default) records the
+    URL, the expected sha256 and the server's ETag or Last-Modified. If it
+    matches, the data already in path is rehashed and the rest is requested
+    with a Range header; the If-Range header makes the server send the whole
+    file instead if it has changed. Blocks of zeroes are left as holes.
+
+    Both files are left in place if the download fails, so it can be resumed;
+    it is up to the caller to move path into place and remove the state file
+    once the digest is checked.
+    """
+    import requests
+
+    if state_path is None:
+        state_path = path + '.json'
+
+    hasher = hashlib.sha256()
+    offset, validator = _resumeFrom(
+        url, path, _loadState(state_path), sha256, hasher)
+
+    headers = {}
+    if offset > 0:
+        log.info("Resuming download of %s at byte %d", url, offset)
+        headers['Range'] = 'bytes=%d-' % offset
+        headers['If-Range'] = validator
+
+    resp = requests.get(url, headers=headers, stream=True, timeout=timeout)
+    try:
+        resumed = resp.status_code == 206 and resp.headers.get(
+            'Content-Range', '').startswith('bytes %d-' % offset)
+        if offset > 0 and (resp.status_code == 416 or (
+                resp.status_code == 206 and not resumed)):
+            # the partial file is no use; start again
+            resp.close()
+            os.remove(path)
+            os.remove(state_path)
+            return resumableDownload(
+                msg, url, path, sha256=sha256, state_path=state_path,
+                buffer_size=buffer_size, timeout=timeout)
+
+        resp.raise_for_status()
+
+        if resumed:
+            mode = 'r+b'
+        else:
+            if offset > 0:
+                log.info("Server sent the whole of %s; starting again", url)
+            offset = 0
+            hasher = hashlib.sha256()
+            mode = 'wb'
+
+        _saveState(state_path, {
+            'url': url,
+            'sha256': sha256,
+            'etag': resp.headers.get('ETag'),
+            'last_modified': resp.headers.get('Last-Modified'),
+        })
+
+        with open(path, mode) as f:
+            f.truncate(offset)
+            f.seek(offset)
+            w = SparseWriter(f)
+            responseToFile(
+                msg, resp, w, hasher=hasher, buffer_size=buffer_size)
+            w.finish()
+    finally:
+        resp.close()
+
+    return hasher.hexdigest()
+
+
+def _probe(url, timeout=DEFAULT_TIMEOUT):
+    """
+    Find out whether a URL can be downloaded in ranges, by asking for its
+    first byte. (A HEAD request would do, but presigned URLs are often only
+    valid for GET.) Returns a dict with its length, ETag and Last-Modified if
+    it can, or None.
+    """
+    import requests
+    resp = requests.get(
+        url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=timeout)
+    try:
+        resp.raise_for_status()
+        content_range = resp.headers.get('Content-Range', '')
+        if resp.status_code != 206 or \
+                not content_range.startswith('bytes 0-0/') or \
+                resp.headers.get('Content-Encoding', 'identity') != 'identity':
+            return None
+        try:
+            length = int(content_range.split('/', 1)[1])
+        except ValueError:
+            # the length is '*', unknown
+            return None
+        return {
+            'length': length,
+            'etag': resp.headers.get('ETag'),
+            'last_modified': resp.headers.get('Last-Modified'),
+        }
+    finally:
+        resp.close()
+
+
+def _segments(length, segments, chunk_size):
+    """
+    Split length bytes into up to this many segments, on chunk_size
+    boundaries. Each is a dict with its first and last byte, and the
+    position up to which it has been downloaded.
+    """
+    per = -(-length // segments)
+    per = max(chunk_size, -(-per // chunk_size) * chunk_size)
+    return [
+        {'start': start, 'end': min(start + per, length) - 1, 'pos': start}
+        for start in range(0, length, per)
+    ]
+
+
+def _resumeSegments(url, path, state, sha256, probe):
+    """
+    Return the segments of an earlier segmented download of url to path
+    which can be resumed, or None.
+    """
+    if state is None or not os.path.exists(path):
+        return None
+    if state.get('url') != url or state.get('sha256') != sha256:
+        return None
+    if state.get('length') != probe['length']:
+        return None
+    validator = state.get('etag') or state.get('last_modified')
+    if validator is None or validator != (
+            probe['etag'] or probe['last_modified']):
+        return None
+    return state.get('segments')
+
+
+class _PositionalFile(object):
+    """
+    A file-like object which writes to fd from pos with os.pwrite, leaving
+    the fd's own offset alone, so that threads can write to it at once.
+    """
+
+    def __init__(self, fd, pos):
+        self.fd = fd
+        self.pos = pos
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos):
+        self.pos = pos
+
+    def write(self, data):
+        view = memoryview(data)
+        written = 0
+        while written < len(view):
+            written += os.pwrite(self.fd, view[written:], self.pos + written)
+        self.pos += written
+        return written
+
+
+class _SegmentedWriter(object):
+    """
+    Downloads segments of a URL into a preallocated file with os.pwrite,
+    and keeps the download's state file up to date.
+
+    The file is hashed in order as it becomes contiguous: whichever thread
+    moves the end of the first incomplete segment on reads what it just
+    passed back from the page cache into the hasher.
+    """
+
+    def __init__(self, url, fd, validator, chunk_size, state, state_path,
+                 bar, timeout=DEFAULT_TIMEOUT):
+        import threading
+        self.url = url
+        self.fd = fd
+        self.validator = validator
+        self.chunk_size = chunk_size
+        self.state = state
+        self.state_path = state_path
+        self.bar = bar
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.failed = threading.Event()
+        self.pending = 0
+        self.last_progress = self.last_save = time.monotonic()
+        self.hasher = hashlib.sha256()
+        self.hashed = 0
+        self.hash_lock = threading.Lock()
+
+    def _advance(self, segment, n):
+        with self.lock:
+            segment['pos'] += n
+            self.pending += n
+            now = time.monotonic()
+            if now - self.last_progress >= PROGRESS_INTERVAL:
+                self.bar.update(self.pending)
+                self.pending = 0
+                self.last_progress = now
+            if now - self.last_save >= STATE_INTERVAL:
+                self.save()
+                self.last_save = now
+        self.hash(wait=False)
+
+    def _contiguous(self):
+        "The position up to which every segment is complete"
+        with self.lock:
+            for p in self.state['segments']:
+                if p['pos'] <= p['end']:
+                    return p['pos']
+            return self.state['length']
+
+    def hash(self, wait=True):
+        """
+        Hash the file from where hashing got to up to where it is complete.
+        Unless wait is true, this gives way to another thread already doing
+        so.
+        """
+        if not self.hash_lock.acquire(blocking=wait):
+            return
+        try:
+            while True:
+                end = self._contiguous()
+                if end <= self.hashed:
+                    return
+                while self.hashed < end:
+                    data = os.pread(
+                        self.fd, min(self.chunk_size, end - self.hashed),
+                        self.hashed)
+                    if not data:
+                        raise IOError("%s is shorter than expected" % self.url)
+                    self.hasher.update(data)
+                    self.hashed += len(data)
+        finally:
+            self.hash_lock.release()
+
+    def save(self):
+        _saveState(self.state_path, self.state)
+
+    def finish(self):
+        with self.lock:
+            self.bar.update(self.pending)
+            self.pending = 0
+            self.save()
+
+    def download(self, segment):
+        import requests
+
+        if segment['pos'] > segment['end']:
+            return
+
+        headers = {
+            'Range': 'bytes=%d-%d' % (segment['pos'], segment['end']),
+            'If-Range': self.validator,
+        }
+        resp = requests.get(
+            self.url, headers=headers, stream=True, timeout=self.timeout)
+        try:
+            resp.raise_for_status()
+            expect = 'bytes %d-%d/' % (segment['pos'], segment['end'])
+            if resp.status_code != 206 or not resp.headers.get(
+                    'Content-Range', '').startswith(expect):
+                raise IOError(
+                    "%s did not return the range %s" % (
+                        self.url, headers['Range']))
+
+            buf = bytearray(self.chunk_size)
+            view = memoryview(buf)
+            raw = resp.raw
+            # blocks of zeroes are left as holes in the preallocated file
+            w = SparseWriter(_PositionalFile(self.fd, segment['pos']))
+            while segment['pos'] <= segment['end']:
+                if self.failed.is_set():
+                    return
+                want = min(self.chunk_size,
+                           segment['end'] - segment['pos'] + 1)
+                n = raw.readinto(view[:want])
+                if not n:
+                    raise IOError(
+                        "%s ended early at byte %d" % (
+                            self.url, segment['pos']))
+                w.write(view[:n])
+                self._advance(segment, n)
+        except BaseException:
+            self.failed.set()
+            raise
+        finally:
+            resp.close()
+
+
+def segmentedDownload(
+        msg, url, path, sha256=None, state_path=None,
+        segments=DEFAULT_SEGMENTS, chunk_size=BUFFER_SIZE,
+        timeout=DEFAULT_TIMEOUT):
+    """
+    Download url to path in this many byte ranges at once. Returns the
+    SHA-256 hex digest of the complete file.
+
+    The file is preallocated as a sparse file and each range is written into
+    place with os.pwrite by its own thread, over its own connection. Blocks
+    of zeroes are left as holes. The state file records how far each range
+    has got, so an interrupted download resumes each of them where it left
+    off. The digest is computed as the start of the file becomes complete,
+    so it is ready soon after the last range arrives.
+
+    If the server doesn't support ranges, or segments is 1, this falls back
+    to resumableDownload.
+    """
+    import concurrent.futures
+
+    if state_path is None:
+        state_path = path + '.json'
+
+    state = _loadState(state_path)
+    probe = None
+    if segments > 1 and not (
+            state is not None and 'segments' not in state and
+            os.path.exists(path)):
+        probe = _probe(url, timeout=timeout)
+    if probe is None or probe['length'] <= chunk_size:
+        # one stream, or resuming an earlier single stream download
+        return resumableDownload(
+            msg, url, path, sha256=sha256, state_path=state_path,
+            buffer_size=chunk_size, timeout=timeout)
+
+    length = probe['length']
+    validator = probe['etag'] or probe['last_modified']
+
+    parts = _resumeSegments(url, path, state, sha256, probe)
+    fresh = parts is None
+    if fresh:
+        parts = _segments(length, segments, chunk_size)
+    else:
+        log.info("Resuming segmented download of %s", url)
+
+    state = {
+        'url': url,
+        'sha256': sha256,
+        'etag': probe['etag'],
+        'last_modified': probe['last_modified'],
+        'length': length,
+        'segments': parts,
+    }
+    done = sum(p['pos'] - p['start'] for p in parts)
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if fresh:
+            # chunks of zeroes aren't written, so there mustn't be any old
+            # data for them to leave in place
+            os.ftruncate(fd, 0)
+        os.ftruncate(fd, length)
+        with click.progressbar(length=length, label=msg) as bar:
+            bar.update(done)
+            writer = _SegmentedWriter(
+                url, fd, validator, chunk_size, state, state_path, bar,
+                timeout=timeout)
+            writer.save()
+            with concurrent.futures.ThreadPoolExecutor(len(parts)) as pool:
+                futures = [pool.submit(writer.download, p) for p in parts]
+                try:
+                    for f in concurrent.futures.as_completed(futures):
+                        f.result()
+                except BaseException:
+                    writer.failed.set()
+                    raise
+                finally:
+                    writer.finish()
+        # hash whatever the download threads left
+        writer.hash()
+    finally:
+        os.close(fd)
+
+    return writer.hasher.hexdigest()
+
+
+def compressionFromUrl(url):
+    "Return the compression a URL's file suffix says it has, or None."
+    from urllib.parse import urlparse
+    path = urlparse(url).path
+    for suffix, compression in _compressionSuffixes.items():
+        if path.endswith(suffix):
+            return compression
+    return None
+
+
+class _Decompressor(object):
+    """
+    A file-like object which decompresses what is written to it and writes
+    the result to a SparseWriter, updating a hasher with the decompressed
+    data.
+    """
+
+    def __init__(self, compression, writer, hasher):
+        import lzma
+        import zlib
+
+        if compression == 'xz':
+            self._d = lzma.LZMADecompressor()
+        elif compression == 'gz':
+            self._d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            raise ValueError("compression must be one of %s, not '%s'" % (
+                ", ".join(COMPRESSIONS), compression))
+        self.compression = compression
+        self.writer = writer
+        self.hasher = hasher
+
+    def _output(self, data):
+        if data:
+            self.hasher.update(data)
+            self.writer.write(data)
+
+    def write(self, chunk):
+        d = self._d
+        if self.compression == 'xz' and not _LZMA_MAX_LENGTH:
+            self._output(d.decompress(chunk))
+        elif self.compression == 'xz':
+            self._output(d.decompress(chunk, max_length=_DECOMPRESS_LIMIT))
+            while not d.eof and not d.needs_input:
+                self._output(d.decompress(b'', max_length=_DECOMPRESS_LIMIT))
+        else:
+            self._output(d.decompress(chunk, _DECOMPRESS_LIMIT))
+            while d.unconsumed_tail:
+                self._output(
+                    d.decompress(d.unconsumed_tail, _DECOMPRESS_LIMIT))
+        return len(chunk)
+
+    def flush(self):
+        self.writer.flush()
+
+    def finish(self):
+        "Check the stream was complete, and set the length of the file."
+        if self.compression == 'xz':
+            complete = self._d.eof
+        else:
+            self._output(self._d.flush())
+            complete = self._d.eof
+        if not complete:
+            raise IOError('compressed image ended early')
+        return self.writer.finish()
+
+
+def decompressingDownload(
+        msg, url, path, compression, state_path=None,
+        buffer_size=BUFFER_SIZE, timeout=DEFAULT_TIMEOUT):
+    """
+    Download a compressed file from url and decompress it to path as it
+    streams in, leaving holes in path for runs of zeroes. compression is one
+    of COMPRESSIONS. Returns the SHA-256 hex digest of the decompressed file.
+
+    Unlike resumableDownload this always starts from the beginning; any
+    earlier partial download at path, and its state file, are removed.
+    """
+    import requests
+
+    if state_path is None:
+        state_path = path + '.json'
+    if os.path.exists(state_path):
+        os.remove(state_path)
+
+    hasher = hashlib.sha256()
+    resp = requests.get(url, stream=True, timeout=timeout)
+    try:
+        resp.raise_for_status()
+        with open(path, 'wb') as f:
+            d = _Decompressor(compression, SparseWriter(f), hasher)
+            responseToFile(msg, resp, d, buffer_size=buffer_size)
+            d.finish()
+    finally:
+        resp.close()
+
+    return hasher.hexdigest()
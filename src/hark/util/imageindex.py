@@ -0,0 +1,124 @@
+import bisect
+
+from hark.exceptions import ImageNotFound
+
+
+class ImageIndex(object):
+    """
+    An index of images, keyed by (driver, guest).
+
+    The images for each key are held in ascending version order, so finding
+    the latest image, an exact version or a range of versions is a bisection
+    rather than a scan, and doesn't depend on the order images were added in.
+    """
+
+    def __init__(self, images=()):
+        # (driver, guest) -> sorted list of versions
+        self._versions = {}
+        # (driver, guest) -> list of images, in the same order as _versions
+        self._images = {}
+
+        for image in images:
+            self.add(image)
+
+    def add(self, image):
+        "Add an image, replacing any with the same driver, guest and version"
+        k = (image['driver'], image['guest'])
+        versions = self._versions.setdefault(k, [])
+        images = self._images.setdefault(k, [])
+
+        v = image['version']
+        i = bisect.bisect_left(versions, v)
+        if i < len(versions) and versions[i] == v:
+            images[i] = image
+        else:
+            versions.insert(i, v)
+            images.insert(i, image)
+
+    def remove(self, image):
+        "Remove an image. Raises ImageNotFound if it isn't in the index."
+        k = (image['driver'], image['guest'])
+        i = self._find(k, image['version'])
+        if i is None:
+            raise ImageNotFound(
+                "no image for driver '%s' and guest '%s' with version %s" % (
+                    k[0], k[1], image['version']))
+        del self._versions[k][i]
+        del self._images[k][i]
+        if not self._versions[k]:
+            del self._versions[k]
+            del self._images[k]
+
+    def _find(self, k, version):
+        versions = self._versions.get(k, [])
+        i = bisect.bisect_left(versions, version)
+        if i < len(versions) and versions[i] == version:
+            return i
+        return None
+
+    def latest(self, driver, guest):
+        """
+        Return the highest-version image for this driver and guest.
+
+        Raises ImageNotFound if there is none.
+        """
+        images = self._images.get((driver, guest))
+        if not images:
+            raise ImageNotFound(
+                "no local image for driver '%s' and guest: '%s'" % (
+                    driver, guest))
+        return images[-1]
+
+    def exact(self, driver, guest, version):
+        """
+        Return the image for this driver and guest with exactly this version.
+
+        Raises ImageNotFound if there is none.
+        """
+        k = (driver, guest)
+        i = self._find(k, version)
+        if i is None:
+            raise ImageNotFound(
+                "no local image for driver '%s' and guest '%s' "
+                "with version %s" % (driver, guest, version))
+        return self._images[k][i]
+
+    def range(self, driver, guest, min_version=None, max_version=None):
+        """
+        Return the images for this driver and guest with versions between
+        min_version and max_version inclusive, in ascending version order.
+        Either bound may be None.
+        """
+        k = (driver, guest)
+        versions = self._versions.get(k, [])
+        images = self._images.get(k, [])
+
+        lo = 0
+        if min_version is not None:
+            lo = bisect.bisect_left(versions, min_version)
+        hi = len(versions)
+        if max_version is not None:
+            hi = bisect.bisect_right(versions, max_version)
+        return images[lo:hi]
+
+    def find(self, driver, guest, version=None):
+        """
+        Return the image with this version, or the latest image if version is
+        None.
+        """
+        if version is None:
+            return self.latest(driver, guest)
+        return self.exact(driver, guest, version)
+
+    def __contains__(self, image):
+        k = (image['driver'], image['guest'])
+        return self._find(k, image['version']) is not None
+
+    def __iter__(self):
+        "Iterate over images, sorted by driver, guest and then version."
+        for k in sorted(self._images):
+            for image in self._images[k]:
+                yield image
+
+    def __len__(self):
+        return sum(len(images) for images in self._images.values())
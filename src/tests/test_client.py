@@ -62,15 +62,115 @@ class TestLocalClient(TestCase):
         m = Machine.new(name='foo', driver='yes', guest='no', memory_mb=512)
         client = hark.client.LocalClient(self.ctx)
 
-        mockRead = MagicMock(return_value=[])
-        self.ctx.dal.read = mockRead
+        mockRead = MagicMock(return_value=None)
+        self.ctx.dal.read_one = mockRead
         self.assertRaises(
             hark.exceptions.MachineNotFound,
             client.getMachine, m['name'])
 
-        mockRead = MagicMock(return_value=[m])
-        self.ctx.dal.read = mockRead
+        mockRead = MagicMock(return_value=m)
+        self.ctx.dal.read_one = mockRead
         assert client.getMachine(m['name']) == m
+        mockRead.assert_called_with(Machine, constraints={'name': 'foo'})
+
+    def testDeleteMachine(self):
+        from hark.models.network_interface import NetworkInterface
+        from hark.models.port_mapping import PortMapping
+
+        self.ctx.dal = hark.dal.InMemoryDAL()
+        client = hark.client.LocalClient(self.ctx)
+
+        m = Machine.new(name='foo', driver='yes', guest='no', memory_mb=512)
+        client.dal().create_many([
+            m,
+            PortMapping(
+                host_port=2222, guest_port=22,
+                machine_id=m['machine_id'], name='ssh'),
+            NetworkInterface(
+                machine_id=m['machine_id'], kind='private',
+                addr='192.168.168.2'),
+        ])
+
+        client.deleteMachine(m)
+
+        assert client.machines() == []
+        assert client.portMappings() == []
+        assert client.networkInterfaces() == []
+
+    def testReadCache(self):
+        from hark.models.port_mapping import PortMapping
+
+        self.ctx.dal = hark.dal.InMemoryDAL()
+        client = hark.client.LocalClient(self.ctx)
+
+        read = MagicMock(wraps=self.ctx.dal.read)
+        self.ctx.dal.read = read
+
+        m = Machine.new(name='foo', driver='yes', guest='no', memory_mb=512)
+        client.createMachine(m)
+
+        assert client.machines() == [m]
+        assert client.machines() == [m]
+        assert read.call_count == 1
+
+        # reads return the same instances
+        assert client.getMachine('foo') is client.machines()[0]
+
+        # writes invalidate reads of that class
+        pm = PortMapping(
+            host_port=2222, guest_port=22,
+            machine_id=m['machine_id'], name='ssh')
+        client.createPortMapping(pm)
+        assert client.portMappings(machine_id=m['machine_id']) == [pm]
+        assert client.portMappings(machine_id=m['machine_id']) == [pm]
+        assert read.call_count == 2
+
+        m2 = Machine.new(name='bar', driver='yes', guest='no', memory_mb=512)
+        client.createMachine(m2)
+        assert len(client.machines()) == 2
+        assert read.call_count == 3
+
+        client.deleteMachine(m)
+        assert client.machines() == [m2]
+        assert client.portMappings() == []
+        self.assertRaises(
+            hark.exceptions.MachineNotFound, client.getMachine, 'foo')
+
+    def testReadCacheRollback(self):
+        self.ctx.dal = hark.dal.InMemoryDAL()
+        client = hark.client.LocalClient(self.ctx)
+
+        m = Machine.new(name='foo', driver='yes', guest='no', memory_mb=512)
+
+        def create():
+            with client.transaction():
+                client.createMachine(m)
+                assert client.getMachine('foo') == m
+                raise hark.exceptions.MachineNotFound
+
+        self.assertRaises(hark.exceptions.MachineNotFound, create)
+        assert client.machines() == []
+        self.assertRaises(
+            hark.exceptions.MachineNotFound, client.getMachine, 'foo')
+
+    def testGcImages(self):
+        m = Machine(
+            machine_id='1', name='foo',
+            driver='yes', guest='no', memory_mb=512)
+        self.ctx.dal.read = MagicMock(return_value=[m])
+        mockGc = MagicMock(return_value=[])
+        self.ctx.image_cache().gc = mockGc
+
+        client = hark.client.LocalClient(self.ctx)
+        assert client.gcImages(quota=100) == []
+        mockGc.assert_called_with(
+            [m], quota=100, dry_run=False, pinned=[])
+
+        with patch('hark.driver.prune_golden_vms') as mockPrune:
+            client.gcImages(dry_run=True, prune_golden=True)
+            assert not mockPrune.called
+            client.gcImages(prune_golden=True)
+            mockPrune.assert_called_once_with(client.dal())
 
     def testLog(self):
         tf = tempfile.mktemp()
@@ -88,6 +188,52 @@ class TestLocalClient(TestCase):
             os.remove(tf)
 
 
+class TestSaveImageFromUrl(TestCase):
+    def setUp(self):
+        import hark.context
+        self.tempdir = tempfile.mkdtemp()
+        self.client = hark.client.LocalClient(
+            hark.context.Context(self.tempdir))
+        self.image = Image(driver='virtualbox', guest='debian-8', version=1)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tempdir)
+
+    def _response(self, data):
+        import io
+        resp = MagicMock()
+        resp.headers = {'Content-Length': str(len(data))}
+        resp.raw = io.BytesIO(data)
+        return resp
+
+    @patch('requests.get')
+    def test_verified(self, mockGet):
+        import hashlib
+        mockGet.return_value = self._response(b'an image')
+        digest = hashlib.sha256(b'an image').hexdigest()
+
+        self.client.saveImageFromUrl(self.image, 'http://x', sha256=digest)
+
+        cache = self.client._context.image_cache()
+        assert self.client.hasImage(self.image)
+        assert cache.entry(self.image)['sha256'] == digest
+        assert not os.path.exists(cache.partial_path(self.image))
+
+    @patch('requests.get')
+    def test_mismatch(self, mockGet):
+        mockGet.return_value = self._response(b'an image')
+
+        self.assertRaises(
+            hark.exceptions.ChecksumMismatch,
+            self.client.saveImageFromUrl, self.image, 'http://x',
+            sha256='0' * 64)
+
+        cache = self.client._context.image_cache()
+        assert not self.client.hasImage(self.image)
+        assert os.listdir(cache.path) == []
+
+
 class TestImagestoreClient(TestCase):
 
     def test_full_url(self):
@@ -121,6 +267,25 @@ class TestImagestoreClient(TestCase):
         expectUrlCall = '/image/Debian-8/virtualbox/1'
         mockGet.assert_called_with(expectUrlCall)
 
+    @patch('hark.client.ImagestoreClient._get')
+    def test_image_info_compression(self, mockGet):
+        client = hark.client.ImagestoreClient('example.com')
+        im = Image(driver='virtualbox', guest='Debian-8', version='1')
+
+        mockGet.return_value = {'url': 'http://blah.com/1.vmdk.xz?sig=a'}
+        info = client.image_info(im, compression=['xz', 'gz'])
+        assert info['compression'] == 'xz'
+        mockGet.assert_called_with(
+            '/image/Debian-8/virtualbox/1?compression=xz,gz')
+
+        mockGet.return_value = {
+            'url': 'http://blah.com/1', 'compression': 'gz'}
+        assert client.image_info(im, compression=['gz'])['compression'] == \
+            'gz'
+
+        mockGet.return_value = {'url': 'http://blah.com/1.vmdk'}
+        assert client.image_info(im)['compression'] is None
+
     @patch('requests.session')
     def test_get(self, mockSession):
         client = hark.client.ImagestoreClient('example.com')
@@ -134,3 +299,115 @@ class TestImagestoreClient(TestCase):
         res = client._get('images')
 
         assert res == expect
+
+    def test_adapter(self):
+        client = hark.client.ImagestoreClient('http://example.com', retries=5)
+        adapter = client.session.get_adapter('http://example.com/images')
+        assert adapter.max_retries.total == 5
+        assert 503 in adapter.max_retries.status_forcelist
+
+
+class TestImagestoreClientCatalogCache(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tempdir)
+
+    def _response(self, status_code, body=None, headers=None):
+        resp = MagicMock()
+        resp.status_code = status_code
+        resp.headers = headers or {}
+        resp.json.return_value = body
+        return resp
+
+    def _client(self):
+        return hark.client.ImagestoreClient(
+            'example.com', cache_dir=self.tempdir)
+
+    @patch('requests.session')
+    def test_fresh(self, mockSession):
+        client = self._client()
+        session = mockSession.return_value
+        session.get.return_value = self._response(
+            200, ['a'], {'Cache-Control': 'max-age=60', 'ETag': '"1"'})
+
+        assert client._get('images') == ['a']
+        assert client._get('images') == ['a']
+        assert session.get.call_count == 1
+
+    @patch('requests.session')
+    def test_revalidate(self, mockSession):
+        client = self._client()
+        session = mockSession.return_value
+        session.get.side_effect = [
+            self._response(200, ['a'], {'ETag': '"1"'}),
+            self._response(304),
+        ]
+
+        assert client._get('images') == ['a']
+        assert client._get('images') == ['a']
+        session.get.assert_called_with(
+            'example.com/images', headers={'If-None-Match': '"1"'},
+            timeout=hark.client.DEFAULT_TIMEOUT)
+
+    @patch('requests.session')
+    def test_no_store(self, mockSession):
+        client = self._client()
+        session = mockSession.return_value
+        session.get.return_value = self._response(
+            200, ['a'], {'Cache-Control': 'no-store', 'ETag': '"1"'})
+
+        client._get('images')
+        client._get('images')
+        session.get.assert_called_with(
+            'example.com/images', headers={},
+            timeout=hark.client.DEFAULT_TIMEOUT)
+
+    @patch('requests.session')
+    def test_offline(self, mockSession):
+        import requests
+        client = self._client()
+        session = mockSession.return_value
+        session.get.side_effect = [
+            self._response(200, ['a'], {'ETag': '"1"'}),
+            requests.ConnectionError('offline'),
+            requests.ConnectionError('offline'),
+        ]
+
+        assert client._get('images') == ['a']
+        assert client._get('images') == ['a']
+        self.assertRaises(requests.ConnectionError, client._get, 'other')
+
+    def test_server_error(self):
+        import http.server
+        import threading
+        import requests
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self.send_response(503)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+        server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever).start()
+        try:
+            url = 'http://127.0.0.1:%d' % server.server_address[1]
+            client = hark.client.ImagestoreClient(
+                url, cache_dir=self.tempdir, retries=1)
+            # a stale cached response, so the server is asked first
+            client.catalog_cache.put(
+                client._full_url('images'), ['a'], {}, etag='"1"')
+
+            with patch('time.sleep'):
+                assert client._get('images') == ['a']
+                self.assertRaises(
+                    requests.exceptions.RetryError, client._get, 'other')
+        finally:
+            server.shutdown()
+            server.server_close()
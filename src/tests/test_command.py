@@ -7,7 +7,9 @@ except ImportError:
     from mock import patch
 
 import hark.exceptions
-from hark.lib.command import which, Command, Result, TerminalCommand
+from hark.lib.command import (
+    batchCommands, which, Command, Result, TerminalCommand,
+)
 
 
 class TestWhich(unittest.TestCase):
@@ -84,3 +86,31 @@ class TestTerminalCommand(unittest.TestCase):
         assert ret == 1
         assert mockPopen.called_with(
             cmd, sys.stdin, sys.stdout, sys.stderr, '/tmp')
+
+
+class TestBatchCommands(unittest.TestCase):
+    def batchable(self, cmd):
+        return 2 if cmd[0] == 'modify' else None
+
+    def test_batchCommands(self):
+        cmds = [
+            ['create', 'a'],
+            ['modify', 'a', '--x', '1'],
+            ['modify', 'a', '--y', '2', '3'],
+            ['modify', 'b', '--x', '1'],
+            ['start', 'a'],
+            ['modify', 'a', '--z'],
+        ]
+        assert batchCommands(cmds, self.batchable) == [
+            ['create', 'a'],
+            ['modify', 'a', '--x', '1', '--y', '2', '3'],
+            ['modify', 'b', '--x', '1'],
+            ['start', 'a'],
+            ['modify', 'a', '--z'],
+        ]
+        # the input commands aren't mutated
+        assert cmds[1] == ['modify', 'a', '--x', '1']
+
+    def test_batchCommands_unbatchable(self):
+        cmds = [['start', 'a'], ['start', 'a']]
+        assert batchCommands(cmds, self.batchable) == cmds
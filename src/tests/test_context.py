@@ -1,7 +1,9 @@
+import hashlib
 import os
 import os.path
 import shutil
 import tempfile
+import time
 import unittest
 try:
     from unittest.mock import patch
@@ -10,8 +12,11 @@ except ImportError:
 
 from hark.context import Context
 from hark.context.imagecache import ImageCache
+from hark.exceptions import ImageNotFound
 from hark.models.image import Image
 
+BLOCK = 4096
+
 
 class TestContext(unittest.TestCase):
     def test_context(self):
@@ -42,6 +47,9 @@ class TestContext(unittest.TestCase):
             ctx = Context(d)
             ic = ctx.image_cache()
             assert isinstance(ic, ImageCache)
+            assert ic.quota is None
+
+            assert Context(d, image_quota=100).image_cache().quota == 100
         finally:
             shutil.rmtree(d)
 
@@ -55,6 +63,8 @@ class TestImageCache(unittest.TestCase):
     def tearDown(self):
         if os.path.exists(self.tempdir):
             shutil.rmtree(self.tempdir)
+        if os.path.exists(self.tempdir + '.json'):
+            os.remove(self.tempdir + '.json')
 
     def test_images(self):
         ic = ImageCache(self.tempdir)
@@ -78,12 +88,166 @@ class TestImageCache(unittest.TestCase):
         assert ic.full_image_path(im) == os.path.join(
             self.tempdir, im.file_path())
 
-    @patch('shutil.copy')
-    def test_save_from_file(self, mockCopy):
+    def test_images_stray_files(self):
+        ic = ImageCache(self.tempdir)
+        for f in ['virtualbox_debian-8_v1.vmdk', 'README', '.DS_Store',
+                  'virtualbox_debian-8_v2.vmdk.partial',
+                  'virtualbox_debian-8_v2.vmdk.partial.json']:
+            with open(os.path.join(self.tempdir, f), 'w'):
+                pass
+
+        assert ic.images() == [
+            Image(driver='virtualbox', guest='debian-8', version=1)]
+
+    def test_manifest(self):
+        ic = ImageCache(self.tempdir)
+        im = Image(driver='virtualbox', guest='debian-8', version=1)
+        with open(ic.full_image_path(im), 'wb') as f:
+            f.write(b'hello')
+        assert ic.has(im)
+
+        # a new cache instance reads the index from the manifest
+        ic = ImageCache(self.tempdir)
+        ic._load_manifest()
+        entry = ic._entries[im.file_path()]
+        assert entry['size'] == 5
+        assert entry['allocated'] == os.stat(
+            ic.full_image_path(im)).st_blocks * 512
+        assert entry['sha256'] is None
+
+        expect = hashlib.sha256(b'hello').hexdigest()
+        assert ic.checksum(im) == expect
+        assert ImageCache(self.tempdir).entry(im)['sha256'] == expect
+
+        missing = Image(driver='virtualbox', guest='debian-8', version=2)
+        assert not ic.has(missing)
+        self.assertRaises(ImageNotFound, ic.entry, missing)
+
+    @patch('os.listdir')
+    def test_images_no_rescan(self, mockListdir):
+        mockListdir.return_value = []
+        ic = ImageCache(self.tempdir)
+
+        # pretend the dir was last modified long enough ago to be trusted
+        old = time.time() - 60
+        os.utime(self.tempdir, (old, old))
+
+        ic.images()
+        ic.images()
+        assert mockListdir.call_count == 1
+
+    def test_save_from_file(self):
         ic = ImageCache(self.tempdir)
         im = Image(driver='virtualbox', guest='debian-8', version=1)
         tf = tempfile.mktemp()
+        with open(tf, 'wb') as f:
+            f.write(b'image')
+
+        try:
+            ic.saveFromFile(im, tf)
+        finally:
+            os.remove(tf)
+
+        with open(ic.full_image_path(im), 'rb') as f:
+            assert f.read() == b'image'
+        assert ic.has(im)
+        assert ic.entry(im)['size'] == 5
+
+    def _write_images(self, ic, sizes):
+        "Write images of these sizes in blocks, so that they are allocated"
+        images = []
+        for version, size in sizes:
+            im = Image(driver='virtualbox', guest='debian-8', version=version)
+            with open(ic.full_image_path(im), 'wb') as f:
+                f.write(b'x' * size * BLOCK)
+            ic.register(im)
+            images.append(im)
+        return images
+
+    def _machine(self, machine_id, guest='debian-8'):
+        return {'machine_id': machine_id, 'driver': 'virtualbox',
+                'guest': guest}
+
+    def test_touch(self):
+        ic = ImageCache(self.tempdir)
+        im, = self._write_images(ic, [(1, 5)])
+
+        ic.touch(im, machine_id='abc')
+        ic.touch(im, machine_id='abc')
 
-        ic.saveFromFile(im, tf)
+        entry = ImageCache(self.tempdir).entry(im)
+        assert entry['use_count'] == 2
+        assert entry['machines'] == ['abc']
+        assert entry['last_used'] is not None
 
-        mockCopy.assert_called_with(tf, ic.full_image_path(im))
+        # usage survives the image file being rewritten
+        with open(ic.full_image_path(im), 'wb') as f:
+            f.write(b'changed')
+        ic.register(im)
+        assert ic.entry(im)['use_count'] == 2
+
+    def test_gc(self):
+        ic = ImageCache(self.tempdir)
+        v1, v2, v3, v4 = self._write_images(
+            ic, [(1, 10), (2, 10), (3, 10), (4, 10)])
+        assert ic.allocated() == 40 * BLOCK
+
+        # v2 is the least recently used, v3 is referenced by a machine and v4
+        # is the latest version.
+        ic.touch(v1)
+        ic.touch(v3, machine_id='m3')
+        ic._entries[v2.file_path()]['last_used'] = 0
+        m3 = self._machine('m3')
+
+        assert ic.evictable([m3]) == [v2, v1]
+
+        assert ic.gc([m3], quota=30 * BLOCK, dry_run=True) == [v2]
+        assert ic.allocated() == 40 * BLOCK
+
+        assert ic.gc([m3], quota=30 * BLOCK) == [v2]
+        assert ic.images() == [v1, v3, v4]
+        assert not os.path.exists(ic.full_image_path(v2))
+
+        # without a quota everything evictable goes; once the machine is
+        # gone its image can go too
+        assert ic.gc([]) == [v1, v3]
+        assert ImageCache(self.tempdir).images() == [v4]
+
+    def test_gc_unrecorded(self):
+        ic = ImageCache(self.tempdir)
+        v1, v2, v3 = self._write_images(ic, [(1, 10), (2, 10), (3, 10)])
+
+        # a machine with no recorded usage could be using any version of
+        # its driver and guest
+        assert ic.gc([self._machine('old')]) == []
+        assert ic.images() == [v1, v2, v3]
+
+        # but not of other guests
+        assert ic.gc([self._machine('old', guest='ubuntu')]) == [v1, v2]
+
+    def test_gc_pinned(self):
+        ic = ImageCache(self.tempdir)
+        v1, v2, v3 = self._write_images(ic, [(1, 10), (2, 10), (3, 10)])
+
+        assert ic.gc([], pinned=[ic.full_image_path(v1)]) == [v2]
+        assert ic.images() == [v1, v3]
+
+    def test_gc_quota(self):
+        ic = ImageCache(self.tempdir, quota=15 * BLOCK)
+        self._write_images(ic, [(1, 10), (2, 10)])
+
+        assert len(ic.gc([])) == 1
+        # the latest version is kept even if it doesn't fit
+        assert ic.gc([], quota=0) == []
+
+    def test_gc_quota_allocated(self):
+        ic = ImageCache(self.tempdir)
+        v1, v2 = self._write_images(ic, [(1, 10), (2, 10)])
+        # v1 is mostly a hole, so uses less disk than its size
+        with open(ic.full_image_path(v1), 'r+b') as f:
+            f.truncate(1000 * BLOCK)
+        ic.register(v1)
+        assert ic.size() == 1010 * BLOCK
+
+        assert ic.gc([], quota=20 * BLOCK) == []
+        assert ic.gc([], quota=15 * BLOCK) == [v1]
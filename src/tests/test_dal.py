@@ -1,16 +1,35 @@
 import collections
 import os
 import re
+import shutil
+import sqlite3
 import tempfile
+import threading
 import unittest
 
 from hark.dal import (
     DAL,
-    InMemoryDAL
+    InMemoryDAL,
+    hark_migrations,
+    hark_schema,
+)
+from hark.exceptions import (
+    DuplicateModelException,
+    InvalidDALOption,
+    InvalidMachineException,
+    InvalidQueryConstraint,
+    UnsupportedSchemaVersion,
 )
-from hark.exceptions import InvalidQueryConstraint, DuplicateModelException
 from hark.models import SQLModel
 from hark.models.machine import Machine
+from hark.models.port_mapping import PortMapping
+
+try:
+    import asyncio
+    from hark.dal.asyncdal import AsyncDAL
+except ImportError:
+    # asyncio is new in Python 3.4
+    asyncio = None
 
 
 class MockDAL(DAL):
@@ -35,6 +54,67 @@ class TestDAL(unittest.TestCase):
         d = InMemoryDAL()
         assert not os.path.exists(d.path)
 
+    def test_init_tuning(self):
+        d = tempfile.mkdtemp()
+        try:
+            dal = DAL(os.path.join(d, 'hark.db'), synchronous='full')
+            mode = dal._db.execute('PRAGMA journal_mode;').fetchone()[0]
+            assert mode == 'wal'
+            sync = dal._db.execute('PRAGMA synchronous;').fetchone()[0]
+            # FULL is 2
+            assert sync == 2
+        finally:
+            shutil.rmtree(d)
+
+        self.assertRaises(InvalidDALOption, DAL, ':memory:', synchronous='no')
+
+
+class TestDALMigrations(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'hark.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _indexes(self, dal):
+        qr = "SELECT name FROM sqlite_master WHERE type = 'index';"
+        return set(r[0] for r in dal._db.execute(qr))
+
+    def test_migrations(self):
+        migrations = hark_migrations()
+        versions = [m[0] for m in migrations]
+        assert versions[0] == 1
+        assert versions == list(range(1, len(versions) + 1))
+
+    def test_new_db(self):
+        dal = DAL(self.path)
+        assert dal.schema_version() == hark_migrations()[-1][0]
+        assert 'port_mapping_machine_id' in self._indexes(dal)
+        assert 'network_interface_kind' in self._indexes(dal)
+
+    def test_upgrade_unversioned_db(self):
+        # a database created before migrations: schema but no user_version
+        db = sqlite3.connect(self.path)
+        db.executescript(hark_schema())
+        db.execute(
+            "INSERT INTO machine VALUES ('abc', 'foo', 'virtualbox', "
+            "'Debian-8', 512);")
+        db.commit()
+        db.close()
+
+        dal = DAL(self.path)
+        assert dal.schema_version() == hark_migrations()[-1][0]
+        assert 'port_mapping_machine_id' in self._indexes(dal)
+        assert len(dal.read(Machine)) == 1
+
+    def test_newer_db(self):
+        db = sqlite3.connect(self.path)
+        db.execute("PRAGMA user_version = 1000;")
+        db.close()
+
+        self.assertRaises(UnsupportedSchemaVersion, DAL, self.path)
+
 
 class TestDALQueries(unittest.TestCase):
     def setUp(self):
@@ -47,30 +127,72 @@ class TestDALQueries(unittest.TestCase):
             key = 'heya'
             fields = ['a', 'b']
 
-        qr = self.db._read_query(mymodel)
+        qr, bindings = self.db._read_query(mymodel)
         expect = "SELECT a, b FROM oof;"
         assert qr == expect
+        assert bindings == []
 
-        qr = self.db._read_query(mymodel, constraints=dict(a=5))
-        expect = "SELECT a, b FROM oof WHERE a = 5;"
+        qr, bindings = self.db._read_query(mymodel, constraints=dict(a=5))
+        expect = "SELECT a, b FROM oof WHERE a = ?;"
         assert qr == expect
+        assert bindings == [5]
 
-        qr = self.db._read_query(mymodel, constraints=dict(b="bleh"))
-        expect = "SELECT a, b FROM oof WHERE b = 'bleh';"
+        qr, bindings = self.db._read_query(
+            mymodel, constraints=dict(b="bleh"))
+        expect = "SELECT a, b FROM oof WHERE b = ?;"
         assert qr == expect
+        assert bindings == ["bleh"]
 
         cons = collections.OrderedDict()
         cons["a"] = 5
-        cons["b"] = "bleh"
-        qr = self.db._read_query(mymodel, constraints=cons)
-        expect = "SELECT a, b FROM oof WHERE a = 5 AND b = 'bleh';"
+        cons["b"] = None
+        qr, bindings = self.db._read_query(mymodel, constraints=cons)
+        expect = "SELECT a, b FROM oof WHERE a = ? AND b IS NULL;"
         assert qr == expect
+        assert bindings == [5]
 
         cons = {"a": {}}
         self.assertRaises(
             InvalidQueryConstraint,
             self.db._read_query, mymodel, constraints=cons)
 
+    def test_read_query_order_limit(self):
+
+        class mymodel(SQLModel):
+            table = 'oof'
+            key = 'heya'
+            fields = ['a', 'b']
+
+        qr, bindings = self.db._read_query(
+            mymodel, constraints=dict(a=5), order_by=['-b', 'a'], limit=1)
+        expect = "SELECT a, b FROM oof WHERE a = ? " \
+            "ORDER BY b DESC, a ASC LIMIT ?;"
+        assert qr == expect
+        assert bindings == [5, 1]
+
+        qr, bindings = self.db._read_query(mymodel, order_by='a')
+        expect = "SELECT a, b FROM oof ORDER BY a ASC;"
+        assert qr == expect
+        assert bindings == []
+
+        self.assertRaises(
+            InvalidQueryConstraint,
+            self.db._read_query, mymodel, order_by='c')
+
+    def test_read_query_cached(self):
+        "The SQL text only depends on which fields are constrained"
+
+        class mymodel(SQLModel):
+            table = 'oof'
+            key = 'heya'
+            fields = ['a', 'b']
+
+        qr1, b1 = self.db._read_query(mymodel, constraints=dict(a=5))
+        qr2, b2 = self.db._read_query(mymodel, constraints=dict(a=6))
+        assert qr1 is qr2
+        assert b1 == [5]
+        assert b2 == [6]
+
     def test_insert_query(self):
 
         class mymodel(SQLModel):
@@ -141,9 +263,10 @@ class TestDALQueries(unittest.TestCase):
             fields = ['answer', 'boot']
 
         instance = mymodel(answer='hi', boot='fsjdlk')
-        qr = self.db._delete_query(instance)
-        expect = "DELETE FROM bleh WHERE answer = 'hi';"
+        qr, bindings = self.db._delete_query(instance)
+        expect = "DELETE FROM bleh WHERE answer = ?;"
         assert qr == expect
+        assert bindings == ['hi']
 
         class mymodel2(SQLModel):
             table = 'bleh'
@@ -151,10 +274,21 @@ class TestDALQueries(unittest.TestCase):
             fields = ['answer', 'boot']
 
         ins = mymodel2(answer='hi', boot='blo')
-        qr = self.db._delete_query(ins)
-        expect = "DELETE FROM bleh WHERE answer = 'hi' AND boot = 'blo';"
-        expect2 = "DELETE FROM bleh WHERE boot = 'blo' AND answer = 'hi';"
+        qr, bindings = self.db._delete_query(ins)
+        expect = "DELETE FROM bleh WHERE answer = ? AND boot = ?;"
+        expect2 = "DELETE FROM bleh WHERE boot = ? AND answer = ?;"
         assert qr == expect or qr == expect2
+        assert sorted(bindings) == ['blo', 'hi']
+
+    def test_delete_where_query_empty(self):
+        class mymodel(SQLModel):
+            table = 'bleh'
+            key = 'answer'
+            fields = ['answer', 'boot']
+
+        self.assertRaises(
+            InvalidQueryConstraint,
+            self.db._delete_where_query, mymodel, {})
 
 
 class TestDALCRUD(unittest.TestCase):
@@ -185,6 +319,60 @@ class TestDALCRUD(unittest.TestCase):
         res = self.dal.read(Machine, constraints={"name": "foo"})
         assert len(res) == 1
 
+    def test_iter_read_one(self):
+        for i, name in enumerate(['b', 'c', 'a']):
+            self.dal.create(Machine.new(
+                name=name, driver='blah',
+                guest='bleh', memory_mb=512 + i))
+
+        it = self.dal.iter(Machine, order_by='name')
+        assert not isinstance(it, list)
+        assert [m['name'] for m in it] == ['a', 'b', 'c']
+
+        res = self.dal.read(Machine, order_by='-memory_mb', limit=2)
+        assert [m['name'] for m in res] == ['a', 'c']
+
+        m = self.dal.read_one(Machine, constraints={'name': 'c'})
+        assert m['memory_mb'] == 513
+
+        assert self.dal.read_one(Machine, constraints={'name': 'd'}) is None
+
+    def test_read_trusted(self):
+        "Rows are only validated on read when asked"
+        self.dal._db.execute(
+            "INSERT INTO machine VALUES ('abc', 'foo', 'blah', 'bleh', 100);")
+
+        res = self.dal.read(Machine)
+        assert len(res) == 1
+        assert isinstance(res[0], Machine)
+        assert res[0]['memory_mb'] == 100
+
+        self.assertRaises(
+            InvalidMachineException,
+            self.dal.read, Machine, validate=True)
+
+    def test_create_validates(self):
+        ins = Machine.new(
+            name='foo', driver='blah',
+            guest='bleh', memory_mb=100)
+        self.assertRaises(InvalidMachineException, self.dal.create, ins)
+        self.assertRaises(
+            InvalidMachineException, self.dal.create_many, [ins])
+        assert len(self.dal.read(Machine)) == 0
+
+    def test_create_read_quotes(self):
+        ins = Machine.new(
+            name="it's", driver='blah',
+            guest='bleh', memory_mb=512)
+        self.dal.create(ins)
+
+        res = self.dal.read(Machine, constraints={"name": "it's"})
+        assert len(res) == 1
+        assert res[0]['name'] == "it's"
+
+        self.dal.deleteWhere(Machine, {"name": "it's"})
+        assert len(self.dal.read(Machine)) == 0
+
     def test_create_read_nulls(self):
         ins = Machine.new(
             name='foo', driver=None,
@@ -245,3 +433,228 @@ class TestDALCRUD(unittest.TestCase):
         res = self.dal.read(Machine)
         assert len(res) == 1
         assert res[0]['machine_id'] == ins2['machine_id']
+
+    def test_create_many_delete_many(self):
+        machines = [
+            Machine.new(
+                name='foo%d' % i, driver='blah',
+                guest='bleh', memory_mb=512)
+            for i in range(5)
+        ]
+        mappings = [
+            PortMapping(
+                host_port=1000 + i, guest_port=22,
+                machine_id=m['machine_id'], name='ssh')
+            for i, m in enumerate(machines)
+        ]
+        self.dal.create_many(machines + mappings)
+        assert len(self.dal.read(Machine)) == 5
+        assert len(self.dal.read(PortMapping)) == 5
+
+        self.dal.delete_many(machines[:3] + mappings[1:])
+        res = self.dal.read(Machine)
+        assert set(m['name'] for m in res) == set(['foo3', 'foo4'])
+        res = self.dal.read(PortMapping)
+        assert len(res) == 1
+        assert res[0]['host_port'] == 1000
+
+    def test_create_many_dup(self):
+        existing = Machine.new(
+            name='foo', driver='blah',
+            guest='bleh', memory_mb=512)
+        self.dal.create(existing)
+
+        machines = [
+            Machine.new(
+                name=n, driver='blah',
+                guest='bleh', memory_mb=512)
+            for n in ('bar', 'foo')
+        ]
+        with self.assertRaises(DuplicateModelException) as cm:
+            self.dal.create_many(machines)
+        # the duplicate is reported, not the first of the batch
+        assert cm.exception.model['name'] == 'foo'
+
+        # nothing from the failed batch was saved
+        res = self.dal.read(Machine)
+        assert len(res) == 1
+
+    def test_create_many_generator(self):
+        self.dal.create_many(
+            Machine.new(
+                name='foo%d' % i, driver='blah',
+                guest='bleh', memory_mb=512)
+            for i in range(3))
+        assert len(self.dal.read(Machine)) == 3
+
+
+class TestDALTransaction(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'hark.db')
+        self.dal = DAL(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _other_read(self):
+        "Read machines through a second connection to the same file."
+        return DAL(self.path).read(Machine)
+
+    def test_commit(self):
+        ins = Machine.new(
+            name='foo', driver='blah',
+            guest='bleh', memory_mb=512)
+        ins2 = Machine.new(
+            name='bar', driver='blah',
+            guest='bleh', memory_mb=512)
+
+        with self.dal.transaction():
+            self.dal.create(ins)
+            # nested blocks join the outer transaction
+            with self.dal.transaction():
+                self.dal.create(ins2)
+            assert len(self._other_read()) == 0
+            assert len(self.dal.read(Machine)) == 2
+
+        assert len(self._other_read()) == 2
+
+    def test_rollback(self):
+        ins = Machine.new(
+            name='foo', driver='blah',
+            guest='bleh', memory_mb=512)
+        dup = Machine.new(
+            name='foo', driver='blah',
+            guest='bleh', memory_mb=512)
+
+        def create():
+            with self.dal.transaction():
+                self.dal.create(ins)
+                self.dal.create(dup)
+
+        self.assertRaises(DuplicateModelException, create)
+        assert len(self.dal.read(Machine)) == 0
+        assert self.dal._transaction_depth == 0
+
+
+class TracingDAL(DAL):
+    """
+    A DAL which records the statements it runs, and whose reads can be held
+    up until an event is set, so that requests queue into one batch.
+    """
+    statements = []
+    reads = []
+    reading = threading.Event()
+    proceed = threading.Event()
+
+    def _connect(self):
+        DAL._connect(self)
+        self._db.set_trace_callback(self.statements.append)
+
+    def read(self, cls, *args, **kwargs):
+        self.reading.set()
+        self.proceed.wait()
+        self.reads.append(cls)
+        return DAL.read(self, cls, *args, **kwargs)
+
+
+@unittest.skipIf(asyncio is None, 'asyncio is not available')
+class TestAsyncDAL(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.dir = tempfile.mkdtemp()
+        self.dal = AsyncDAL(
+            os.path.join(self.dir, 'hark.db'), loop=self.loop)
+
+    def tearDown(self):
+        self.dal.close()
+        self.loop.close()
+        shutil.rmtree(self.dir)
+
+    def _wait(self, *futures):
+        return self.loop.run_until_complete(asyncio.gather(*futures))
+
+    def _machine(self, name):
+        return Machine.new(
+            name=name, driver='blah',
+            guest='bleh', memory_mb=512)
+
+    def test_create_read(self):
+        machines = [self._machine('foo%d' % i) for i in range(10)]
+        self._wait(*[self.dal.create(m) for m in machines])
+
+        res, one = self._wait(
+            self.dal.read(Machine),
+            self.dal.read_one(Machine, constraints={'name': 'foo3'}))
+        assert len(res) == 10
+        assert one == machines[3]
+
+    def test_read_after_write(self):
+        "Requests in a batch run in order"
+        m = self._machine('foo')
+        before, _, after, _, deleted = self._wait(
+            self.dal.read(Machine),
+            self.dal.create(m),
+            self.dal.read(Machine),
+            self.dal.delete(m),
+            self.dal.read(Machine))
+        assert before == []
+        assert after == [m]
+        assert deleted == []
+
+    def test_failed_write(self):
+        "A failed write doesn't affect the rest of its batch"
+        dup = self.dal.create(self._machine('foo'))
+        futures = [
+            self.dal.create(self._machine('bar')),
+            self.dal.create(self._machine('foo')),
+            self.dal.create(self._machine('baz')),
+        ]
+        self._wait(dup)
+        self.loop.run_until_complete(
+            asyncio.wait(futures))
+
+        assert futures[0].exception() is None
+        assert isinstance(futures[1].exception(), DuplicateModelException)
+        assert futures[2].exception() is None
+
+        res, = self._wait(self.dal.read(Machine))
+        assert set(m['name'] for m in res) == set(['foo', 'bar', 'baz'])
+
+    def test_batch(self):
+        "A batch commits once, and identical reads in it run once"
+        self.dal.close()
+        TracingDAL.reading.clear()
+        TracingDAL.proceed.clear()
+        self.dal = AsyncDAL(
+            os.path.join(self.dir, 'hark.db'), loop=self.loop,
+            dal_class=TracingDAL)
+
+        # hold the worker up in a read while the rest queue behind it
+        first = self.dal.read(PortMapping)
+        TracingDAL.reading.wait()
+        del TracingDAL.statements[:]
+        del TracingDAL.reads[:]
+        futures = [
+            self.dal.read(Machine),
+            self.dal.read(Machine),
+            self.dal.create(self._machine('foo')),
+            self.dal.create(self._machine('bar')),
+            self.dal.read(Machine),
+        ]
+        TracingDAL.proceed.set()
+        self._wait(first)
+        before, again, _, _, after = self._wait(*futures)
+
+        assert before == again == []
+        assert len(after) == 2
+        assert TracingDAL.reads == [PortMapping, Machine, Machine]
+        commits = [s for s in TracingDAL.statements if s.startswith('COMMIT')]
+        # one for the first batch, and one for the rest
+        assert len(commits) == 2
+
+    def test_close(self):
+        f = self.dal.create(self._machine('foo'))
+        self.dal.close()
+        self._wait(f)
+        self.assertRaises(RuntimeError, self.dal.read, Machine)
@@ -83,3 +83,385 @@ class TestDriverBase(unittest.TestCase):
         d.waitStatus(RUNNING, interval_ms=1)
 
         mockStatus.assert_has_calls([call(), call(), call()])
+
+    @patch('time.sleep')
+    @patch('hark.driver.virtualbox.Driver.status')
+    def testWaitStatusTimeout(self, mockStatus, mockSleep):
+        from hark.driver.status import RUNNING, STOPPED
+        mockStatus.return_value = STOPPED
+        d = hark.driver.virtualbox.Driver({'name': 'hi', 'guest': 'Debian-8'})
+
+        with patch('time.monotonic') as mockTime:
+            mockTime.side_effect = [0, 1, 3, 6, 11]
+            self.assertRaises(
+                hark.exceptions.WaitTimeout,
+                d.waitStatus, RUNNING, timeout=10,
+                interval_ms=1000, max_interval_ms=4000)
+
+        # backs off, with jitter, up to the max interval
+        sleeps = [c[0][0] for c in mockSleep.call_args_list]
+        assert len(sleeps) == 3
+        assert 0.5 <= sleeps[0] <= 1
+        assert 1 <= sleeps[1] <= 2
+        assert 2 <= sleeps[2] <= 4
+
+    @patch('time.sleep')
+    @patch('hark.driver.virtualbox.Driver._run')
+    @patch('hark.driver.virtualbox.Driver.status')
+    def testWaitStatusEvents(self, mockStatus, mockRun, mockSleep):
+        from hark.driver.status import RUNNING, STOPPED
+        from hark.lib.command import Result
+        mockRun.return_value = Result([], 0, b'Value: 7.0.10\n', b'')
+        mockStatus.side_effect = [RUNNING, RUNNING, STOPPED]
+        d = hark.driver.virtualbox.Driver({'name': 'hi', 'guest': 'Debian-8'})
+        d.waitStatus(STOPPED, timeout=30)
+
+        # with Guest Additions it waits on guest properties between polls
+        # rather than sleeping, for no longer than the longest poll interval
+        cmds = [c[0][0] for c in mockRun.call_args_list]
+        assert cmds == [
+            ['guestproperty', 'get', 'hi', '/VirtualBox/GuestAdd/Version'],
+            ['guestproperty', 'wait', 'hi', '*', '--timeout', '1000'],
+            ['guestproperty', 'wait', 'hi', '*', '--timeout', '1000'],
+        ]
+        assert not mockSleep.called
+
+        # and falls back to sleeping if the event source fails
+        mockRun.reset_mock()
+        mockRun.side_effect = OSError('no VBoxManage')
+        mockStatus.side_effect = [RUNNING, STOPPED]
+        d.waitStatus(STOPPED)
+        assert mockRun.call_count == 1
+        assert mockSleep.call_count == 1
+
+    @patch('time.sleep')
+    @patch('hark.driver.virtualbox.Driver._run')
+    @patch('hark.driver.virtualbox.Driver.status')
+    def testWaitStatusNoGuestAdditions(self, mockStatus, mockRun, mockSleep):
+        from hark.driver.status import RUNNING, STOPPED
+        from hark.lib.command import Result
+        mockRun.return_value = Result([], 0, b'No value set!\n', b'')
+        mockStatus.side_effect = [RUNNING, RUNNING, RUNNING, STOPPED]
+        d = hark.driver.virtualbox.Driver({'name': 'hi', 'guest': 'Debian-8'})
+        d.waitStatus(STOPPED, timeout=30)
+
+        # nothing would change a guest property, so it polls, with backoff
+        mockRun.assert_called_once_with(
+            ['guestproperty', 'get', 'hi', '/VirtualBox/GuestAdd/Version'])
+        sleeps = [c[0][0] for c in mockSleep.call_args_list]
+        assert len(sleeps) == 3
+        assert sleeps[2] <= 0.4
+
+
+class TestStatuses(unittest.TestCase):
+    @patch('hark.lib.platform.platform')
+    @patch('hark.driver.qemu.Driver.statuses')
+    @patch('hark.driver.virtualbox.Driver.statuses')
+    def testStatuses(self, mockVbox, mockQemu, mockPlatform):
+        from hark.driver.status import RUNNING, STOPPED
+        mockPlatform.return_value = 'linux'
+        mockVbox.return_value = {'a': RUNNING, 'c': STOPPED}
+        mockQemu.return_value = {'b': STOPPED}
+        machines = [
+            {'name': 'a', 'driver': 'virtualbox'},
+            {'name': 'b', 'driver': 'qemu'},
+            {'name': 'c', 'driver': 'virtualbox'},
+        ]
+
+        res = hark.driver.statuses(machines, state_dir='/machines')
+
+        assert res == {'a': RUNNING, 'b': STOPPED, 'c': STOPPED}
+        mockVbox.assert_called_once_with(
+            [machines[0], machines[2]], state_dir='/machines')
+        mockQemu.assert_called_once_with(
+            [machines[1]], state_dir='/machines')
+
+
+def _vboxmanage(vms=None, fail=()):
+    """
+    Return a side effect for a mocked Driver._run, which keeps a dict of
+    registered VM name -> showvminfo values up to date as VMs are created,
+    given disks and snapshots, and unregistered, and answers showvminfo from
+    it. Commands starting with any of fail fail.
+    """
+    from hark.lib.command import Command, Result
+    if vms is None:
+        vms = {}
+
+    def showvminfo(info):
+        lines = [
+            ('"%s"="%s"' if '-' in k else '%s="%s"') % (k, v)
+            for k, v in sorted(info.items())
+        ]
+        return ''.join(line + '\n' for line in lines).encode('utf-8')
+
+    def run(cmd):
+        stdout = b''
+        fail_with = None
+        if any(cmd[:len(f)] == f for f in fail):
+            fail_with = b'failed'
+        elif cmd[0] == 'createvm':
+            vms[cmd[2]] = {'name': cmd[2]}
+        elif cmd[0] == 'showvminfo':
+            if cmd[1] not in vms:
+                fail_with = b'Could not find a registered machine'
+            else:
+                stdout = showvminfo(vms[cmd[1]])
+        elif cmd[1] in vms:
+            info = vms[cmd[1]]
+            if cmd[0] == 'storageattach':
+                info['sata1-0-0'] = cmd[cmd.index('--medium') + 1]
+            elif cmd[:3] == ['snapshot', cmd[1], 'take']:
+                info['SnapshotName'] = cmd[3]
+            elif cmd[:3] == ['snapshot', cmd[1], 'delete']:
+                del info['SnapshotName']
+            elif cmd[0] == 'unregistervm':
+                del vms[cmd[1]]
+        if fail_with is not None:
+            raise hark.exceptions.CommandFailed(
+                Command(cmd), Result(cmd, 1, b'', fail_with))
+        return Result(cmd, 0, stdout, b'')
+    return run
+
+
+class TestVirtualBoxDriver(unittest.TestCase):
+    def setUp(self):
+        self.machine = hark.models.machine.Machine.new(
+            name='hi', driver='virtualbox', guest='Debian-8', memory_mb=512)
+        self.driver = hark.driver.virtualbox.Driver(self.machine)
+
+    @patch('hark.driver.virtualbox.Driver._run')
+    def testStatuses(self, mockRun):
+        from hark.driver.status import (
+            ABORTED, MISSING, PAUSED, RUNNING, STOPPED)
+        from hark.lib.command import Result
+        since = ' (since 2016-01-01T00:00:00.000000000)'
+        listing = '\n'.join([
+            'Name:            hi',
+            'UUID:            0c8e8e0c-7f5e-4a6a-9b0b-1c2d3e4f5a6b',
+            'State:           powered off' + since,
+            "Name: 'share', Host path: '/tmp' (machine mapping), writable",
+            '',
+            'Name:            my "quoted" vm',
+            'State:           running' + since,
+            '',
+            'Name:            stopping',
+            'State:           paused' + since,
+            '',
+            'Name:            crashed',
+            'State:           aborted' + since,
+            '',
+            'Name:            other',
+            'State:           saved' + since,
+            '',
+        ]).encode('utf-8')
+        mockRun.return_value = Result([], 0, listing, b'')
+
+        machines = [
+            {'name': 'hi'}, {'name': 'my "quoted" vm'}, {'name': 'stopping'},
+            {'name': 'crashed'}, {'name': 'gone'}]
+        res = hark.driver.virtualbox.Driver.statuses(machines)
+
+        assert res == {
+            'hi': STOPPED, 'my "quoted" vm': RUNNING, 'stopping': PAUSED,
+            'crashed': ABORTED, 'gone': MISSING}
+        mockRun.assert_called_once_with(['list', '--long', 'vms'])
+
+        # as with status(), a state hark doesn't know is an error
+        self.assertRaises(
+            hark.exceptions.UnrecognisedMachineState,
+            hark.driver.virtualbox.Driver.statuses, [{'name': 'other'}])
+
+    @patch('hark.driver.virtualbox.Driver.host_only_interface')
+    @patch('hark.driver.virtualbox.Driver._run')
+    def testCreate(self, mockRun, mockHostOnly):
+        mockHostOnly.return_value = 'vboxnet0'
+
+        self.driver.create('/images/base.vmdk', None)
+
+        cmds = [c[0][0] for c in mockRun.call_args_list]
+        assert [c[0] for c in cmds] == [
+            'createvm', 'modifyvm', 'storagectl', 'storageattach']
+        modify = cmds[1]
+        assert modify[:2] == ['modifyvm', 'hi']
+        for flag in ['--ostype', '--acpi', '--ioapic', '--memory', '--nic1',
+                     '--nic2', '--hostonlyadapter2', '--nictype1',
+                     '--nictype2']:
+            assert flag in modify
+        assert modify[modify.index('--memory') + 1] == '512'
+
+    @patch('hark.driver.virtualbox.Driver._run')
+    def testSetPortMappings(self, mockRun):
+        from hark.models.port_mapping import PortMapping
+        mappings = [
+            PortMapping(
+                host_port=p, guest_port=22, name='ssh%d' % p,
+                machine_id=self.machine['machine_id'])
+            for p in (2222, 2223)
+        ]
+
+        self.driver.setPortMappings(mappings)
+
+        mockRun.assert_called_once_with([
+            'modifyvm', 'hi',
+            '--natpf1', mappings[0].format_virtualbox(),
+            '--natpf1', mappings[1].format_virtualbox(),
+        ])
+
+    @patch('hark.driver.virtualbox.Driver.host_only_interface')
+    @patch('hark.driver.virtualbox.Driver._run')
+    def testCreateLinkedClone(self, mockRun, mockHostOnly):
+        from hark.dal import InMemoryDAL
+        from hark.driver.virtualbox.golden import golden_images
+        mockHostOnly.return_value = 'vboxnet0'
+        mockRun.side_effect = _vboxmanage()
+        dal = InMemoryDAL()
+
+        self.driver.create('/images/base.vmdk', dal, linked_clone=True)
+
+        cmds = [c[0][0] for c in mockRun.call_args_list]
+        golden = cmds[0][1]
+        assert golden.startswith('hark-golden-base-')
+        assert [c[:2] for c in cmds] == [
+            ['showvminfo', golden],
+            ['createvm', '--name'],
+            ['modifyvm', golden],
+            ['storagectl', golden],
+            ['storageattach', golden],
+            ['snapshot', golden],
+            ['clonevm', golden],
+            ['modifyvm', 'hi'],
+        ]
+        assert cmds[6][2:] == [
+            '--snapshot', 'hark-base', '--options', 'link',
+            '--name', 'hi', '--register']
+        assert '--memory' in cmds[7]
+        assert golden_images(dal) == ['/images/base.vmdk']
+
+        # the next machine is only a clone of the same golden VM
+        mockRun.reset_mock()
+        m = hark.models.machine.Machine.new(
+            name='ho', driver='virtualbox', guest='Debian-8', memory_mb=512)
+        hark.driver.virtualbox.Driver(m).create(
+            '/images/base.vmdk', dal, linked_clone=True)
+
+        cmds = [c[0][0] for c in mockRun.call_args_list]
+        assert [c[:2] for c in cmds] == [
+            ['showvminfo', golden], ['clonevm', golden], ['modifyvm', 'ho']]
+
+    @patch('hark.driver.virtualbox.Driver._run')
+    def testGoldenPoolAdopt(self, mockRun):
+        from hark.dal import InMemoryDAL
+        from hark.driver.virtualbox.golden import _golden_name
+        name = _golden_name('/images/base.vmdk')
+        mockRun.side_effect = _vboxmanage({
+            name: {'name': name, 'SnapshotName': 'hark-base'}})
+        pool = self.driver.golden_pool(InMemoryDAL())
+
+        # a complete golden VM left by a rolled back transaction is reused
+        assert pool.get('/images/base.vmdk') == name
+        cmds = [c[0][0] for c in mockRun.call_args_list]
+        assert [c[0] for c in cmds] == ['showvminfo']
+        assert pool.images() == ['/images/base.vmdk']
+
+    @patch('hark.driver.virtualbox.Driver._run')
+    def testGoldenPoolIncomplete(self, mockRun):
+        from hark.dal import InMemoryDAL
+        from hark.driver.virtualbox.golden import _golden_name
+        name = _golden_name('/images/base.vmdk')
+        mockRun.side_effect = _vboxmanage({name: {'name': name}})
+        pool = self.driver.golden_pool(InMemoryDAL())
+
+        # one without its snapshot is removed and created again
+        assert pool.get('/images/base.vmdk') == name
+        cmds = [c[0][0] for c in mockRun.call_args_list]
+        assert [c[0] for c in cmds[:4]] == [
+            'showvminfo', 'storageattach', 'unregistervm', 'createvm']
+        assert cmds[-1] == ['snapshot', name, 'take', 'hark-base']
+
+    @patch('hark.driver.virtualbox.Driver._run')
+    def testGoldenPoolCreateFails(self, mockRun):
+        from hark.dal import InMemoryDAL
+        mockRun.side_effect = _vboxmanage(fail=[['snapshot']])
+        pool = self.driver.golden_pool(InMemoryDAL())
+
+        self.assertRaises(
+            hark.exceptions.CommandFailed, pool.get, '/images/base.vmdk')
+
+        # the partial VM is removed, without deleting the base image
+        cmds = [c[0][0] for c in mockRun.call_args_list]
+        assert cmds[-2][-2:] == ['--medium', 'none']
+        assert cmds[-1][0] == 'unregistervm'
+        assert pool.images() == []
+
+    @patch('hark.driver.virtualbox.Driver._run')
+    def testGoldenPoolPrune(self, mockRun):
+        from hark.dal import InMemoryDAL
+        from hark.driver.virtualbox.golden import _golden_name
+        vms = {}
+        mockRun.side_effect = _vboxmanage(vms)
+        dal = InMemoryDAL()
+        pool = self.driver.golden_pool(dal)
+        pool.get('/images/a.vmdk')
+        pool.get('/images/b.vmdk')
+
+        # VirtualBox won't delete the snapshot of b, which has clones
+        b = _golden_name('/images/b.vmdk')
+        mockRun.side_effect = _vboxmanage(vms, fail=[['snapshot', b]])
+
+        assert hark.driver.prune_golden_vms(dal) == ['/images/a.vmdk']
+        assert pool.images() == ['/images/b.vmdk']
+        assert hark.driver.pinned_images(dal) == ['/images/b.vmdk']
+
+    @patch('hark.driver.virtualbox.Driver._run')
+    def testGoldenPoolRemove(self, mockRun):
+        from hark.dal import InMemoryDAL
+        mockRun.side_effect = _vboxmanage()
+        dal = InMemoryDAL()
+        pool = self.driver.golden_pool(dal)
+        golden = pool.get('/images/base.vmdk')
+        mockRun.reset_mock()
+
+        pool.remove('/images/base.vmdk')
+
+        cmds = [c[0][0] for c in mockRun.call_args_list]
+        assert cmds[0][:2] == ['showvminfo', golden]
+        assert cmds[1] == ['snapshot', golden, 'delete', 'hark-base']
+        assert cmds[2][-2:] == ['--medium', 'none']
+        assert cmds[3] == ['unregistervm', golden, '--delete']
+        assert pool.images() == []
+
+    @patch('hark.driver.virtualbox.Driver._run')
+    def testGoldenPoolRemoveFails(self, mockRun):
+        from hark.dal import InMemoryDAL
+        vms = {}
+        mockRun.side_effect = _vboxmanage(vms)
+        dal = InMemoryDAL()
+        pool = self.driver.golden_pool(dal)
+        golden = pool.get('/images/base.vmdk')
+
+        mockRun.side_effect = _vboxmanage(vms, fail=[['unregistervm']])
+        self.assertRaises(
+            hark.exceptions.CommandFailed, pool.remove, '/images/base.vmdk')
+
+        # the VM is still registered, so its image stays pinned
+        assert hark.driver.pinned_images(dal) == ['/images/base.vmdk']
+
+        # and without its snapshot, it is replaced rather than cloned from
+        mockRun.side_effect = _vboxmanage(vms)
+        mockRun.reset_mock()
+        assert pool.get('/images/base.vmdk') == golden
+        cmds = [c[0][0] for c in mockRun.call_args_list]
+        assert 'createvm' in [c[0] for c in cmds]
+        assert pool.images() == ['/images/base.vmdk']
+
+        # removing it again picks up where the failed remove left off
+        mockRun.side_effect = _vboxmanage(vms, fail=[['unregistervm']])
+        self.assertRaises(
+            hark.exceptions.CommandFailed, pool.remove, '/images/base.vmdk')
+        mockRun.side_effect = _vboxmanage(vms)
+        mockRun.reset_mock()
+        pool.remove('/images/base.vmdk')
+        cmds = [c[0][0] for c in mockRun.call_args_list]
+        assert [c[0] for c in cmds] == ['showvminfo', 'unregistervm']
+        assert pool.images() == []
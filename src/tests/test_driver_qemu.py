@@ -0,0 +1,272 @@
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+import hark.driver
+import hark.driver.qemu
+from hark.driver.qemu.qmp import QMPClient
+import hark.driver.status
+import hark.exceptions
+import hark.models.machine
+from hark.models.port_mapping import PortMapping
+
+
+class FakeQMP(object):
+    """
+    A QMP server on a unix socket which answers each command from a dict of
+    command name -> reply, and sends any events queued for a command first.
+    """
+
+    def __init__(self, path, replies, events=None):
+        self.path = path
+        self.replies = replies
+        self.events = events or {}
+        self.commands = []
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(5)
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _send(self, f, msg):
+        f.write(json.dumps(msg).encode('utf-8') + b'\n')
+        f.flush()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with conn, conn.makefile('rwb') as f:
+                self._send(f, {'QMP': {'version': {}, 'capabilities': []}})
+                for line in f:
+                    cmd = json.loads(line.decode('utf-8'))
+                    name = cmd['execute']
+                    self.commands.append(cmd)
+                    for e in self.events.get(name, []):
+                        self._send(f, e)
+                    reply = self.replies.get(name, {'return': {}})
+                    self._send(f, reply)
+
+    def close(self):
+        self.sock.close()
+
+
+class TestQemuDriver(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.machine = hark.models.machine.Machine.new(
+            name='hi', driver='qemu', guest='Debian-8', memory_mb=512)
+        self.driver = hark.driver.qemu.Driver(self.machine, state_dir=self.dir)
+        self.qmp_server = None
+
+    def tearDown(self):
+        if self.qmp_server is not None:
+            self.qmp_server.close()
+        shutil.rmtree(self.dir)
+
+    def _serve(self, replies=None, events=None):
+        if not os.path.exists(self.driver.machine_dir()):
+            os.makedirs(self.driver.machine_dir())
+        self.qmp_server = FakeQMP(
+            self.driver.qmp_path(), replies or {}, events)
+        return self.qmp_server
+
+    def _create(self):
+        with patch('hark.driver.qemu.Driver._run') as mockRun:
+            self.driver.create('/images/qemu_Debian-8_v1.qcow2', None)
+        return mockRun
+
+    @patch('hark.lib.platform.platform')
+    def testGetDriver(self, mockPlatform):
+        mockPlatform.return_value = 'linux'
+        d = hark.driver.get_driver('qemu', self.machine, state_dir=self.dir)
+        assert isinstance(d, hark.driver.qemu.Driver)
+        assert d.machine_dir() == os.path.join(self.dir, 'hi')
+
+    def testCreate(self):
+        mockRun = self._create()
+
+        mockRun.assert_called_once_with([
+            'qemu-img', 'create', '-f', 'qcow2',
+            '-b', '/images/qemu_Debian-8_v1.qcow2', '-F', 'qcow2',
+            os.path.join(self.dir, 'hi', 'disk.qcow2'),
+        ])
+
+    def testCreateFails(self):
+        with patch('hark.driver.qemu.Driver._run') as mockRun:
+            mockRun.side_effect = OSError('no qemu-img')
+            self.assertRaises(
+                OSError, self.driver.create, '/images/base.vmdk', None)
+        assert not os.path.exists(self.driver.machine_dir())
+
+    @patch('hark.driver.qemu.kvmAvailable')
+    def testStartCommand(self, mockKvm):
+        self._create()
+        self.driver.setPortMappings([PortMapping(
+            host_port=2222, guest_port=22, name='ssh',
+            machine_id=self.machine['machine_id'])])
+
+        mockKvm.return_value = True
+        cmd = self.driver._startCommand()
+        assert cmd[0] == 'qemu-system-x86_64'
+        assert cmd[cmd.index('-m') + 1] == '512'
+        assert cmd[cmd.index('-netdev') + 1] == \
+            'user,id=net0,hostfwd=tcp:127.0.0.1:2222-:22'
+        assert cmd[cmd.index('-accel') + 1] == 'kvm'
+        assert cmd[cmd.index('-display') + 1] == 'none'
+
+        mockKvm.return_value = False
+        cmd = self.driver._startCommand(gui=True)
+        assert cmd[cmd.index('-accel') + 1] == 'tcg'
+        assert cmd[cmd.index('-display') + 1] == 'gtk'
+
+    def testStatusStopped(self):
+        self._create()
+        assert self.driver.status() == hark.driver.status.STOPPED
+
+        # a pidfile left by a qemu which has exited
+        import subprocess
+        p = subprocess.Popen(['true'])
+        p.wait()
+        with open(self.driver.pid_path(), 'w') as f:
+            f.write('%d\n' % p.pid)
+        assert self.driver.status() == hark.driver.status.STOPPED
+
+    def testStatusMissing(self):
+        assert self.driver.status() == hark.driver.status.MISSING
+        # removing a machine which is already gone is fine
+        self.driver.remove()
+
+    def testStatusNoSocket(self):
+        # qemu is running, but its QMP socket isn't there
+        self._create()
+        with open(self.driver.pid_path(), 'w') as f:
+            f.write('%d\n' % os.getpid())
+        self.assertRaises(FileNotFoundError, self.driver.status)
+        self.assertRaises(FileNotFoundError, self.driver.remove)
+        assert os.path.exists(self.driver.machine_dir())
+
+    def testStatusTimeout(self):
+        # qemu is too busy to answer; a busy machine isn't a stopped one
+        self._create()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.driver.qmp_path())
+        sock.listen(1)
+        self.driver.qmpTimeout = 0.05
+        try:
+            self.assertRaises(socket.timeout, self.driver.status)
+            self.assertRaises(socket.timeout, self.driver.remove)
+        finally:
+            sock.close()
+        assert os.path.exists(self.driver.machine_dir())
+
+    def testStatus(self):
+        self._serve({'query-status': {
+            'return': {'status': 'running', 'running': True}}})
+        assert self.driver.status() == hark.driver.status.RUNNING
+
+        self.qmp_server.replies['query-status'] = {
+            'return': {'status': 'paused', 'running': False}}
+        assert self.driver.status() == hark.driver.status.PAUSED
+
+        self.qmp_server.replies['query-status'] = {
+            'return': {'status': 'weird', 'running': False}}
+        self.assertRaises(
+            hark.exceptions.UnrecognisedMachineState, self.driver.status)
+
+    def testStatuses(self):
+        self._create()
+        gone = hark.models.machine.Machine.new(
+            name='gone', driver='qemu', guest='Debian-8', memory_mb=512)
+
+        res = hark.driver.qemu.Driver.statuses(
+            [self.machine, gone], state_dir=self.dir)
+        assert res == {
+            'hi': hark.driver.status.STOPPED,
+            'gone': hark.driver.status.MISSING,
+        }
+
+    def testStop(self):
+        server = self._serve()
+        self.driver.stop()
+        assert [c['execute'] for c in server.commands] == [
+            'qmp_capabilities', 'system_powerdown']
+
+    def testWaitChange(self):
+        running = {'return': {'status': 'running', 'running': True}}
+        server = self._serve(
+            {'query-status': running},
+            events={'query-status': [{'event': 'SHUTDOWN'}]})
+
+        assert not self.driver.waitChange(hark.driver.status.STOPPED, 1)
+        assert self.driver.waitChange(hark.driver.status.RUNNING, 1)
+        assert [c['execute'] for c in server.commands] == [
+            'qmp_capabilities', 'query-status']
+
+        # the state changed before it connected
+        server.events = {}
+        assert self.driver.waitChange(hark.driver.status.PAUSED, 1)
+
+    def testSetPortMappingsRunning(self):
+        self._create()
+        server = self._serve({'query-status': {
+            'return': {'status': 'running', 'running': True}}})
+
+        self.driver.setPortMappings([PortMapping(
+            host_port=2222, guest_port=22, name='ssh',
+            machine_id=self.machine['machine_id'])])
+
+        assert server.commands[-1] == {
+            'execute': 'human-monitor-command',
+            'arguments': {
+                'command-line': 'hostfwd_add tcp:127.0.0.1:2222-:22'},
+        }
+
+    def testRemove(self):
+        self._create()
+        self.driver.remove()
+        assert not os.path.exists(self.driver.machine_dir())
+
+
+class TestQMPClient(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'qmp.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testEvents(self):
+        powerdown = {'event': 'POWERDOWN', 'timestamp': {}}
+        server = FakeQMP(
+            self.path, {'query-name': {'return': {'name': 'hi'}}},
+            events={'query-name': [powerdown]})
+        try:
+            with QMPClient(self.path) as q:
+                assert q.execute('query-name') == {'name': 'hi'}
+                assert q.waitEvent(['POWERDOWN'], timeout=1) == powerdown
+                assert q.waitEvent(['SHUTDOWN'], timeout=0.01) is None
+        finally:
+            server.close()
+
+    def testError(self):
+        server = FakeQMP(self.path, {'stop': {
+            'error': {'class': 'GenericError', 'desc': 'nope'}}})
+        try:
+            with QMPClient(self.path) as q:
+                self.assertRaises(hark.exceptions.QMPError, q.execute, 'stop')
+        finally:
+            server.close()
+
+    def testNotListening(self):
+        self.assertRaises(OSError, QMPClient(self.path).connect)
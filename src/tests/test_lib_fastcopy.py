@@ -0,0 +1,122 @@
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from hark.lib.fastcopy import copyFile
+
+
+class TestCopyFile(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.dir, 'source')
+        self.dest = os.path.join(self.dir, 'dest')
+        self.data = os.urandom(1024 * 1024 + 17)
+        with open(self.source, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _dest_data(self):
+        with open(self.dest, 'rb') as f:
+            return f.read()
+
+    def test_copy(self):
+        res = copyFile(self.source, self.dest)
+        assert self._dest_data() == self.data
+        assert os.path.exists(self.source)
+        assert not os.path.samefile(self.source, self.dest)
+        assert res.size == len(self.data)
+        assert res.strategy in (
+            'reflink', 'sparse', 'copy_file_range', 'sendfile', 'userspace')
+
+    @patch('fcntl.ioctl')
+    def test_copy_fallback(self, mockIoctl):
+        mockIoctl.side_effect = OSError(errno.EOPNOTSUPP, 'not supported')
+        unsupported = OSError(errno.EXDEV, 'cross-device')
+
+        with patch('os.copy_file_range', side_effect=unsupported, create=True):
+            with patch('os.sendfile', side_effect=unsupported):
+                res = copyFile(self.source, self.dest)
+
+        assert res.strategy == 'userspace'
+        assert self._dest_data() == self.data
+
+    def test_link(self):
+        res = copyFile(self.source, self.dest, mode='link')
+        assert res.strategy == 'hardlink'
+        assert os.path.samefile(self.source, self.dest)
+
+    @patch('os.link')
+    def test_link_fallback(self, mockLink):
+        mockLink.side_effect = OSError(errno.EXDEV, 'cross-device')
+        res = copyFile(self.source, self.dest, mode='link')
+        assert res.strategy != 'hardlink'
+        assert self._dest_data() == self.data
+        assert os.path.exists(self.source)
+
+    def test_move(self):
+        res = copyFile(self.source, self.dest, mode='move')
+        assert res.strategy == 'rename'
+        assert not os.path.exists(self.source)
+        assert self._dest_data() == self.data
+
+    @patch('os.replace')
+    def test_move_fallback(self, mockReplace):
+        mockReplace.side_effect = OSError(errno.EXDEV, 'cross-device')
+        res = copyFile(self.source, self.dest, mode='move')
+        assert res.strategy != 'rename'
+        assert not os.path.exists(self.source)
+        assert self._dest_data() == self.data
+
+    def test_bad_mode(self):
+        self.assertRaises(
+            ValueError, copyFile, self.source, self.dest, mode='teleport')
+
+    def _write_sparse(self, data, hole):
+        with open(self.source, 'wb') as f:
+            f.write(data)
+            f.seek(hole, os.SEEK_CUR)
+            f.write(data)
+        return data + b'\0' * hole + data
+
+    def _allocated(self, path):
+        return os.stat(path).st_blocks * 512
+
+    @patch('fcntl.ioctl')
+    def test_copy_sparse(self, mockIoctl):
+        mockIoctl.side_effect = OSError(errno.EOPNOTSUPP, 'not supported')
+        hole = 64 * 1024 * 1024
+        expect = self._write_sparse(b'data' * 1024, hole)
+        if self._allocated(self.source) >= hole:
+            self.skipTest('the filesystem does not support sparse files')
+
+        res = copyFile(self.source, self.dest)
+
+        assert res.strategy == 'sparse'
+        assert self._dest_data() == expect
+        assert self._allocated(self.dest) < hole
+
+    @patch('fcntl.ioctl')
+    def test_copy_userspace_zeroes(self, mockIoctl):
+        # a source with its zeroes written out becomes sparse
+        mockIoctl.side_effect = OSError(errno.EOPNOTSUPP, 'not supported')
+        zeroes = 16 * 1024 * 1024
+        with open(self.source, 'wb') as f:
+            f.write(b'\0' * zeroes + b'end')
+        unsupported = OSError(errno.EXDEV, 'cross-device')
+
+        with patch('os.copy_file_range', side_effect=unsupported, create=True):
+            with patch('os.sendfile', side_effect=unsupported):
+                res = copyFile(self.source, self.dest)
+
+        assert res.strategy == 'userspace'
+        with open(self.dest, 'rb') as f:
+            assert f.read() == b'\0' * zeroes + b'end'
+        assert self._allocated(self.dest) < zeroes
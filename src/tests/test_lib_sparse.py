@@ -0,0 +1,70 @@
+import io
+import os
+import tempfile
+import unittest
+
+from hark.lib.sparse import SparseWriter
+
+
+class TestSparseWriter(unittest.TestCase):
+    def test_write(self):
+        zeroes = b'\0' * 8192
+        data = [b'head' + b'\0' * 100, zeroes, b'x' * 5000, zeroes + b'y']
+        f = io.BytesIO()
+        w = SparseWriter(f)
+
+        for d in data:
+            assert w.write(d) == len(d)
+        assert w.finish() == sum(len(d) for d in data)
+
+        assert f.getvalue() == b''.join(data)
+        assert w.skipped == 2 * len(zeroes)
+
+    def test_write_views(self):
+        import array
+        # a reused buffer, as readinto() fills, and a view of wider items
+        buf = bytearray(b'a' * 4096 + b'\0' * 4096)
+        f = io.BytesIO()
+        w = SparseWriter(f)
+        w.write(memoryview(buf)[:6000])
+        buf[:] = b'b' * 8192
+        words = array.array('I', [0] * 1024 + [1])
+        w.write(memoryview(words))
+        w.finish()
+
+        assert f.getvalue() == \
+            b'a' * 4096 + b'\0' * 1904 + words.tobytes()
+        assert w.skipped == 1904 + 4096
+
+    def test_trailing_hole(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            with open(path, 'wb') as f:
+                w = SparseWriter(f)
+                w.write(b'x')
+                w.write(b'\0' * 10000)
+                w.finish()
+
+            with open(path, 'rb') as f:
+                assert f.read() == b'x' + b'\0' * 10000
+        finally:
+            os.remove(path)
+
+    def test_sparse_file(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            with open(path, 'wb') as f:
+                w = SparseWriter(f)
+                w.write(b'\0' * 16 * 1024 * 1024)
+                w.write(b'end')
+                w.finish()
+
+            st = os.stat(path)
+            assert st.st_size == 16 * 1024 * 1024 + 3
+            if hasattr(st, 'st_blocks'):
+                # nearly all of it is a hole, where the filesystem supports it
+                assert st.st_blocks * 512 < st.st_size
+        finally:
+            os.remove(path)
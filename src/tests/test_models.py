@@ -35,6 +35,53 @@ class TestBaseModel(unittest.TestCase):
         ins = mymodel(a=1, b=2)
         assert ins.validate() is None
 
+    def test_slots(self):
+        "Test that fields are stored in slots, not an instance dict"
+        class mymodel(BaseModel):
+            fields = ['a', 'key', 'items']
+
+        ins = mymodel(items=3, a=1)
+        assert not hasattr(ins, '__dict__')
+        assert not hasattr(ins, '_extra')
+
+        # fields iterate in declaration order, skipping unset ones
+        assert list(ins.keys()) == ['a', 'items']
+        assert len(ins) == 2
+        assert 'a' in ins
+        assert 'key' not in ins
+        self.assertRaises(KeyError, lambda: ins['key'])
+
+        ins['key'] = 2
+        assert list(ins.items()) == [('a', 1), ('key', 2), ('items', 3)]
+        assert ins.json() == '{"a": 1, "key": 2, "items": 3}'
+
+        del ins['a']
+        assert 'a' not in ins
+        self.assertRaises(KeyError, ins.__delitem__, 'a')
+
+    def test_extra_keys(self):
+        "Test that keys which aren't fields are still supported"
+        class mymodel(BaseModel):
+            fields = ['a']
+
+        ins = mymodel(a=1, z=2)
+        assert list(ins.items()) == [('a', 1), ('z', 2)]
+        assert ins['z'] == 2
+        assert 'z' in ins
+        del ins['z']
+        assert 'z' not in ins
+        self.assertRaises(KeyError, lambda: ins['y'])
+
+    def test_equality(self):
+        class mymodel(BaseModel):
+            fields = ['a', 'b']
+
+        assert mymodel(a=1, b=2) == mymodel(b=2, a=1)
+        assert mymodel(a=1, b=2) == {'a': 1, 'b': 2}
+        assert mymodel(a=1, b=2) != mymodel(a=1, b=3)
+        assert mymodel(a=1) in [mymodel(a=2), mymodel(a=1)]
+        assert dict(mymodel(a=1, b=2)) == {'a': 1, 'b': 2}
+
 
 class TestSQLModel(unittest.TestCase):
     def test_validate(self):
@@ -72,6 +119,18 @@ class TestSQLModel(unittest.TestCase):
         ins = mymodel()
         self.assertRaises(ModelInvalidException, ins.validate)
 
+    def test_from_sql_row(self):
+        m = Machine.from_sql_row(('abc', 'foo', 'bar', 'bang', 512))
+        expect = Machine(
+            machine_id='abc', name='foo',
+            driver='bar', guest='bang', memory_mb=512)
+        assert m == expect
+        assert list(m.keys()) == Machine.fields
+
+        self.assertRaises(
+            InvalidMachineException,
+            Machine.from_sql_row, ('abc', 'foo', 'bar', 'bang', 100))
+
     def test_missing_table(self):
         class mymodel(SQLModel):
             key = 'a'
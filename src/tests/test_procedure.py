@@ -0,0 +1,64 @@
+from unittest import TestCase
+try:
+    from unittest.mock import patch, MagicMock
+except ImportError:
+    from mock import patch, MagicMock
+
+import hark.client
+import hark.dal
+import hark.procedure
+
+from hark.models.machine import Machine
+
+
+class TestNewMachine(TestCase):
+    def setUp(self):
+        ctx = MagicMock()
+        ctx.dal = hark.dal.InMemoryDAL()
+        ctx.network.return_value.get_free_address.return_value = \
+            '192.168.168.2'
+        self.client = hark.client.LocalClient(ctx)
+        self.driver = MagicMock()
+        self.client.driver = MagicMock(return_value=self.driver)
+        self.machine = Machine.new(
+            name='foo', driver='virtualbox', guest='Debian-8', memory_mb=512)
+
+    def _run(self, machine):
+        proc = hark.procedure.NewMachine(self.client, machine)
+        with patch.object(proc, 'image') as mockImage:
+            mockImage.return_value = (None, '/images/base.vmdk')
+            proc.run()
+        return proc
+
+    def testCreate(self):
+        proc = self._run(self.machine)
+
+        self.driver.create.assert_called_once_with(
+            '/images/base.vmdk', self.client.dal(), linked_clone=False)
+        self.driver.setPortMappings.assert_called_once_with(
+            [proc.ssh_port_mapping])
+        assert self.client.getMachine('foo') == self.machine
+        assert self.client.portMappings() == [proc.ssh_port_mapping]
+        assert self.client.networkInterfaces() == [proc.private_interface]
+
+    def testDuplicate(self):
+        self._run(self.machine)
+        self.driver.reset_mock()
+
+        other = Machine.new(
+            name='foo', driver='virtualbox', guest='Debian-8', memory_mb=512)
+        self.assertRaises(hark.procedure.Abort, self._run, other)
+
+        # the driver never touched the existing machine
+        assert not self.driver.create.called
+        assert not self.driver.remove.called
+
+    def testFailureRemovesMachine(self):
+        self.driver.setPortMappings.side_effect = OSError('no VBoxManage')
+
+        self.assertRaises(OSError, self._run, self.machine)
+
+        # nothing was saved, so the driver's machine is removed too
+        assert self.driver.remove.called
+        assert self.client.machines() == []
+        assert self.client.portMappings() == []
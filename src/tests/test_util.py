@@ -1,7 +1,10 @@
 import unittest
 from unittest.mock import call, patch
 
+from hark.exceptions import ImageNotFound
+from hark.models.image import Image
 import hark.util
+from hark.util.imageindex import ImageIndex
 
 
 class TestGetFreePort(unittest.TestCase):
@@ -50,3 +53,90 @@ class TestCheckHarkEnv(unittest.TestCase):
         mockVersionInfo.micro = 11
         self.assertRaises(
             hark.exceptions.BadHarkEnvironment, hark.util.checkHarkEnv)
+
+
+class TestParseSize(unittest.TestCase):
+    def test_parseSize(self):
+        assert hark.util.parseSize('100') == 100
+        assert hark.util.parseSize('2k') == 2048
+        assert hark.util.parseSize('1.5M') == 3 * 512 * 1024
+        assert hark.util.parseSize('20G') == 20 * 1024 ** 3
+        assert hark.util.parseSize('1GiB') == 1024 ** 3
+
+    def test_parseSize_invalid(self):
+        for s in ['', 'lots', '10X', '-1G']:
+            self.assertRaises(ValueError, hark.util.parseSize, s)
+
+
+class TestFormatSize(unittest.TestCase):
+    def test_formatSize(self):
+        assert hark.util.formatSize(100) == '100B'
+        assert hark.util.formatSize(1536) == '1.5K'
+        assert hark.util.formatSize(20 * 1024 ** 3) == '20.0G'
+        assert hark.util.formatSize(3 * 1024 ** 4) == '3.0T'
+
+
+class TestImageIndex(unittest.TestCase):
+    def setUp(self):
+        self.images = [
+            Image(driver='virtualbox', guest='Debian-8', version=v)
+            for v in (3, 1, 10, 2)
+        ] + [
+            Image(driver='virtualbox', guest='Debian-7', version=5),
+            Image(driver='qemu', guest='Debian-8', version=7),
+        ]
+        self.index = ImageIndex(self.images)
+
+    def test_latest(self):
+        im = self.index.latest('virtualbox', 'Debian-8')
+        assert im['version'] == 10
+        self.assertRaises(
+            ImageNotFound, self.index.latest, 'virtualbox', 'Debian-9')
+
+    def test_exact(self):
+        im = self.index.exact('virtualbox', 'Debian-8', 2)
+        assert im == Image(driver='virtualbox', guest='Debian-8', version=2)
+        self.assertRaises(
+            ImageNotFound, self.index.exact, 'virtualbox', 'Debian-8', 4)
+
+    def test_range(self):
+        def versions(images):
+            return [i['version'] for i in images]
+
+        r = self.index.range('virtualbox', 'Debian-8', 2, 3)
+        assert versions(r) == [2, 3]
+        r = self.index.range('virtualbox', 'Debian-8', min_version=3)
+        assert versions(r) == [3, 10]
+        r = self.index.range('virtualbox', 'Debian-8', max_version=9)
+        assert versions(r) == [1, 2, 3]
+        assert self.index.range('virtualbox', 'Debian-9') == []
+
+    def test_add_remove(self):
+        im = Image(driver='virtualbox', guest='Debian-8', version=11)
+        assert im not in self.index
+        self.index.add(im)
+        assert im in self.index
+        assert self.index.latest('virtualbox', 'Debian-8') == im
+        assert len(self.index) == len(self.images) + 1
+
+        self.index.remove(im)
+        assert im not in self.index
+        self.assertRaises(ImageNotFound, self.index.remove, im)
+
+        qemu = self.index.latest('qemu', 'Debian-8')
+        self.index.remove(qemu)
+        self.assertRaises(
+            ImageNotFound, self.index.latest, 'qemu', 'Debian-8')
+
+    def test_iter(self):
+        keys = [(i['driver'], i['guest'], i['version']) for i in self.index]
+        assert keys == sorted(keys)
+
+    def test_findImage(self):
+        im = hark.util.findImage(self.images, 'virtualbox', 'Debian-8')
+        assert im['version'] == 10
+        im = hark.util.findImage(self.images, 'virtualbox', 'Debian-8', 3)
+        assert im['version'] == 3
+        self.assertRaises(
+            ImageNotFound,
+            hark.util.findImage, self.images, 'qemu', 'Debian-7')
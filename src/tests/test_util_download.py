@@ -0,0 +1,382 @@
+import hashlib
+import http.server
+import io
+import json
+import os
+import re
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+import unittest
+try:
+    from unittest.mock import MagicMock, patch
+except ImportError:
+    from mock import MagicMock, patch
+
+from hark.util.download import (
+    DEFAULT_TIMEOUT,
+    _segments, compressionFromUrl, decompressingDownload, resumableDownload,
+    responseToFile, segmentedDownload,
+)
+
+
+def response(data, headers=None):
+    resp = MagicMock()
+    resp.headers = {'Content-Length': str(len(data))}
+    resp.headers.update(headers or {})
+    resp.raw = io.BytesIO(data)
+    resp.iter_content.return_value = [data]
+    return resp
+
+
+class TestResponseToFile(unittest.TestCase):
+    def test_responseToFile(self):
+        data = bytes(range(256)) * 100
+        f = io.BytesIO()
+        hasher = hashlib.sha256()
+
+        n = responseToFile(
+            'test', response(data), f, hasher=hasher, buffer_size=1000)
+
+        assert n == len(data)
+        assert f.getvalue() == data
+        assert hasher.hexdigest() == hashlib.sha256(data).hexdigest()
+
+    def test_responseToFile_encoded(self):
+        # an encoded body is decoded by requests rather than read raw
+        resp = response(b'decoded', {'Content-Encoding': 'gzip'})
+        resp.raw = None
+        f = io.BytesIO()
+
+        responseToFile('test', resp, f)
+
+        assert f.getvalue() == b'decoded'
+
+    @patch('click.progressbar')
+    def test_responseToFile_no_length(self, mockProgressBar):
+        # a chunked response has no Content-Length
+        data = b'x' * 10000
+        resp = response(data)
+        del resp.headers['Content-Length']
+        f = io.BytesIO()
+
+        assert responseToFile('test', resp, f, buffer_size=1000) == len(data)
+        assert f.getvalue() == data
+        assert not mockProgressBar.called
+
+        # nor is the encoded length used for the decoded body
+        resp = response(b'decoded', {'Content-Encoding': 'gzip'})
+        responseToFile('test', resp, io.BytesIO())
+        assert not mockProgressBar.called
+
+    @patch('click.progressbar')
+    def test_responseToFile_progress(self, mockProgressBar):
+        bar = mockProgressBar.return_value.__enter__.return_value
+        data = b'x' * 10000
+
+        responseToFile(
+            'test', response(data), io.BytesIO(), buffer_size=10,
+            progress_interval=60)
+
+        # the bar is updated once at the end, not for each of 1000 chunks
+        bar.update.assert_called_once_with(len(data))
+
+
+class TestResumableDownload(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(self.path)
+        self.state_path = self.path + '.json'
+        self.data = b'0123456789' * 10
+        self.sha256 = hashlib.sha256(self.data).hexdigest()
+
+    def tearDown(self):
+        for p in (self.path, self.state_path):
+            if os.path.exists(p):
+                os.remove(p)
+
+    def _partial(self, n, etag='"v1"'):
+        with open(self.path, 'wb') as f:
+            f.write(self.data[:n])
+        with open(self.state_path, 'w') as f:
+            json.dump({'url': 'http://x', 'sha256': self.sha256,
+                       'etag': etag, 'last_modified': None}, f)
+
+    @patch('requests.get')
+    def test_fresh(self, mockGet):
+        resp = response(self.data, {'ETag': '"v1"'})
+        resp.status_code = 200
+        mockGet.return_value = resp
+
+        digest = resumableDownload(
+            'test', 'http://x', self.path, sha256=self.sha256)
+
+        assert digest == self.sha256
+        mockGet.assert_called_once_with(
+            'http://x', headers={}, stream=True, timeout=DEFAULT_TIMEOUT)
+        with open(self.state_path) as f:
+            assert json.load(f)['etag'] == '"v1"'
+
+    @patch('requests.get')
+    def test_resume(self, mockGet):
+        self._partial(40)
+        resp = response(self.data[40:], {
+            'ETag': '"v1"', 'Content-Range': 'bytes 40-99/100'})
+        resp.status_code = 206
+        mockGet.return_value = resp
+
+        digest = resumableDownload(
+            'test', 'http://x', self.path, sha256=self.sha256)
+
+        assert digest == self.sha256
+        mockGet.assert_called_once_with(
+            'http://x', headers={'Range': 'bytes=40-', 'If-Range': '"v1"'},
+            stream=True, timeout=DEFAULT_TIMEOUT)
+        with open(self.path, 'rb') as f:
+            assert f.read() == self.data
+
+    @patch('requests.get')
+    def test_resume_changed(self, mockGet):
+        # If-Range didn't match, so the server sends the whole file
+        self._partial(40)
+        with open(self.path, 'wb') as f:
+            f.write(b'x' * 40)
+        resp = response(self.data, {'ETag': '"v2"'})
+        resp.status_code = 200
+        mockGet.return_value = resp
+
+        digest = resumableDownload(
+            'test', 'http://x', self.path, sha256=self.sha256)
+
+        assert digest == self.sha256
+        with open(self.path, 'rb') as f:
+            assert f.read() == self.data
+
+    @patch('requests.get')
+    def test_no_validator(self, mockGet):
+        self._partial(40, etag=None)
+        resp = response(self.data)
+        resp.status_code = 200
+        mockGet.return_value = resp
+
+        resumableDownload('test', 'http://x', self.path, sha256=self.sha256)
+
+        mockGet.assert_called_once_with(
+            'http://x', headers={}, stream=True, timeout=DEFAULT_TIMEOUT)
+
+    @patch('requests.get')
+    def test_interrupted(self, mockGet):
+        resp = response(self.data, {'ETag': '"v1"'})
+        resp.status_code = 200
+        resp.raw = MagicMock()
+        resp.raw.readinto.side_effect = IOError('connection reset')
+        mockGet.return_value = resp
+
+        self.assertRaises(
+            IOError, resumableDownload, 'test', 'http://x', self.path)
+
+        # the partial file and its state are kept to resume from
+        assert os.path.exists(self.path)
+        assert os.path.exists(self.state_path)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    "http.server.ThreadingHTTPServer, which is only in Python 3.7 on"
+    daemon_threads = True
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    "Serves the server's data, honouring single byte ranges"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        data = self.server.data
+        self.server.requests.append(self.headers.get('Range'))
+        stall = self.server.stall and self.headers.get('Range') != 'bytes=0-0'
+
+        m = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if m is None or not self.server.ranges:
+            self.send_response(200)
+            body = data
+        else:
+            start = int(m.group(1))
+            end = int(m.group(2)) if m.group(2) else len(data) - 1
+            body = data[start:end + 1]
+            self.send_response(206)
+            self.send_header(
+                'Content-Range', 'bytes %d-%d/%d' % (start, end, len(data)))
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', '"v1"')
+        self.end_headers()
+        if stall:
+            # send the headers, then nothing
+            time.sleep(1)
+            return
+        self.wfile.write(body)
+
+
+class TestSegmentedDownload(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(
+            ('127.0.0.1', 0), RangeHandler)
+        self.server.data = os.urandom(100000)
+        self.server.ranges = True
+        self.server.stall = False
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever).start()
+        self.url = 'http://127.0.0.1:%d/image' % self.server.server_address[1]
+
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'image.partial')
+        self.sha256 = hashlib.sha256(self.server.data).hexdigest()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tempdir)
+
+    def _data(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_segments(self):
+        digest = segmentedDownload(
+            'test', self.url, self.path, sha256=self.sha256, segments=4,
+            chunk_size=1000)
+
+        assert digest == self.sha256
+        assert self._data() == self.server.data
+        # a probe, then one request for each of the four segments
+        assert sorted(self.server.requests[1:]) == [
+            'bytes=0-24999', 'bytes=25000-49999',
+            'bytes=50000-74999', 'bytes=75000-99999']
+
+        with open(self.path + '.json') as f:
+            state = json.load(f)
+        assert all(s['pos'] == s['end'] + 1 for s in state['segments'])
+
+    @patch('os.pwrite', side_effect=os.pwrite)
+    def test_sparse(self, mockPwrite):
+        # each chunk has data in it, but only its data blocks are written
+        block = 4096
+        self.server.data = (os.urandom(block) + bytes(3 * block)) * 8
+        sha256 = hashlib.sha256(self.server.data).hexdigest()
+
+        digest = segmentedDownload(
+            'test', self.url, self.path, sha256=sha256, segments=2,
+            chunk_size=4 * block)
+
+        assert digest == sha256
+        assert self._data() == self.server.data
+        written = sum(len(c[0][1]) for c in mockPwrite.call_args_list)
+        assert written == 8 * block
+
+    @patch('hark.util.download._hashFile')
+    def test_single_pass(self, mockHashFile):
+        # the file is hashed as it arrives, not reread afterwards
+        digest = segmentedDownload(
+            'test', self.url, self.path, sha256=self.sha256, segments=4,
+            chunk_size=1000)
+        assert digest == self.sha256
+        assert not mockHashFile.called
+
+    def test_stalled(self):
+        self.server.stall = True
+
+        self.assertRaises(
+            Exception, segmentedDownload,
+            'test', self.url, self.path, sha256=self.sha256, segments=2,
+            chunk_size=1000, timeout=(1, 0.1))
+
+        # the state is left to resume from
+        with open(self.path + '.json') as f:
+            assert len(json.load(f)['segments']) == 2
+
+    def test_resume(self):
+        segmentedDownload(
+            'test', self.url, self.path, sha256=self.sha256, segments=2,
+            chunk_size=1000)
+
+        # pretend the second segment was interrupted halfway through
+        with open(self.path + '.json') as f:
+            state = json.load(f)
+        state['segments'][1]['pos'] = 75000
+        with open(self.path + '.json', 'w') as f:
+            json.dump(state, f)
+        with open(self.path, 'r+b') as f:
+            f.seek(75000)
+            f.write(b'\0' * 25000)
+        self.server.requests = []
+
+        digest = segmentedDownload(
+            'test', self.url, self.path, sha256=self.sha256, segments=2,
+            chunk_size=1000)
+
+        assert digest == self.sha256
+        assert self.server.requests == ['bytes=0-0', 'bytes=75000-99999']
+
+    def test_no_ranges(self):
+        self.server.ranges = False
+
+        digest = segmentedDownload(
+            'test', self.url, self.path, sha256=self.sha256, segments=4,
+            chunk_size=1000)
+
+        assert digest == self.sha256
+        assert self._data() == self.server.data
+        assert self.server.requests == ['bytes=0-0', None]
+
+    def test_segments_chunk_aligned(self):
+        parts = _segments(10000, 3, 1024)
+        assert [(p['start'], p['end']) for p in parts] == [
+            (0, 4095), (4096, 8191), (8192, 9999)]
+
+
+class TestDecompressingDownload(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'image.partial')
+        self.data = os.urandom(5000) + b'\0' * 100000 + os.urandom(5000)
+        self.sha256 = hashlib.sha256(self.data).hexdigest()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    @patch('requests.get')
+    def _download(self, compression, compressed, mockGet):
+        mockGet.return_value = response(compressed)
+        digest = decompressingDownload(
+            'test', 'http://x', self.path, compression, buffer_size=1000)
+        with open(self.path, 'rb') as f:
+            assert f.read() == self.data
+        return digest
+
+    def test_xz(self):
+        import lzma
+        assert self._download('xz', lzma.compress(self.data)) == self.sha256
+
+    @patch('hark.util.download._LZMA_MAX_LENGTH', False)
+    def test_xz_unbounded(self):
+        # before Python 3.5 each chunk is decompressed whole
+        import lzma
+        assert self._download('xz', lzma.compress(self.data)) == self.sha256
+
+    def test_gz(self):
+        import gzip
+        assert self._download('gz', gzip.compress(self.data)) == self.sha256
+
+    def test_truncated(self):
+        import lzma
+        compressed = lzma.compress(self.data)
+        self.assertRaises(
+            IOError, self._download, 'xz', compressed[:len(compressed) // 2])
+
+    def test_compressionFromUrl(self):
+        assert compressionFromUrl('http://x/a.vmdk.xz?sig=1') == 'xz'
+        assert compressionFromUrl('http://x/a.vmdk.gz') == 'gz'
+        assert compressionFromUrl('http://x/a.vmdk') is None